@@ -0,0 +1,91 @@
+"""Compares the sync (enroll.api) and async (enroll.async_api) enroll services.
+
+Start the services and DynamoDB Local/Redis first (sh run.sh, then foreman start
+enroll_async for the async one), reset the data (sh resetDatabases.sh) and run:
+
+    python benchmarks/async_vs_sync.py --requests 2000 --concurrency 200
+
+Every scenario is sent to both services with the same number of requests in
+flight, and throughput plus p50/p95/p99 latency are printed side by side.
+"""
+import argparse
+import asyncio
+import itertools
+import statistics
+import time
+
+import httpx
+
+SCENARIOS = {
+    # name: (method, path builder)
+    "list": ("GET", lambda n: "/list"),
+    "enrolled": ("GET", lambda n: "/enrolled/11/2/micah/mbaumann@csu.fullerton.edu"),
+    "waitlist": ("GET", lambda n: f"/waitlist/{n}/2/student{n}/student{n}@example.com"),
+    # fresh student ids, spread over the active classes, end up enrolled or waitlisted
+    "enroll": ("POST", lambda n: f"/enroll/{n}/{(2, 4, 6, 8, 10)[n % 5]}/student{n}/student{n}@example.com"),
+}
+
+
+def percentile(latencies, pct):
+    ordered = sorted(latencies)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_scenario(base_url, method, path_for, total, concurrency, first_id):
+    ids = itertools.count(first_id)
+    latencies = []
+    errors = 0
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=30, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def worker(count):
+            nonlocal errors
+            for _ in range(count):
+                path = path_for(next(ids))
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path)
+                    if response.status_code >= 500:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        per_worker = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(count) for count in per_worker if count))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "throughput": len(latencies) / elapsed,
+        "mean": statistics.mean(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "errors": errors,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sync-url", default="http://localhost:5300")
+    parser.add_argument("--async-url", default="http://localhost:5600")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per scenario and service")
+    parser.add_argument("--concurrency", type=int, default=100, help="requests in flight at once")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated, from: " + ", ".join(SCENARIOS))
+    args = parser.parse_args()
+
+    print(f"{'scenario':<10} {'service':<6} {'req/s':>9} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'5xx':>5}")
+    # student ids for write scenarios start well above the sample data and never repeat
+    first_id = 100000
+    for name in args.scenarios.split(","):
+        method, path_for = SCENARIOS[name]
+        for service, base_url in (("sync", args.sync_url), ("async", args.async_url)):
+            result = await run_scenario(base_url, method, path_for, args.requests, args.concurrency, first_id)
+            first_id += args.requests
+            print(f"{name:<10} {service:<6} {result['throughput']:>9.1f} {result['mean'] * 1000:>9.1f} "
+                  f"{result['p50'] * 1000:>9.1f} {result['p95'] * 1000:>9.1f} {result['p99'] * 1000:>9.1f} {result['errors']:>5}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,352 @@
+"""Load test of the enroll and users services with registration-open traffic.
+
+Workers send a weighted mix of requests for as long as --duration: students
+listing the catalog, enrolling (mostly in a few popular classes, so they fill
+up and waitlists grow), dropping classes they got into, checking their
+waitlist position, logging in and the registrar looking users up. For every
+endpoint it reports throughput, p50/p95/p99 latency, the status codes and the
+error rate (5xx responses and failed connections, a 409 for a full class is an
+answer, not an error) and the share of requests turned away with a 429 by the
+login rate limits, and writes them to a JSON file with the commit they were
+measured on.
+
+Logins are spread over --login-users users, since each username only gets a
+handful of attempts before its rate limit kicks in. With --start-stack they are
+created as loadtest1, loadtest2, ... and the per-client limit is raised, all the
+traffic comes from one address. Against running services the sample users are
+used, expect most logins to be rejected with 429 under any real load.
+
+Against services that are already running (sh run.sh, then sh resetDatabases.sh):
+
+    python benchmarks/load_test.py --duration 60 --concurrency 100
+
+Or let it start everything on local stand-ins, DynamoDB Local from bin/ in
+memory, a throwaway redis-server and a fresh copy of the users SQLite database,
+one worker each of enroll.api, users.auth and the promotions worker:
+
+    python benchmarks/load_test.py --start-stack
+
+Compare a run with an earlier one, for instance from before a change:
+
+    python benchmarks/load_test.py --compare benchmarks/results/<earlier>.json
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import json
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+from async_vs_sync import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+DYNAMODB_PORT = 5500
+ACTIVE_CLASSES = (2, 4, 6, 8, 10)
+# registration opens and most students go for the same couple of classes
+CLASS_WEIGHTS = (8, 4, 1, 1, 1)
+# student ids above the sample data
+FIRST_STUDENT_ID = 100000
+DEFAULT_MIX = "list=30,enroll=30,drop=10,waitlist=15,login=5,getuser=10"
+# users in users/var/users.sql, all with the password 12345
+SAMPLE_USERS = ("fara", "steve", "andy", "tim", "elizabeth", "george", "pheobe", "earl", "sarah", "anna", "micah", "edwin")
+
+
+class Traffic:
+    """Builds the requests of each scenario, remembering who got into which class so drops hit real enrollments"""
+    def __init__(self, students: int, seed: int, login_users=SAMPLE_USERS):
+        self.random = random.Random(seed)
+        self.students = students
+        self.login_users = login_users
+        self.enrolled = []
+
+    def student(self):
+        student_id = FIRST_STUDENT_ID + self.random.randrange(self.students)
+        return student_id, f"/{student_id}/{{}}/student{student_id}/student{student_id}@example.com"
+
+    def popular_class(self):
+        return self.random.choices(ACTIVE_CLASSES, CLASS_WEIGHTS)[0]
+
+    def request(self, scenario: str):
+        """Returns (service, method, path, json body)"""
+        if scenario == "list":
+            return "enroll", "GET", "/list", None
+        if scenario == "enroll":
+            _, path = self.student()
+            return "enroll", "POST", "/enroll" + path.format(self.popular_class()), None
+        if scenario == "drop" and self.enrolled:
+            student_id, class_id = self.enrolled.pop(self.random.randrange(len(self.enrolled)))
+            return "enroll", "DELETE", f"/enrollmentdrop/{student_id}/{class_id}/student{student_id}/student{student_id}@example.com", None
+        if scenario in ("drop", "waitlist"):
+            # nobody to drop yet, students are still checking where they stand
+            _, path = self.student()
+            return "enroll", "GET", "/waitlist" + path.format(self.popular_class()), None
+        if scenario == "login":
+            return "users", "POST", "/login", {"username": self.random.choice(self.login_users), "password": "12345"}
+        if scenario == "getuser":
+            return "users", "GET", f"/getuser/{self.random.randint(1, 12)}", None
+        raise ValueError(f"Unknown scenario {scenario}")
+
+    def observe(self, method: str, path: str, response):
+        if method == "POST" and path.startswith("/enroll/") and response.status_code == 200 \
+                and response.json().get("message") == "Enrollment added successfully":
+            _, _, student_id, class_id, *_ = path.split("/")
+            self.enrolled.append((int(student_id), int(class_id)))
+
+
+def parse_mix(mix: str):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def load_test_users(count: int):
+    return tuple(f"loadtest{n}" for n in range(1, count + 1))
+
+
+def summarize(latencies, statuses, errors: int, elapsed: float):
+    count = len(latencies)
+    if not count:
+        return {"requests": 0, "errors": errors, "error_rate": 1.0 if errors else 0.0,
+                "rejected": 0, "rejected_rate": 0.0, "statuses": dict(statuses)}
+    return {
+        "requests": count,
+        "throughput": round(count / elapsed, 2),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+        "errors": errors,
+        "error_rate": round(errors / count, 4),
+        "rejected": statuses[429],
+        "rejected_rate": round(statuses[429] / count, 4),
+        "statuses": {str(code): n for code, n in sorted(statuses.items(), key=lambda item: str(item[0]))},
+    }
+
+
+async def run_load(args, base_urls):
+    login_users = load_test_users(args.login_users) if args.start_stack and args.login_users else SAMPLE_USERS
+    traffic = Traffic(args.students, args.seed, login_users)
+    mix = parse_mix(args.mix)
+    scenarios, weights = list(mix), list(mix.values())
+    latencies = collections.defaultdict(list)
+    statuses = collections.defaultdict(collections.Counter)
+    errors = collections.Counter()
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with contextlib.AsyncExitStack() as stack:
+        clients = {
+            service: await stack.enter_async_context(httpx.AsyncClient(base_url=url, timeout=30, limits=limits))
+            for service, url in base_urls.items()
+        }
+        start = time.perf_counter()
+        measure_from = start + args.warmup
+        stop_at = measure_from + args.duration
+
+        async def worker():
+            while time.perf_counter() < stop_at:
+                scenario = traffic.random.choices(scenarios, weights)[0]
+                service, method, path, body = traffic.request(scenario)
+                sent = time.perf_counter()
+                try:
+                    response = await clients[service].request(method, path, json=body)
+                    status = response.status_code
+                    traffic.observe(method, path, response)
+                except httpx.HTTPError as e:
+                    response, status = None, type(e).__name__
+                if sent < measure_from:
+                    continue
+                latencies[scenario].append(time.perf_counter() - sent)
+                statuses[scenario][status] += 1
+                if response is None or response.status_code >= 500:
+                    errors[scenario] += 1
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - measure_from
+
+    endpoints = {
+        scenario: summarize(latencies[scenario], statuses[scenario], errors[scenario], elapsed)
+        for scenario in scenarios
+    }
+    total = summarize(
+        [latency for values in latencies.values() for latency in values],
+        sum(statuses.values(), collections.Counter()),
+        sum(errors.values()),
+        elapsed,
+    )
+    return total, endpoints
+
+
+def wait_for_port(port: int, process, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"{' '.join(process.args)} exited with {process.returncode}")
+        with contextlib.suppress(OSError), socket.create_connection(("localhost", port), timeout=1):
+            return
+        time.sleep(0.2)
+    sys.exit(f"Nothing listening on port {port} after {timeout} seconds")
+
+
+@contextlib.contextmanager
+def local_stack(args):
+    """Starts DynamoDB Local, Redis, the users and enroll services and the promotions worker, stops them on exit"""
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    users_db = os.path.join(workdir, "users.db")
+    with open(os.path.join(ROOT, "users", "var", "users.sql")) as script, contextlib.closing(sqlite3.connect(users_db)) as db:
+        db.executescript(script.read())
+        # the sample users' hash of 12345, so logging them in costs the same as the real ones
+        (password,), = db.execute("SELECT UserPassword FROM Registrations WHERE Username = 'micah'")
+        db.executemany(
+            "INSERT INTO Registrations(Username, FullName, Email, UserPassword) VALUES (?, ?, ?, ?)",
+            [(username, f"Load Test {username}", f"{username}@example.com", password)
+             for username in load_test_users(args.login_users)])
+        db.commit()
+    redis_port = urlsplit(args.redis_url).port or 6379
+    env = {
+        **os.environ,
+        "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+        "AWS_ACCESS_KEY_ID": os.environ.get("AWS_ACCESS_KEY_ID", "local"),
+        "AWS_SECRET_ACCESS_KEY": os.environ.get("AWS_SECRET_ACCESS_KEY", "local"),
+        "DATABASE_2": users_db,
+        "DATABASE_3": users_db,
+        "REDIS_PORT": str(redis_port),
+        "USERS_SERVICE_URLS": json.dumps([args.users_url]),
+        # every request comes from this machine, only the per-username limits should bite
+        "LOGIN_CLIENT_RATE": "100000",
+        "LOGIN_CLIENT_BURST": "100000",
+    }
+    processes = []
+    log = open(os.path.join(workdir, "stack.log"), "w")
+
+    def start(command, port=None, **overrides):
+        process = subprocess.Popen(command, cwd=ROOT, env={**env, **overrides}, stdout=log, stderr=subprocess.STDOUT)
+        processes.append(process)
+        if port is not None:
+            wait_for_port(port, process)
+        return process
+
+    try:
+        start(["java", "-Djava.library.path=./bin/DynamoDBLocal_lib", "-jar", "./bin/DynamoDBLocal.jar",
+               "-inMemory", "-port", str(DYNAMODB_PORT)], DYNAMODB_PORT)
+        start(["redis-server", "--port", str(redis_port), "--save", "", "--appendonly", "no"], redis_port)
+        subprocess.run([sys.executable, "enroll/var/catalog.py"], cwd=ROOT, env=env, stdout=log, check=True)
+        start([sys.executable, "-m", "uvicorn", "--port", str(urlsplit(args.users_url).port), "users.auth:app"],
+              urlsplit(args.users_url).port, DATABASE=users_db)
+        start([sys.executable, "-m", "uvicorn", "--port", str(urlsplit(args.enroll_url).port), "enroll.api:app"],
+              urlsplit(args.enroll_url).port)
+        start([sys.executable, "-m", "enroll.promotions", "run"])
+        print(f"Stack running, logs in {log.name}")
+        yield
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        log.close()
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def print_results(total, endpoints):
+    print(f"{'endpoint':<10} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>8} "
+          f"{'429s':>8}  statuses")
+    for name, result in [*endpoints.items(), ("total", total)]:
+        if not result["requests"]:
+            print(f"{name:<10} {0:>9} {'-':>9} {'-':>9} {'-':>9} {'-':>9} {result['error_rate']:>8.2%} {'-':>8}  "
+                  f"{result['statuses']}")
+            continue
+        print(f"{name:<10} {result['requests']:>9} {result['throughput']:>9.1f} {result['p50_ms']:>9.1f} "
+              f"{result['p95_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['error_rate']:>8.2%} "
+              f"{result['rejected_rate']:>8.2%}  {result['statuses']}")
+
+
+def print_comparison(baseline, total, endpoints):
+    """Prints the change of throughput, p95, p99 and error rate against an earlier run"""
+    print(f"\nagainst {baseline.get('commit', '?')[:10]} ({baseline.get('timestamp', '?')}):")
+    print(f"{'endpoint':<10} {'req/s':>9} {'p95':>9} {'p99':>9} {'errors':>9}")
+    previous = {**baseline["endpoints"], "total": baseline["total"]}
+    for name, result in [*endpoints.items(), ("total", total)]:
+        before = previous.get(name)
+        if not before or not before["requests"] or not result["requests"]:
+            continue
+
+        def change(key):
+            return f"{(result[key] - before[key]) / before[key]:+.1%}" if before[key] else "-"
+        print(f"{name:<10} {change('throughput'):>9} {change('p95_ms'):>9} {change('p99_ms'):>9} "
+              f"{(result['error_rate'] - before['error_rate']) * 100:>+8.2f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--enroll-url", default="http://localhost:5300")
+    parser.add_argument("--users-url", default="http://localhost:5000")
+    parser.add_argument("--redis-url", default="redis://localhost:6379", help="where --start-stack runs redis-server")
+    parser.add_argument("--start-stack", action="store_true", help="start the services on local stand-ins first")
+    parser.add_argument("--duration", type=float, default=30, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of traffic before measuring")
+    parser.add_argument("--concurrency", type=int, default=100, help="requests in flight at once")
+    parser.add_argument("--students", type=int, default=5000, help="distinct student ids in the traffic")
+    parser.add_argument("--login-users", type=int, default=1000,
+                        help="users created to log in as with --start-stack, otherwise the sample users are used")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"scenario weights, default {DEFAULT_MIX}")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="JSON file for the results, default benchmarks/results/<commit>-<time>.json")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    base_urls = {"enroll": args.enroll_url, "users": args.users_url}
+    with local_stack(args) if args.start_stack else contextlib.nullcontext():
+        total, endpoints = asyncio.run(run_load(args, base_urls))
+
+    print_results(total, endpoints)
+    commit, dirty = git_commit()
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": timestamp,
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "total": total,
+        "endpoints": endpoints,
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{(commit or 'unknown')[:10]}-{timestamp.replace(':', '').replace('-', '')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            print_comparison(json.load(baseline_file), total, endpoints)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,289 +1,473 @@
 import contextlib
-import requests
+import contextvars
+import logging
+import logging.config
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import redis
-import boto3
 
-from fastapi import FastAPI, Depends, HTTPException, status, Request
+from fastapi import FastAPI, HTTPException, status, Request, Query
+from fastapi.responses import StreamingResponse, Response, FileResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic_settings import BaseSettings
 from pydantic import BaseModel
-from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key, Attr
 
-KRAKEND_PORT = "5400"
-
-# start dynamo db
-dynamo_db = boto3.resource('dynamodb', endpoint_url="http://localhost:5500")
-# retrieve tables
-users_table = dynamo_db.Table('Users')
-classes_table = dynamo_db.Table('Classes')
-enrollments_table = dynamo_db.Table('Enrollments')
+from enroll.waitlist import Waitlist, ALREADY_WAITLISTED, WAITLIST_FULL
+from enroll.cache import ClassCache
+from enroll.known_users import KnownUsers
+from enroll.open_classes import OpenClasses, etag, etag_matches
+from enroll.teardown import ClassTeardown
+from enroll.pagination import encode_cursor, format_rows, MEDIA_TYPES
+from enroll.class_import import read_rows, parse_row
+from enroll.users_client import UsersClient, UsersServiceUnavailable
+from enroll.promotions import SeatEvents, Promoter, PromotionWorker, PromotionConflict
+from enroll.idempotency import IdempotencyStore, replay_or_run
+from enroll.repository import (
+    open_repository, RepositoryError, ConditionFailed, TransactionCancelled,
+    TakeSeat, AddSeats, SetEnrollmentState,
+)
+from enroll.dynamodb_repository import DynamoDBRepository
+from enroll.enrollments import (
+    enrollment_state, enrollment_changed, check_class_found, check_active, check_can_enroll, check_can_drop,
+    check_can_leave_waitlist, check_can_drop_administratively, check_instructor, check_waitlist_push,
+    check_roster_request, parse_cursor, enrollment_write, enroll_writes, seat_refused, student_rows, waitlist_page,
+)
+from enroll import metrics, tracing
 
 class Settings(BaseSettings, env_file="enroll/.env", extra="ignore"):
+    # dynamodb://localhost:5500, sqlite:///./enroll/var/enroll.db or memory://, see enroll/repository.py
     database: str
     logging_config: str
+    id_block_size: int = 20
+    # "transactional" takes the seat and writes the enrollment in one transaction,
+    # "legacy" checks capacity in python and writes them separately
+    enroll_mode: str = "transactional"
+    redis_host: str = "localhost"
+    redis_port: int = 6379
+    redis_db: int = 0
+    # connections shared by all requests in this worker, a request waits up to
+    # redis_pool_timeout seconds for one when they are all in use
+    redis_max_connections: int = 50
+    redis_pool_timeout: int = 5
+    # class items cached per worker, see enroll/cache.py
+    class_cache_size: int = 1024
+    class_cache_ttl: float = 30
+    # users that already have a Users item, see enroll/known_users.py
+    known_users_size: int = 100000
+    user_flush_interval: float = 1
+    # threads writing drop batches when /remove tears down a class
+    teardown_workers: int = 8
+    # parallel enrollment queries of one /enrollcart request
+    cart_lookup_workers: int = 8
+    # threads writing 25 class batches during /import
+    import_workers: int = 8
+    # users service instances the registrar endpoints look instructors up in, see enroll/users_client.py
+    users_service_urls: list[str] = ["http://localhost:5000", "http://localhost:5100", "http://localhost:5200"]
+    users_service_timeout: float = 2
+    user_profile_ttl: float = 300
+    user_profile_cache_size: int = 10000
+    # responses replayed for an Idempotency-Key, see enroll/idempotency.py
+    idempotency_ttl: int = 86400
+    idempotency_lock_ttl: int = 60
+    # seconds clients and KrakenD may reuse a /list response without revalidating it
+    catalog_max_age: int = 5
+    # see enroll/tracing.py, requests taking trace_log_threshold seconds or more are logged with their trace
+    trace_log_threshold: float = 1
+    profile_dir: str = "./enroll/var/profiles"
+    profile_all_requests: bool = False
+
+
+class IdAllocator:
+    """Hands out unique ids from an atomic counter in the repository.
+
+    Each worker leases a block of ids with a single ADD and then hands them out
+    locally, so most allocations don't touch the database at all. Ids left in a
+    block when a worker restarts are skipped, never reused.
+    """
+    def __init__(self, counter_name: str, block_size: int):
+        self.counter_name = counter_name
+        self.block_size = block_size
+        self.next_id = 1
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+    def lease_block(self, size: int):
+        return repository.lease_ids(self.counter_name, size)
+
+    def allocate(self):
+        with self.lock:
+            if self.next_id > self.last_id:
+                self.next_id, self.last_id = self.lease_block(self.block_size)
+            new_id = self.next_id
+            self.next_id += 1
+            return new_id
+
+
+class UnitOfWork:
+    """Reads and writes of one request.
+
+    Class and enrollment items are memoized, so a request never fetches the same
+    item twice. Enrollment state changes and CurrentEnrollment deltas are staged
+    and sent at commit() as one repository transaction, which publishes a seat
+    freed event for every class that lost a student (see enroll/promotions.py).
+    """
+    def __init__(self):
+        self.classes = {}
+        self.enrollments = {}
+        self.writes = []
+        self.seat_deltas = {}
+
+    def stage_enrollment_state(self, enrollment, new_status: str):
+        """Changes the enrollment's state at commit, if it still has the state it was read with"""
+        self.writes.append(SetEnrollmentState(enrollment["EnrollmentID"], enrollment["EnrollmentState"], new_status))
+        enrollment["EnrollmentState"] = new_status
+
+    def stage_seats(self, class_id: int, delta: int):
+        self.seat_deltas[class_id] = self.seat_deltas.get(class_id, 0) + delta
+
+    def commit(self):
+        """Sends the staged writes, raises TransactionCancelled if any condition failed (nothing is written then)"""
+        writes = self.writes + [AddSeats(class_id, delta) for class_id, delta in self.seat_deltas.items() if delta]
+        seat_deltas = self.seat_deltas
+        self.writes = []
+        self.seat_deltas = {}
+        if writes:
+            repository.transact(writes)
+        # the writes are committed, a Redis failure mustn't turn them into an error now. The promotions
+        # sweep finds a seat without an event, python -m enroll.open_classes check a view that drifted.
+        for class_id, delta in seat_deltas.items():
+            try:
+                if delta < 0:
+                    seat_events.publish(class_id)
+                open_classes.adjust(class_id, delta)
+            except redis.RedisError as e:
+                logger.error("Error publishing the seat change of class %s: %s", class_id, e)
+
+
+current_unit_of_work = contextvars.ContextVar("current_unit_of_work", default=None)
+
+
+def unit_of_work():
+    """The UnitOfWork of the request being handled"""
+    return current_unit_of_work.get() or UnitOfWork()
 
-def get_redis():
-    yield redis.Redis()
 
 settings = Settings()
-app = FastAPI()
+logging.config.fileConfig(settings.logging_config, disable_existing_loggers=False)
+logger = logging.getLogger(__name__)
+
+repository = open_repository(settings.database)
+if isinstance(repository, DynamoDBRepository):
+    metrics.instrument_dynamodb(repository.client)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    open_classes.ensure(repository)
+    class_cache.start_listener()
+    known_users.start()
+    promotion_worker = None
+    if repository.in_process:
+        # python -m enroll.promotions can't see this worker's data, so it promotes itself
+        promotion_worker = PromotionWorker(promoter, redis_client, f"{socket.gethostname()}-{os.getpid()}")
+        threading.Thread(target=promotion_worker.run, name="promotions", daemon=True).start()
+    yield
+    if promotion_worker is not None:
+        promotion_worker.stop()
+    known_users.stop()
+    class_cache.stop_listener()
+
+app = FastAPI(lifespan=lifespan)
+# endpoints run under the profiler when a request asks for it
+app.router.route_class = tracing.ProfiledRoute
+
+# /import runs for longer than an idempotency claim lasts
+NOT_IDEMPOTENT_PATHS = {"/import"}
+
+
+# registered first so it runs innermost, a replay is still measured and traced
+@app.middleware("http")
+async def replay_idempotent_requests(request: Request, call_next):
+    return await replay_or_run(idempotency, request, call_next, NOT_IDEMPOTENT_PATHS)
+
+
+@app.middleware("http")
+async def run_in_unit_of_work(request: Request, call_next):
+    work = UnitOfWork()
+    token = current_unit_of_work.set(work)
+    try:
+        response = await call_next(request)
+    finally:
+        current_unit_of_work.reset(token)
+    return response
 
 
-def check_user(id_val: int, username: str, email: str):
-    """check if user exists in Users table, if not, add user"""
-    response = users_table.query(KeyConditionExpression=Key('UserId').eq(id_val))
-    items = response.get('Items', [])
+app.middleware("http")(tracing.RequestTracer(settings.profile_dir, settings.profile_all_requests, settings.trace_log_threshold))
 
-    if items:
-        user_item = items[0]
-        return user_item
-    else:
-        user_item = {
-            "UserId": id_val,
-            "Username": username,
-            "Email": email
-        }
-        users_table.put_item(Item=user_item)
-        return user_item
 
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        metrics.observe_request(request, status_code, time.perf_counter() - start)
+    return response
+
+redis_pool = redis.BlockingConnectionPool(
+    host=settings.redis_host,
+    port=settings.redis_port,
+    db=settings.redis_db,
+    max_connections=settings.redis_max_connections,
+    timeout=settings.redis_pool_timeout,
+)
+# every request shares this client, it takes a connection from the pool per command
+redis_client = metrics.Redis(connection_pool=redis_pool)
+waitlist = Waitlist(redis_client)
+class_cache = ClassCache(redis_client, settings.class_cache_size, settings.class_cache_ttl)
+open_classes = OpenClasses(redis_client)
+seat_events = SeatEvents(redis_client)
+promoter = Promoter(repository, redis_client, settings.cart_lookup_workers)
+teardown = ClassTeardown(repository, redis_client, settings.teardown_workers)
+users_client = UsersClient(
+    settings.users_service_urls,
+    settings.users_service_timeout,
+    settings.user_profile_ttl,
+    settings.user_profile_cache_size,
+    settings.redis_max_connections,
+)
+idempotency = IdempotencyStore(redis_client, settings.idempotency_ttl, settings.idempotency_lock_ttl)
+known_users = KnownUsers(repository, redis_client, settings.known_users_size, settings.user_flush_interval)
+
+enrollment_ids = IdAllocator('EnrollmentID', settings.id_block_size)
+class_ids = IdAllocator('ClassID', settings.id_block_size)
 
-def check_class_exists(class_id: int):
-    response = classes_table.query(
-        KeyConditionExpression=Key('ClassID').eq(class_id)
-    )
 
-    class_items = response.get('Items', [])
+def check_user(id_val: int, username: str, email: str):
+    """Makes sure the user has a Users item, new users are written in the background"""
+    return known_users.check(id_val, username, email)
+
 
-    if not class_items:
+def get_instructor(instructor_id: int):
+    """Returns the instructor's profile from the users service, or raises 404 if there's no such user"""
+    try:
+        instructor_info = users_client.get_user(instructor_id)
+    except UsersServiceUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if instructor_info is None:
         raise HTTPException(
             status_code=404,
-            detail=f"Class with ClassID {class_id} not found"
+            detail="Instructor does not exist",
         )
-    return class_items[0]
+    check_user(instructor_info["userid"], instructor_info["username"], instructor_info["email"])
+    return instructor_info
+
+
+def load_class(class_id: int):
+    return repository.get_class(class_id)
+
+
+def check_class_exists(class_id: int, fresh: bool = False):
+    """Returns the class item, from the class cache unless fresh is set.
+    Use fresh when the caller decides something on CurrentEnrollment."""
+    work = unit_of_work()
+    # memoized as (item, fresh), a cached item is reloaded if fresh is asked for later
+    class_item, was_fresh = work.classes.get(class_id, (None, False))
+    if class_item is None or (fresh and not was_fresh):
+        class_item = load_class(class_id) if fresh else class_cache.get(class_id, load_class)
+        work.classes[class_id] = (class_item, fresh)
+    return check_class_found(class_item, class_id)
 
 
 
 def get_enrollment_status(student_id: int, class_id: int):
-    response = enrollments_table.query(
-        IndexName='StudentID-ClassID-index',
-        KeyConditionExpression=Key('StudentID').eq(student_id) & Key('ClassID').eq(class_id),
-        ProjectionExpression='EnrollmentState',
-        Limit=1
-    )
+    return enrollment_state(get_enrollment(student_id, class_id))
 
-    items = response.get('Items', [])
 
-    if items:
-        enrollment_item = items[0]
-        return enrollment_item.get('EnrollmentState')
-    else:
-        return None
+def get_enrollment(student_id: int, class_id: int):
+    """Returns the student's enrollment item for the class (id and state) or None,
+    queried once per request"""
+    enrollments = unit_of_work().enrollments
+    if (student_id, class_id) not in enrollments:
+        enrollments[(student_id, class_id)] = repository.get_enrollment(student_id, class_id)
+    return enrollments[(student_id, class_id)]
 
 
+def allocate_enrollment_write(student_id: int, class_id: int, enrollment, new_status: str):
+    """enrollment_write, with a new EnrollmentID if the student has no enrollment yet"""
+    new_enrollment_id = enrollment_ids.allocate() if enrollment is None else None
+    return enrollment_write(student_id, class_id, enrollment, new_status, new_enrollment_id)
 
-def update_enrollment_status(enrollment_id: int, new_status: str):
+
+def take_seat_and_enroll(student_id: int, class_id: int, enrollment):
+    """Increments CurrentEnrollment and writes the enrollment in a single transaction.
+
+    The increment is conditional on the class being active and below MaxCapacity, so
+    concurrent enrolls can't oversubscribe a class. Returns (enrollment item, None) on
+    success, or (None, class item) if the class is full.
+    """
+    enrollment_item, write = allocate_enrollment_write(student_id, class_id, enrollment, "ENROLLED")
     try:
-        response = enrollments_table.update_item(
-            Key={'EnrollmentID': enrollment_id},
-            UpdateExpression='SET EnrollmentState = :status',
-            ExpressionAttributeValues={':status': new_status},
-            ReturnValues='UPDATED_NEW'
-        )
-        updated_item = response.get('Attributes')
-        if updated_item:
-            return updated_item.get('EnrollmentState')
-        else:
-            return None
+        repository.transact(enroll_writes(class_id, write))
+        open_classes.adjust(class_id, 1)
+        unit_of_work().enrollments[(student_id, class_id)] = enrollment_item
+        return enrollment_item, None
+    except TransactionCancelled as e:
+        class_item = seat_refused(e, student_id, class_id)
+
+    # the seat condition failed, find out whether the class is missing, inactive or full
+    if not class_item:
+        class_item = check_class_exists(class_id)
+    check_active(class_item, class_id)
+    return None, class_item
+
 
-    except ClientError as e:
-        print(f"Error updating enrollment status for enrollmentID {enrollment_id}: {e.response['Error']['Message']}")
+def update_enrollment_status(enrollment_id: int, new_status: str):
+    try:
+        updated_state = repository.set_enrollment_state(enrollment_id, new_status)
+        if updated_state:
+            # keep the request's memoized copy in step
+            for enrollment in unit_of_work().enrollments.values():
+                if enrollment is not None and enrollment['EnrollmentID'] == enrollment_id:
+                    enrollment['EnrollmentState'] = new_status
+        return updated_state
+
+    except RepositoryError as e:
+        logger.error("Error updating enrollment status for enrollmentID %s: %s", enrollment_id, e)
         return None
 
     
 
 def update_current_enrollment(class_id: int, increment: bool = True):
-    # Determine whether to increment or decrement
-    update_expression = 'ADD CurrentEnrollment :delta' if increment else 'SET CurrentEnrollment = CurrentEnrollment - :delta'
-
-    # Set the value of :delta based on whether to increment or decrement
-    expression_attribute_values = {':delta': 1} if increment else {':delta': 1}
-
-    # Perform the update
-    response = classes_table.update_item(
-        Key={'ClassID': class_id},
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_attribute_values,
-        ReturnValues='UPDATED_NEW'
-    )
+    current_enrollment = repository.add_seats(class_id, 1 if increment else -1)
+    open_classes.adjust(class_id, 1 if increment else -1)
+    return current_enrollment
 
-    updated_item = response.get('Attributes')
 
-    if updated_item:
-        return updated_item.get('CurrentEnrollment')
-    else:
-        return None
+def check_instructor_for_class(instructor_id: int, class_id: int, username: str, email: str):
+    check_user(instructor_id, username, email)
+    check_instructor(instructor_id, class_id, class_cache.get(class_id, load_class))
 
 
-def is_instructor_for_class(instructor_id: int, class_id: int):
-        response = classes_table.get_item(Key={"ClassID": class_id})
-        # Check if the class exists and has the specified instructor
-        if "Item" in response:
-            class_info = response["Item"]
-            return class_info.get("InstructorID") == instructor_id
-        else:
-            return False    
-        
+def student_pages(class_id: int, enrollment_status: str, limit: int = None, start_key=None):
+    """Yields (students, key of the next page) for each page of the class's enrollments in a state"""
+    for items, start_key in repository.enrollment_pages(class_id, enrollment_status, limit, start_key):
+        yield student_rows(items), start_key
 
-def get_students_for_class(class_id: int, enrollment_status: str):
+
+def get_students_for_class(class_id: int, enrollment_status: str, limit: int = None, cursor: str = None):
+    """Returns up to limit students from cursor on and the cursor of the next page,
+    or every student and None when there's no limit"""
+    start_key = parse_cursor(cursor)
+    if limit is not None:
+        students, last_key = next(student_pages(class_id, enrollment_status, limit, start_key))
+        return students, encode_cursor(last_key)
     enrolled_students = []
-    response = enrollments_table.query(
-        IndexName='ClassID-EnrollmentState-index',
-        KeyConditionExpression=Key('ClassID').eq(class_id) & Key('EnrollmentState').eq(enrollment_status),
-        ProjectionExpression='StudentID, EnrollmentState'
-    )
-    for item in response.get("Items", []):
-        student_info = {
-            "StudentID": item.get("StudentID"),
-            "EnrollmentState": item.get("EnrollmentState"),
-        }
-        enrolled_students.append(student_info)
+    for students, _ in student_pages(class_id, enrollment_status, start_key=start_key):
+        enrolled_students.extend(students)
+    return enrolled_students, None
 
-    return enrolled_students    
 
-        
+def retrieve_enrollment_record_id(student_id: int, class_id: int):
+    enrollment = get_enrollment(student_id, class_id)
+    return enrollment.get('EnrollmentID') if enrollment else None
+
+
+def commit_or_conflict(work, student_id: int, class_id: int):
+    try:
+        work.commit()
+    except TransactionCancelled:
+        raise enrollment_changed(student_id, class_id)
+
+
+def add_to_waitlist(class_id: int, student_id: int, class_item=None):
+    if class_item is None:
+        class_item = check_class_exists(class_id)
+    # take the waitlist spot first, the script refuses duplicates and full waitlists atomically
+    check_waitlist_push(waitlist.push(class_id, student_id, class_item["WaitlistMaximum"]), student_id, class_id)
+    open_classes.adjust(class_id)
 
-def drop_students_from_class(class_id: int):
-    dropped_students = []
-    # Query for ENROLLED students
-    enrolled_response = enrollments_table.query(
-        IndexName='ClassID-EnrollmentState-index',
-        KeyConditionExpression=Key('ClassID').eq(class_id) & Key('EnrollmentState').eq('ENROLLED'),
-        ProjectionExpression='StudentID, EnrollmentID'
-    )
-    # Query for WAITLISTED students
-    waitlisted_response = enrollments_table.query(
-        IndexName='ClassID-EnrollmentState-index',
-        KeyConditionExpression=Key('ClassID').eq(class_id) & Key('EnrollmentState').eq('WAITLISTED'),
-        ProjectionExpression='StudentID , EnrollmentID'
-    )
     try:
-        print("Fourth checkpoint")
-        # Process ENROLLED students
-        for item in enrolled_response.get("Items", []):
-            student_id = item.get("StudentID")
-            enrollment_id = item.get("EnrollmentID")
-            updated_status = update_enrollment_status(enrollment_id, 'DROPPED')
-            if updated_status:
-                dropped_students.append(student_id)
-        print("Fifth checkpoint")
-        # Process WAITLISTED students
-        for item in waitlisted_response.get("Items", []):
-            student_id = item.get("StudentID")
-            enrollment_id = item.get("EnrollmentID")
-            updated_status = update_enrollment_status(enrollment_id, 'DROPPED')
-            if updated_status:
-                dropped_students.append(student_id)
-        if dropped_students != []:
-            return dropped_students
+        new_response = retrieve_enrollment_record_id(student_id, class_id)
+        if not new_response:
+            # create a new enrollment record
+            enrollment_item = {
+                "EnrollmentID": enrollment_ids.allocate(),
+                "StudentID": student_id,
+                "ClassID": class_id,
+                "EnrollmentState": "WAITLISTED"
+            }
+            repository.put_enrollment(enrollment_item)
+            unit_of_work().enrollments[(student_id, class_id)] = enrollment_item
+            updated_status = "WAITLISTED"
         else:
-            return None
-    except ClientError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to drop students from class {class_id}: {e.response['Error']['Message']}")
-    
-    
-def retrieve_enrollment_record_id(student_id: int, class_id: int):
-    response = enrollments_table.query(
-        IndexName='StudentID-ClassID-index',
-        KeyConditionExpression=Key('StudentID').eq(student_id) & Key('ClassID').eq(class_id),
-        ProjectionExpression='EnrollmentID',
-        Limit=1
-    )
-    # return response.get('Items')
-    enrollment_item = response.get('Items')[0] if 'Items' in response and len(response.get('Items')) != 0 else None
+            updated_status = update_enrollment_status(new_response, 'WAITLISTED')
+    except RepositoryError:
+        updated_status = None
+    if not updated_status:
+        # give the spot back so the waitlist matches the enrollment records
+        waitlist.remove(class_id, student_id)
+        open_classes.adjust(class_id)
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to update enrollment status"
+        )
+    return True
 
-    if enrollment_item:
-        return enrollment_item.get('EnrollmentID')
-    else:
-        return None
 
+@app.get("/metrics")
+def get_metrics():
+    """Request latencies and DynamoDB, Redis and users service calls of this worker, in the Prometheus text format."""
+    content, media_type = metrics.render()
+    return Response(content=content, media_type=media_type)
 
-def add_to_waitlist(class_id: int, student_id: int, r):
-    response_class = classes_table.query(
-        KeyConditionExpression=Key('ClassID').eq(class_id)
-    )
-    new_response = retrieve_enrollment_record_id(student_id, class_id)
-    if not new_response:
-        # create a new enrollment record
-        response = enrollments_table.scan(
-                ProjectionExpression='EnrollmentID',
-                Select='SPECIFIC_ATTRIBUTES',
-            )
-        items = response.get('Items', [])
 
-        # Find the highest enrollmentID
-        highest_enrollment_id = 0
-        for item in items:
-            enrollment_id = item.get('EnrollmentID', 0)
-            
-            if enrollment_id > highest_enrollment_id:
-                highest_enrollment_id = enrollment_id
+@app.get("/profiles/{name}")
+def get_profile(name: str):
+    """A profile saved for a request sent with an X-Profile header."""
+    path = tracing.profile_path(settings.profile_dir, name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path)
 
-        # Calculate the new ClassID
-        new_enrollment_id = highest_enrollment_id + 1
 
-        enrollment_item = {
-            "EnrollmentID": new_enrollment_id,
-            "StudentID": student_id,
-            "ClassID": class_id,
-            "EnrollmentState": "WAITLISTED"
-        }
-        enrollments_table.put_item(Item=enrollment_item)
-        
-    else:
-        updated_status = update_enrollment_status(new_response, 'WAITLISTED')
-        if not updated_status:
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to update enrollment status"
-            )
+@app.get("/cachestats")
+def cache_stats():
+    """Hit and miss counters of this worker's class cache."""
+    return class_cache.stats()
 
-    if r.llen(f"waitClassID_{class_id}") < response_class["Items"][0]["WaitlistMaximum"]:
-        r.rpush(f"waitClassID_{class_id}", student_id)
-        return True
-    else:
-        raise HTTPException(
-            status_code=409,
-            detail=f"Class and Waitlist with ClassID {class_id} are full"
-        )
-    
 
 ### Student related endpoints
 @app.get("/list")
-def list_open_classes(r = Depends(get_redis)):
+def list_open_classes(request: Request):
     """API to fetch list of available classes in catalog.
 
     Args:
         None
 
     Returns:
-        A dictionary with a list of classes available for enrollment.
+        A dictionary with a list of classes available for enrollment, with the
+        catalog version as its ETag. A request whose If-None-Match has the
+        current version gets a 304.
     """
-    response = classes_table.query(
-        IndexName='State-index',
-        KeyConditionExpression=Key('State').eq('active'),
-        ProjectionExpression='ClassID, CourseCode, SectionNumber, ClassName, Department, MaxCapacity, CurrentEnrollment, CurrentWaitlist, InstructorID, WaitlistMaximum'
-    )
-    items = response.get('Items', [])
-    classList = {"Classes": []}
-    for aClass in items:
-        if r.llen(f"waitClassID_{aClass['ClassID']}") < aClass["WaitlistMaximum"]:
-            classList["Classes"].append(aClass)
+    version = open_classes.version()
+    if etag_matches(request.headers.get("If-None-Match"), version):
+        return Response(status_code=304, headers=catalog_headers(version))
+    version, body = open_classes.list_json(version)
+    return Response(content=body, media_type="application/json", headers=catalog_headers(version))
 
-    return classList
+
+def catalog_headers(version: int):
+    return {"ETag": etag(version), "Cache-Control": f"public, max-age={settings.catalog_max_age}"}
 
 
 @app.post("/enroll/{studentid}/{classid}/{username}/{email}")
-def enroll_student_in_class(studentid: int, classid: int, username: str, email: str, r = Depends(get_redis)):
+def enroll_student_in_class(studentid: int, classid: int, username: str, email: str):
     """API to enroll a student in a class.
     
     Args:
@@ -294,7 +478,9 @@ def enroll_student_in_class(studentid: int, classid: int, username: str, email:
         A dictionary with a message indicating the student's enrollment status.
     """
     check_user(studentid, username, email)
-    class_item = check_class_exists(classid)
+    if settings.enroll_mode == "transactional":
+        return enroll_with_transaction(studentid, classid)
+    class_item = check_class_exists(classid, fresh=True)
     if class_item.get('State') != 'active':
         raise HTTPException(
             status_code=409,
@@ -331,37 +517,20 @@ def enroll_student_in_class(studentid: int, classid: int, username: str, email:
                     detail="Failed to update current enrollment"
                 )
         else:
-            if add_to_waitlist(classid, studentid, r):
+            if add_to_waitlist(classid, studentid):
                 return {
                     "message": "Student added to waitlist",
                 }
             
     elif status is None:
         if class_item.get('CurrentEnrollment') < class_item.get('MaxCapacity'):
-            response = enrollments_table.scan(
-                ProjectionExpression='EnrollmentID',
-                Select='SPECIFIC_ATTRIBUTES',
-            )
-            items = response.get('Items', [])
-
-            # Find the highest EnrollmentID
-            highest_enrollment_id = 0
-            for item in items:
-                enrollment_id = item.get('EnrollmentID', 0)
-            
-                if enrollment_id > highest_enrollment_id:
-                    highest_enrollment_id = enrollment_id
-
-            # Calculate the new ClassID
-            new_enrollment_id = highest_enrollment_id + 1
-
             enrollment_item = {
-                "EnrollmentID": new_enrollment_id,
+                "EnrollmentID": enrollment_ids.allocate(),
                 "StudentID": studentid,
                 "ClassID": classid,
                 "EnrollmentState": "ENROLLED"
             }
-            enrollments_table.put_item(Item=enrollment_item)
+            repository.put_enrollment(enrollment_item)
 
             # Increment the CurrentEnrollment for the class
             updated_current_enrollment = update_current_enrollment(classid, increment=True)
@@ -379,7 +548,7 @@ def enroll_student_in_class(studentid: int, classid: int, username: str, email:
                     detail="Failed to update current enrollment"
                 )
         else:
-            if add_to_waitlist(classid, studentid, r):
+            if add_to_waitlist(classid, studentid):
                 return {
                     "message": "Student added to waitlist",
                 }
@@ -391,8 +560,197 @@ def enroll_student_in_class(studentid: int, classid: int, username: str, email:
         )
 
 
+def enroll_with_transaction(studentid: int, classid: int):
+    """Enrolls with one enrollment query and one transaction, falling back to the waitlist when full"""
+    enrollment = get_enrollment(studentid, classid)
+    check_can_enroll(studentid, classid, enrollment_state(enrollment))
+
+    if waitlist.length(classid):
+        # a freed seat goes to the waitlist before anyone new, even before the promotion worker got to it
+        class_item = check_class_exists(classid)
+        check_active(class_item, classid)
+        add_to_waitlist(classid, studentid, class_item)
+        return {
+            "message": "Student added to waitlist",
+        }
+
+    enrollment_item, class_item = take_seat_and_enroll(studentid, classid, enrollment)
+    if enrollment_item is not None:
+        return {
+            "message": "Enrollment added successfully",
+            "enrollment_item": enrollment_item,
+        }
+    if add_to_waitlist(classid, studentid, class_item):
+        return {
+            "message": "Student added to waitlist",
+        }
+
+
+# two writes per class, a DynamoDB transaction takes at most 100
+MAX_CART_CLASSES = 25
+
+
+class Cart(BaseModel):
+    classes: list[int]
+
+
+def cart_result(status_code: int, **fields):
+    return {"status_code": status_code, **fields}
+
+
+def load_classes(class_ids):
+    """Fetches the class items in one batch, returns {class id: item}"""
+    classes = repository.get_classes(class_ids)
+    work = unit_of_work()
+    for class_id, class_item in classes.items():
+        work.classes[class_id] = (class_item, True)
+    return classes
+
+
+def get_enrollments(student_id: int, class_ids):
+    """Returns {class id: enrollment or None}, queried in parallel.
+    StudentID-ClassID-index is hashed on ClassID, so it takes one query per class."""
+    with ThreadPoolExecutor(max_workers=min(len(class_ids), settings.cart_lookup_workers)) as pool:
+        # each query runs in the request's context so it's memoized and counted
+        futures = {
+            class_id: pool.submit(contextvars.copy_context().run, get_enrollment, student_id, class_id)
+            for class_id in class_ids
+        }
+        return {class_id: future.result() for class_id, future in futures.items()}
+
+
+def take_seats_and_enroll(student_id: int, class_ids, classes, enrollments, results):
+    """Enrolls the student in every class with one transaction, retried without the classes
+    whose conditions failed. Returns {class id: class item} of the classes that were full."""
+    writes = {class_id: allocate_enrollment_write(student_id, class_id, enrollments[class_id], "ENROLLED") for class_id in class_ids}
+    full = {}
+    pending = list(class_ids)
+    conflicts = 0
+    while pending:
+        try:
+            repository.transact([write for class_id in pending for write in (TakeSeat(class_id), writes[class_id][1])])
+            break
+        except TransactionCancelled as e:
+            reasons = e.failed
+        failed = []
+        for index, class_id in enumerate(pending):
+            if 2 * index + 1 in reasons:
+                results[class_id] = cart_result(
+                    409, detail=f"Enrollment for StudentID {student_id} in class with ClassID {class_id} changed, try again"
+                )
+                failed.append(class_id)
+            elif 2 * index in reasons:
+                class_item = reasons[2 * index] or classes[class_id]
+                if class_item.get('State') != 'active':
+                    results[class_id] = cart_result(409, detail=f"Class with ClassID {class_id} is not active")
+                else:
+                    full[class_id] = class_item
+                failed.append(class_id)
+        if not failed:
+            # cancelled by concurrent writes to the same items rather than a condition
+            conflicts += 1
+            if conflicts > 3:
+                for class_id in pending:
+                    results[class_id] = cart_result(
+                        409, detail=f"Enrollment for StudentID {student_id} in class with ClassID {class_id} changed, try again"
+                    )
+                return full
+        pending = [class_id for class_id in pending if class_id not in failed]
+
+    work = unit_of_work()
+    for class_id in pending:
+        enrollment_item = writes[class_id][0]
+        work.enrollments[(student_id, class_id)] = enrollment_item
+        open_classes.adjust(class_id, 1)
+        results[class_id] = cart_result(200, message="Enrollment added successfully", enrollment_item=enrollment_item)
+    return full
+
+
+def join_waitlists(student_id: int, full, enrollments, results):
+    """Puts the student on the waitlist of every full class, writing the enrollments in one transaction"""
+    joined = []
+    for class_id, class_item in full.items():
+        position = waitlist.push(class_id, student_id, class_item["WaitlistMaximum"])
+        if position == ALREADY_WAITLISTED:
+            results[class_id] = cart_result(
+                409, detail=f"Student with StudentID {student_id} is already on the waitlist for class with ClassID {class_id}"
+            )
+        elif position == WAITLIST_FULL:
+            results[class_id] = cart_result(409, detail=f"Class and Waitlist with ClassID {class_id} are full")
+        else:
+            joined.append((class_id, *allocate_enrollment_write(student_id, class_id, enrollments[class_id], "WAITLISTED")))
+
+    try:
+        if joined:
+            repository.transact([write for _, _, write in joined])
+        work = unit_of_work()
+        for class_id, enrollment_item, _ in joined:
+            work.enrollments[(student_id, class_id)] = enrollment_item
+            results[class_id] = cart_result(200, message="Student added to waitlist")
+    except RepositoryError:
+        # give the spots back so the waitlists match the enrollment records
+        for class_id, _, _ in joined:
+            waitlist.remove(class_id, student_id)
+            results[class_id] = cart_result(500, detail="Failed to update enrollment status")
+    for class_id in full:
+        open_classes.adjust(class_id)
+
+
+@app.post("/enrollcart/{studentid}/{username}/{email}")
+def enroll_student_in_classes(studentid: int, username: str, email: str, cart: Cart):
+    """API to enroll a student in several classes at once.
+
+    Args:
+        studentid: The student's ID.
+        cart: The class IDs, at most 25.
+
+    Returns:
+        A dictionary with the outcome for each class, with the status code and
+        message or detail a single enroll would have returned.
+    """
+    check_user(studentid, username, email)
+    class_ids = list(dict.fromkeys(cart.classes))
+    if not class_ids or len(class_ids) > MAX_CART_CLASSES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A cart holds between 1 and {MAX_CART_CLASSES} classes"
+        )
+    classes = load_classes(class_ids)
+    enrollments = get_enrollments(studentid, class_ids)
+
+    results = {}
+    to_enroll = []
+    for class_id in class_ids:
+        class_item = classes.get(class_id)
+        status = enrollments[class_id].get('EnrollmentState') if enrollments[class_id] else None
+        if class_item is None:
+            results[class_id] = cart_result(404, detail=f"Class with ClassID {class_id} not found")
+        elif class_item.get('State') != 'active':
+            results[class_id] = cart_result(409, detail=f"Class with ClassID {class_id} is not active")
+        elif status == 'ENROLLED':
+            results[class_id] = cart_result(
+                409, detail=f"Student with StudentID {studentid} is already enrolled in class with ClassID {class_id}"
+            )
+        elif status == 'WAITLISTED':
+            results[class_id] = cart_result(
+                409, detail=f"Student with StudentID {studentid} is already on the waitlist for class with ClassID {class_id}"
+            )
+        else:
+            to_enroll.append(class_id)
+
+    if to_enroll:
+        # classes with a waitlist are joined straight away, as in a single enroll
+        waiting = waitlist.lengths(to_enroll)
+        to_enroll = [class_id for class_id in to_enroll if not waiting[class_id]]
+        full = {class_id: classes[class_id] for class_id, length in waiting.items() if length}
+        if to_enroll:
+            full.update(take_seats_and_enroll(studentid, to_enroll, classes, enrollments, results))
+        join_waitlists(studentid, full, enrollments, results)
+    return {"Results": [{"ClassID": class_id, **results[class_id]} for class_id in class_ids]}
+
+
 @app.delete("/enrollmentdrop/{studentid}/{classid}/{username}/{email}")
-def drop_student_from_class(studentid: int, classid: int, username: str, email: str, r = Depends(get_redis)):
+def drop_student_from_class(studentid: int, classid: int, username: str, email: str):
     """API to drop a class.
     
     Args:
@@ -403,60 +761,20 @@ def drop_student_from_class(studentid: int, classid: int, username: str, email:
         A dictionary with a message indicating the student's enrollment status.
     """
     check_user(studentid, username, email)
-    new_updated_status = None
-    updated_status = None
-    updated_current_enrollment = None
-    # Try to Remove student from the class
-    status = get_enrollment_status(studentid, classid)
-    if status == 'DROPPED':
-        raise HTTPException(
-            status_code=409,
-            detail=f"Student with StudentID {studentid} is already dropped from class with ClassID {classid}"
-        )
-    if status is None:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Student with StudentID {studentid} is not enrolled in class with ClassID {classid}"
-        )
-    elif status == 'WAITLISTED':
-        raise HTTPException(
-            status_code=404,
-            detail=f"Student with StudentID {studentid} is on the waitlist for class {classid}. Drop from the waitlist instead."
-        )
-    elif status == 'ENROLLED':
-        new_status = 'DROPPED'
-        response = retrieve_enrollment_record_id(studentid, classid)
-        updated_status = update_enrollment_status(response, new_status)
-        # Decrement the CurrentEnrollment for the class
-        updated_current_enrollment = update_current_enrollment(classid, increment=False)
-        if updated_current_enrollment:
-            next_on_waitlist = r.lpop(f"waitClassID_{classid}")
-            if next_on_waitlist is not None:
-                # Convert the retrieved string to an integer
-                next_on_waitlist = int(next_on_waitlist)
-                new_status = 'ENROLLED'
-                new_response = retrieve_enrollment_record_id(next_on_waitlist, classid)
-                new_updated_status = update_enrollment_status(new_response, new_status)
-                updated_current_enrollment = update_current_enrollment(classid, increment=True)
-            
-            return {
-                "message": "Class dropped updated successfully",
-                "updated_status": updated_status,
-                "new_student": new_updated_status,
-                "updated_current_enrollment": updated_current_enrollment
-            }
-        else:
-            return {"message": "Class dropped updated successfully",
-                "updated_status": updated_status,
-                "updated_current_enrollment": updated_current_enrollment}
-    else:
-        raise HTTPException(
-            status_code=500,
-            detail="Failed to update enrollment status"
-        )
+    enrollment = get_enrollment(studentid, classid)
+    check_can_drop(studentid, classid, enrollment_state(enrollment))
+    # the next student on the waitlist is enrolled in the background, see enroll/promotions.py
+    work = unit_of_work()
+    work.stage_enrollment_state(enrollment, 'DROPPED')
+    work.stage_seats(classid, -1)
+    commit_or_conflict(work, studentid, classid)
+    return {
+        "message": "Class dropped updated successfully",
+        "updated_status": 'DROPPED',
+    }
 
 @app.delete("/waitlistdrop/{studentid}/{classid}/{username}/{email}")
-def remove_student_from_waitlist(studentid: int, classid: int, username: str, email: str, r = Depends(get_redis)):
+def remove_student_from_waitlist(studentid: int, classid: int, username: str, email: str):
     """API to drop a class from waitlist.
     
     Args:
@@ -469,31 +787,14 @@ def remove_student_from_waitlist(studentid: int, classid: int, username: str, em
     check_user(studentid, username, email)
     # exists = db.execute("SELECT * FROM Waitlists WHERE StudentID = ? AND ClassID = ?", (studentid, classid)).fetchone()
     status = get_enrollment_status(studentid, classid)
-    if status == 'DROPPED':
-        raise HTTPException(
-            status_code=409,
-            detail=f"Student with StudentID {studentid} is already dropped from class with ClassID {classid}"
-        )
-    if status is None:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Student with StudentID {studentid} is not enrolled in class with ClassID {classid}"
-        )
-    elif status == 'ENROLLED':
-        raise HTTPException(
-            status_code=409,
-            detail=f"Student with StudentID {studentid} is enrolled in class with ClassID {classid}"
-        )
+    check_can_leave_waitlist(studentid, classid, status)
     if status == 'WAITLISTED':
-        new_status = 'DROPPED'
-        updated_status = update_enrollment_status(retrieve_enrollment_record_id(studentid, classid), new_status)
-        if not updated_status:
-            raise HTTPException(
-                status_code=500,
-                detail="Student was not on the waitlist"
-            )
-        
-        exists = r.lrem(f"waitClassID_{classid}", 0, studentid)
+        work = unit_of_work()
+        work.stage_enrollment_state(get_enrollment(studentid, classid), 'DROPPED')
+        commit_or_conflict(work, studentid, classid)
+
+        exists = waitlist.remove(classid, studentid)
+        open_classes.adjust(classid)
         if exists == 0:
             raise HTTPException(
                 status_code=400,
@@ -503,7 +804,7 @@ def remove_student_from_waitlist(studentid: int, classid: int, username: str, em
     return {"Element removed": studentid}
 
 @app.get("/waitlist/{studentid}/{classid}/{username}/{email}")
-def view_waitlist_position(studentid: int, classid: int, username: str, email: str, r = Depends(get_redis)):
+def view_waitlist_position(studentid: int, classid: int, username: str, email: str):
     """API to view a student's position on the waitlist.
 
     Args:
@@ -514,9 +815,9 @@ def view_waitlist_position(studentid: int, classid: int, username: str, email: s
         A dictionary with a message indicating the student's position on the waitlist.
     """
     check_user(studentid, username, email)
-    position = r.lpos(f"waitClassID_{classid}", studentid)
-    
-    if position:
+    position = waitlist.position(classid, studentid)
+
+    if position is not None:
         message = f"Student {studentid} is on the waitlist for class {classid} in position"
     else:
         message = f"Student {studentid} is not on the waitlist for class {classid}"
@@ -528,52 +829,46 @@ def view_waitlist_position(studentid: int, classid: int, username: str, email: s
     
 ### Instructor related endpoints
 @app.get("/enrolled/{instructorid}/{classid}/{username}/{email}")
-def view_enrolled(instructorid: int, classid: int, username: str, email: str):
+def view_enrolled(instructorid: int, classid: int, username: str, email: str, limit: int = Query(None, ge=1, le=1000), cursor: str = None):
     """API to view all students enrolled in a class.
     
     Args:
         instructorid: The instructor's ID.
         classid: The class ID.
+        limit: Optional page size, every student is returned without it.
+        cursor: next_cursor of the previous page.
 
     Returns:
         A dictionary with a list of students enrolled in the instructor's classes.
     """
-    check_user(instructorid, username, email)
-    if not is_instructor_for_class(instructorid, classid):
-        raise HTTPException(
-            status_code=403,
-            detail=f"Instructor with InstructorID {instructorid} is not an instructor for class with ClassID {classid}"
-        )
-    enrolled_students = get_students_for_class(classid, 'ENROLLED')
-    if not enrolled_students:
+    check_instructor_for_class(instructorid, classid, username, email)
+    enrolled_students, next_cursor = get_students_for_class(classid, 'ENROLLED', limit, cursor)
+    if not enrolled_students and cursor is None:
         raise HTTPException(status_code=404, detail="No enrolled students found for this class.")
-    return {"Enrolled Students": enrolled_students}
+    return {"Enrolled Students": enrolled_students, "next_cursor": next_cursor}
 
 
 @app.get("/dropped/{instructorid}/{classid}/{username}/{email}")
-def view_dropped_students(instructorid: int, classid: int, username: str, email: str):
+def view_dropped_students(instructorid: int, classid: int, username: str, email: str, limit: int = Query(None, ge=1, le=1000), cursor: str = None):
     """API to view all students dropped from a class.
     
     Args:
         instructorid: The instructor's ID.
+        limit: Optional page size, every student is returned without it.
+        cursor: next_cursor of the previous page.
 
     Returns:
         A dictionary with a list of students dropped from the instructor's classes.
     """
-    check_user(instructorid, username, email)
-    if not is_instructor_for_class(instructorid, classid):
-        raise HTTPException(
-            status_code=403,
-            detail=f"Instructor with InstructorID {instructorid} is not an instructor for class with ClassID {classid}"
-        )
+    check_instructor_for_class(instructorid, classid, username, email)
     
-    dropped_students = get_students_for_class(classid, 'DROPPED')
-    if not dropped_students:
+    dropped_students, next_cursor = get_students_for_class(classid, 'DROPPED', limit, cursor)
+    if not dropped_students and cursor is None:
         raise HTTPException(status_code=404, detail="No dropped students found for this class.")
-    return {"Dropped Students": dropped_students}
+    return {"Dropped Students": dropped_students, "next_cursor": next_cursor}
 
 @app.delete("/drop/{instructorid}/{classid}/{studentid}/{username}/{email}")
-def drop_student_administratively(instructorid: int, classid: int, studentid: int, username: str, email: str, r = Depends(get_redis)):
+def drop_student_administratively(instructorid: int, classid: int, studentid: int, username: str, email: str):
     """API to drop a student from a class.
     
     Args:
@@ -584,76 +879,79 @@ def drop_student_administratively(instructorid: int, classid: int, studentid: in
     Returns:
         A dictionary with a message indicating the student's enrollment status.
     """
-    check_user(instructorid, username, email)
-    if not is_instructor_for_class(instructorid, classid):
-        raise HTTPException(
-            status_code=403,
-            detail=f"Instructor with InstructorID {instructorid} is not an instructor for class with ClassID {classid}"
-        )
-    status = get_enrollment_status(studentid, classid)
-    if status == 'DROPPED':
-        raise HTTPException(
-            status_code=409,
-            detail=f"Student with StudentID {studentid} is already dropped from class with ClassID {classid}"
-        )
-    # retrieve record id from dynamo
-    response = retrieve_enrollment_record_id(studentid, classid)
-    updated_status = update_enrollment_status(response, 'DROPPED')
-    if not updated_status:
-        raise HTTPException(
-            status_code=500,
-            detail="Failed to update enrollment status"
-        )
-    # Decrement the CurrentEnrollment for the class
-    updated_current_enrollment = update_current_enrollment(classid, increment=False)
-    if updated_current_enrollment is None:
-        raise HTTPException(
-            status_code=500,
-            detail="Failed to update current enrollment"
-        )
-    # Retrieve the next student ID from the waitlist
-    next_on_waitlist_str = r.lpop(f"waitClassID_{classid}")
-
-    if next_on_waitlist_str is not None:
-        # Convert the retrieved string to an integer
-        next_on_waitlist = int(next_on_waitlist_str)
-
-        # The rest of your code for processing the waitlisted student
-        new_status = 'ENROLLED'
-        new_response = retrieve_enrollment_record_id(next_on_waitlist, classid)
-        new_updated_status = update_enrollment_status(new_response, new_status)
-        updated_current_enrollment = update_current_enrollment(classid, increment=True)
+    check_instructor_for_class(instructorid, classid, username, email)
+    enrollment = get_enrollment(studentid, classid)
+    status = enrollment_state(enrollment)
+    check_can_drop_administratively(studentid, classid, enrollment)
+    work = unit_of_work()
+    work.stage_enrollment_state(enrollment, 'DROPPED')
+    if status == 'ENROLLED':
+        work.stage_seats(classid, -1)
+    commit_or_conflict(work, studentid, classid)
+    if status == 'WAITLISTED':
+        waitlist.remove(classid, studentid)
+        open_classes.adjust(classid)
     return {"message": f"Student {studentid} has been administratively dropped from class {classid} by instructor {instructorid}"}
 
 
 @app.get("/instructorwaitlist/{instructorid}/{classid}/{username}/{email}")
-def view_waitlist(instructorid: int, classid: int, username: str, email: str, r = Depends(get_redis)):
+def view_waitlist(instructorid: int, classid: int, username: str, email: str, limit: int = Query(None, ge=1, le=1000), cursor: str = None):
     """API to view the waitlist for a class.
     
     Args:
         instructorid: The instructor's ID.
+        limit: Optional page size, the whole waitlist is returned without it.
+        cursor: next_cursor of the previous page. Pages are by position, students
+            leaving the waitlist between pages shift the ones behind them.
 
     Returns:
         A dictionary with a list of students on the waitlist for the instructor's classes.
     """
-    check_user(instructorid, username, email)
-    if not is_instructor_for_class(instructorid, classid):
-        raise HTTPException(
-            status_code=403,
-            detail=f"Instructor with InstructorID {instructorid} is not an instructor for class with ClassID {classid}"
-        )
-    waitlisted_students = get_students_for_class(classid, 'WAITLISTED')
-    if not waitlisted_students:
-        raise HTTPException(status_code=404, detail="No waitlisted students found for this class.")    
-
-    student_ids = r.lrange(f"waitClassID_{classid}", 0, -1)
-    if not len(student_ids):
+    check_instructor_for_class(instructorid, classid, username, email)
+    position = parse_cursor(cursor)
+    offset = position.get("offset", 0) if position else 0
+    if cursor is None:
+        waitlisted_students, _ = get_students_for_class(classid, 'WAITLISTED', limit=1)
+        if not waitlisted_students:
+            raise HTTPException(status_code=404, detail="No waitlisted students found for this class.")
+
+    # one extra student tells whether there's another page
+    student_ids, next_cursor = waitlist_page(waitlist.students(classid, offset, None if limit is None else limit + 1), offset, limit)
+    if not len(student_ids) and cursor is None:
         raise HTTPException(status_code=404, detail="No students found in the waitlist for this class")
-    return {"Waitlist": [{"student_id": int(student)} for student in student_ids]}
+    return {"Waitlist": [{"student_id": student} for student in student_ids], "next_cursor": next_cursor}
+
+@app.get("/roster/{instructorid}/{classid}/{username}/{email}")
+def export_roster(instructorid: int, classid: int, username: str, email: str, status: str = 'ENROLLED', format: str = 'csv'):
+    """API to download the students of a class in one state.
+
+    Args:
+        instructorid: The instructor's ID.
+        classid: The class ID.
+        status: ENROLLED, WAITLISTED or DROPPED.
+        format: csv or ndjson.
+
+    Returns:
+        The roster, streamed a page at a time.
+    """
+    check_instructor_for_class(instructorid, classid, username, email)
+    check_roster_request(status, format)
+
+    def rows():
+        header = True
+        for students, _ in student_pages(classid, status):
+            yield format_rows(students, format, header)
+            header = False
+
+    return StreamingResponse(
+        rows(),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f"attachment; filename=class_{classid}_{status.lower()}.{format}"}
+    )
 
 ### Registrar related endpoints
 @app.post("/add/{sectionid}/{coursecode}/{classname}/{department}/{professorid}/{enrollmax}/{status}/{waitmax}")
-def add_class(request: Request, sectionid: int, coursecode: str, classname: str, department:str, professorid: int, enrollmax: int, status: str, waitmax: int):
+def add_class(sectionid: int, coursecode: str, classname: str, department:str, professorid: int, enrollmax: int, status: str, waitmax: int):
     """API to add a class to the catalog.
     
     Args:
@@ -669,44 +967,16 @@ def add_class(request: Request, sectionid: int, coursecode: str, classname: str,
     Returns:
         A dictionary with a message indicating the class was added successfully.
     """
-    instructor_req = requests.get(f"http://localhost:{KRAKEND_PORT}/user/get/{professorid}", headers={"Authorization": request.headers.get("Authorization")})
-    instructor_info = instructor_req.json()
-
-    if instructor_req.status_code != 200:
-        raise HTTPException(
-            status_code=404,
-            detail="Instructor does not exist",
-        )
-    check_user(instructor_info["userid"], instructor_info["username"], instructor_info["email"])
+    get_instructor(professorid)
     # check if combination of coursecode and sectionid already exists
-    existing_class = classes_table.query(
-        IndexName='SectionNumber-CourseCode-index',
-        KeyConditionExpression=Key('SectionNumber').eq(sectionid) & Key('CourseCode').eq(coursecode),
-        ProjectionExpression='ClassID',
-    )
     # If there's an existing class, return an error
-    if existing_class.get('Items'):
+    if repository.section_exists(sectionid, coursecode):
         raise HTTPException(
             status_code=400,
             detail="Class with the given SectionNumber and CourseCode already exists",
         )
 
-    # Query to find the highest existing ClassID
-    response = classes_table.scan(
-        ProjectionExpression='ClassID',
-        Select='SPECIFIC_ATTRIBUTES',
-    )
-    items = response.get('Items', [])
-
-    # Find the highest ClassID
-    highest_class_id = 0
-    for item in items:
-        class_id = item.get('ClassID', 0)
-        if class_id > highest_class_id:
-            highest_class_id = class_id
-
-    # Calculate the new ClassID
-    new_class_id = highest_class_id + 1
+    new_class_id = class_ids.allocate()
 
     # Create the new class item
     new_class_item = {
@@ -725,16 +995,109 @@ def add_class(request: Request, sectionid: int, coursecode: str, classname: str,
     # Insert the new class item into the classes table
     try:
 
-        classes_table.put_item(Item=new_class_item)
+        repository.put_class(new_class_item)
+        open_classes.put(new_class_item)
         return {"message": f"Class with ClassID {new_class_id} added successfully", "class_details": new_class_item}
-    except ClientError as e:
-        print(f"Error adding class with ClassID {new_class_id}: {e.response['Error']['Message']}")
+    except RepositoryError as e:
+        logger.error("Error adding class with ClassID %s: %s", new_class_id, e)
         raise HTTPException(
             status_code=500,
             detail="Failed to add class"
         )
 
 
+# rows validated and written together by /import
+IMPORT_CHUNK_ROWS = 500
+
+
+def existing_sections():
+    """(SectionNumber, CourseCode) of every class"""
+    return repository.class_sections()
+
+
+def find_instructors(instructor_ids):
+    """Returns the ids that belong to a user, looked up in the users service in batches"""
+    instructors = users_client.get_users(instructor_ids)
+    for instructor_info in instructors.values():
+        check_user(instructor_info["userid"], instructor_info["username"], instructor_info["email"])
+    return set(instructors)
+
+
+def import_chunk(rows, instructors, sections, errors):
+    """Validates a chunk of (row number, fields) and writes its classes, returns how many were written.
+    instructors ({id: exists}) and sections carry over between the chunks of one import."""
+    parsed = []
+    for number, fields in rows:
+        try:
+            parsed.append((number, parse_row(fields)))
+        except ValueError as e:
+            errors.append({"row": number, "error": str(e)})
+
+    unknown = {class_item["InstructorID"] for _, class_item in parsed} - instructors.keys()
+    if unknown:
+        found = find_instructors(unknown)
+        instructors.update({instructor_id: instructor_id in found for instructor_id in unknown})
+
+    new_classes = []
+    for number, class_item in parsed:
+        section = (class_item["SectionNumber"], class_item["CourseCode"])
+        if not instructors[class_item["InstructorID"]]:
+            errors.append({"row": number, "error": "Instructor does not exist"})
+        elif section in sections:
+            errors.append({"row": number, "error": "Class with the given SectionNumber and CourseCode already exists"})
+        else:
+            sections.add(section)
+            new_classes.append(class_item)
+    if not new_classes:
+        return 0
+
+    # one counter update for the whole chunk
+    first_id, _ = class_ids.lease_block(len(new_classes))
+    for offset, class_item in enumerate(new_classes):
+        class_item["ClassID"] = first_id + offset
+
+    batches = [new_classes[start:start + 25] for start in range(0, len(new_classes), 25)]
+    with ThreadPoolExecutor(max_workers=settings.import_workers) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, repository.put_classes, batch_items) for batch_items in batches]
+        for future in futures:
+            future.result()
+    open_classes.put_many(new_classes)
+    return len(new_classes)
+
+
+@app.post("/import")
+async def import_classes(request: Request, format: str = 'csv'):
+    """API to add many classes to the catalog.
+
+    Args:
+        format: csv (with a header line) or ndjson. The body has one class per
+            line with the fields of /add: sectionid, coursecode, classname,
+            department, professorid, enrollmax, status, waitmax.
+
+    Returns:
+        The number of classes imported and the errors of the rows that weren't.
+    """
+    if format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid format {format}")
+    sections = await run_in_threadpool(existing_sections)
+    instructors = {}
+    errors = []
+    imported = 0
+    chunk = []
+    try:
+        async for row in read_rows(request.stream(), format):
+            chunk.append(row)
+            if len(chunk) >= IMPORT_CHUNK_ROWS:
+                imported += await run_in_threadpool(import_chunk, chunk, instructors, sections, errors)
+                chunk = []
+        if chunk:
+            imported += await run_in_threadpool(import_chunk, chunk, instructors, sections, errors)
+    except UsersServiceUnavailable as e:
+        raise HTTPException(status_code=503, detail=f"{e}, {imported} classes were imported before it")
+    errors.sort(key=lambda error: error["row"])
+    return {"message": f"Imported {imported} classes", "imported": imported, "errors": errors}
+
+
 @app.delete("/remove/{classid}")
 def remove_class(classid: int):
     """API to remove a class from the catalog.
@@ -746,23 +1109,42 @@ def remove_class(classid: int):
         
 
     """
-    class_item = check_class_exists(classid)
-    dropped_students = []
+    check_class_exists(classid, fresh=True)
+    # stop enrolls and waitlist joins before reading the class's enrollments
+    repository.update_class(classid, State='inactive')
+    class_cache.invalidate(classid)
+    open_classes.remove(classid)
+    try:
+        dropped_students = teardown.run(classid)
+    except RepositoryError as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to drop students from class {classid}: {e}"
+        )
+    repository.delete_class(classid)
+    class_cache.invalidate(classid)
+    open_classes.remove(classid)
+    return {"message": f"Class with ClassID {classid} deleted successfully", "dropped_students": dropped_students}
+
 
-    if class_item.get('CurrentEnrollment') > 0:
-        # drop all the students in the class before deleting class
-        dropped_students = drop_students_from_class(classid)
-        if not dropped_students:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to drop students from class {classid}"
-            )
-    response = classes_table.delete_item(Key={'ClassID': classid})
-    if response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 200:
-        return {"message": f"Class with ClassID {classid} deleted successfully", "dropped_students": dropped_students}
-    else:
-        return {"message": f"Failed to delete class with ClassID {classid}"}
 
+@app.get("/remove/{classid}")
+def remove_class_progress(classid: int):
+    """API to follow the removal of a class.
+
+    Args:
+        classid: The class ID.
+
+    Returns:
+        The state of the teardown and how many students were found and dropped so far.
+    """
+    progress = teardown.get_progress(classid)
+    if progress is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Class with ClassID {classid} isn't being removed"
+        )
+    return progress
 
 
 @app.put("/state/{classid}/{state}")
@@ -776,28 +1158,65 @@ def state_enrollment(classid: int, state: str):
     Returns:
         A dictionary with a message indicating the class was successfully updated.
     """
-    record = check_class_exists(classid)
+    record = check_class_exists(classid, fresh=True)
     
     if state not in ['active', 'inactive']:
         return {"message": "Invalid state provided"}
     if record.get('State') == state:
         return {"message": f"Class is already in the {state} state"}
-    response = classes_table.update_item(
-        Key={'ClassID': classid},
-        UpdateExpression='SET #state_attribute = :state',
-        ExpressionAttributeValues={':state': state},
-        ExpressionAttributeNames={'#state_attribute': 'State'},
-        ReturnValues='UPDATED_NEW'
-    )
-    updated_item = response.get('Attributes')
+    updated_item = repository.update_class(classid, State=state)
+    class_cache.invalidate(classid)
     if updated_item:
+        open_classes.put(updated_item)
         return {"message": f"Class updated to {state} successfully"}
     else:
         return {"message": f"Failed to update class to {state}"}
 
 
+@app.put("/capacity/{classid}/{enrollmax}")
+def change_capacity(classid: int, enrollmax: int):
+    """API to change how many students can enroll in a class.
+
+    Seats added by a raise are filled from the waitlist right away, in batches of
+    up to 99 students that are enrolled with one transaction each.
+
+    Args:
+        classid: The class ID.
+        enrollmax: The new maximum capacity, at least the number of students enrolled.
+
+    Returns:
+        A dictionary with the new capacity and enrollment and the students enrolled from the waitlist.
+    """
+    check_class_exists(classid, fresh=True)
+    try:
+        updated_item = repository.set_capacity(classid, enrollmax)
+    except ConditionFailed:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Class with ClassID {classid} has more than {enrollmax} students enrolled"
+        )
+    class_cache.invalidate(classid)
+    open_classes.put(updated_item)
+
+    message = f"Capacity updated to {enrollmax} successfully"
+    try:
+        promoted = promoter.promote(classid)
+    except (RepositoryError, PromotionConflict) as e:
+        logger.warning("Error promoting from the waitlist of class %s: %s", classid, e)
+        promoted = []
+        # the promotion worker fills the seats that are left
+        seat_events.publish(classid)
+        message += ", students on the waitlist will be enrolled shortly"
+    return {
+        "message": message,
+        "MaxCapacity": enrollmax,
+        "CurrentEnrollment": int(updated_item['CurrentEnrollment']) + len(promoted),
+        "promoted": promoted,
+    }
+
+
 @app.put("/change/{classid}/{newprofessorid}")
-def change_prof(request: Request, classid: int, newprofessorid: int):
+def change_prof(classid: int, newprofessorid: int):
     """API to change the professor for a class.
     
     Args:
@@ -807,29 +1226,17 @@ def change_prof(request: Request, classid: int, newprofessorid: int):
     Returns:
         A dictionary with a message indicating the professor was successfully updated.
     """
-    instructor_req = requests.get(f"http://localhost:{KRAKEND_PORT}/user/get/{newprofessorid}", headers={"Authorization": request.headers.get("Authorization")})
-    instructor_info = instructor_req.json()
-
-    if instructor_req.status_code != 200:
-        raise HTTPException(
-            status_code=404,
-            detail="Instructor does not exist",
-        )
-    check_user(instructor_info["userid"], instructor_info["username"], instructor_info["email"])
-    class_item = check_class_exists(classid)
+    get_instructor(newprofessorid)
+    class_item = check_class_exists(classid, fresh=True)
     if class_item.get('InstructorID') == newprofessorid:
         raise HTTPException(
             status_code=409,
             detail="Instructor already teaches this class",
         )
-    response = classes_table.update_item(
-        Key={'ClassID': classid},
-        UpdateExpression='SET InstructorID = :instructor_id',
-        ExpressionAttributeValues={':instructor_id': newprofessorid},
-        ReturnValues='UPDATED_NEW'
-    )
-    updated_item = response.get('Attributes')
+    updated_item = repository.update_class(classid, InstructorID=newprofessorid)
+    class_cache.invalidate(classid)
     if updated_item:
+        open_classes.put(updated_item)
         return {"message": f"Instructor updated to user with UserID '{newprofessorid}' successfully"}
     else:
         return {"message": f"Failed to update instructor to {newprofessorid}"}
\ No newline at end of file
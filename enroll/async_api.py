@@ -0,0 +1,465 @@
+import asyncio
+import contextlib
+import logging
+import logging.config
+import os
+import socket
+import threading
+import time
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.responses import StreamingResponse, Response, FileResponse
+from pydantic_settings import BaseSettings
+
+from enroll.waitlist import AsyncWaitlist
+from enroll.cache import ClassCache
+from enroll.known_users import KnownUsers, KNOWN_USERS_KEY
+from enroll.open_classes import OpenClasses, AsyncOpenClasses, etag, etag_matches
+from enroll.pagination import encode_cursor, format_rows, MEDIA_TYPES
+from enroll.promotions import AsyncSeatEvents, Promoter, PromotionWorker
+from enroll.idempotency import IdempotencyStore, replay_or_run
+from enroll.repository import open_repository, open_async_repository, RepositoryError, TransactionCancelled
+from enroll.dynamodb_repository import DynamoDBRepository, AsyncDynamoDBRepository
+from enroll.enrollments import (
+    enrollment_state, enrollment_changed, check_class_found, check_active, check_can_enroll, check_can_drop,
+    check_can_leave_waitlist, check_can_drop_administratively, check_instructor, check_waitlist_push,
+    check_roster_request, parse_cursor, enrollment_item, enrollment_write, enroll_writes, seat_refused, drop_writes,
+    student_rows, waitlist_page,
+)
+from enroll import metrics, tracing
+
+# Async version of the student and instructor endpoints in enroll/api.py.
+# Every database and Redis call is awaited instead of blocking a threadpool
+# thread, so one worker can keep hundreds of requests in flight. The checks and
+# writes of every endpoint come from enroll/enrollments.py and go through an
+# AsyncRepository on the same database as the sync workers (see enroll/repository.py).
+
+class Settings(BaseSettings, env_file="enroll/.env", extra="ignore"):
+    database: str
+    logging_config: str
+    id_block_size: int = 20
+    redis_host: str = "localhost"
+    redis_port: int = 6379
+    redis_db: int = 0
+    redis_max_connections: int = 50
+    redis_pool_timeout: int = 5
+    class_cache_size: int = 1024
+    class_cache_ttl: float = 30
+    known_users_size: int = 100000
+    user_flush_interval: float = 1
+    idempotency_ttl: int = 86400
+    idempotency_lock_ttl: int = 60
+    catalog_max_age: int = 5
+    trace_log_threshold: float = 1
+    profile_dir: str = "./enroll/var/profiles"
+    profile_all_requests: bool = False
+
+settings = Settings()
+logging.config.fileConfig(settings.logging_config, disable_existing_loggers=False)
+logger = logging.getLogger(__name__)
+# the class cache's listener thread, the new-user flush thread and the
+# idempotency store run outside the event loop, they get sync clients of their own
+sync_redis_client = metrics.Redis(host=settings.redis_host, port=settings.redis_port, db=settings.redis_db)
+# invalidations are published by the registrar endpoints in enroll/api.py
+class_cache = ClassCache(sync_redis_client, settings.class_cache_size, settings.class_cache_ttl)
+sync_repository = open_repository(settings.database)
+if isinstance(sync_repository, DynamoDBRepository):
+    metrics.instrument_dynamodb(sync_repository.client)
+known_users = KnownUsers(
+    sync_repository,
+    sync_redis_client,
+    settings.known_users_size,
+    settings.user_flush_interval,
+)
+idempotency = IdempotencyStore(sync_redis_client, settings.idempotency_ttl, settings.idempotency_lock_ttl)
+
+
+class Backends:
+    """Repository and Redis client shared by every request, opened in lifespan"""
+    repository = None
+    redis = None
+    waitlist = None
+    open_classes = None
+    seat_events = None
+
+backends = Backends()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with open_async_repository(sync_repository) as repository:
+        backends.repository = repository
+        if isinstance(repository, AsyncDynamoDBRepository):
+            metrics.instrument_dynamodb(repository.client)
+        backends.redis = metrics.AsyncRedis(connection_pool=redis.BlockingConnectionPool(
+            host=settings.redis_host,
+            port=settings.redis_port,
+            db=settings.redis_db,
+            max_connections=settings.redis_max_connections,
+            timeout=settings.redis_pool_timeout,
+        ))
+        backends.waitlist = AsyncWaitlist(backends.redis)
+        backends.open_classes = AsyncOpenClasses(backends.redis)
+        backends.seat_events = AsyncSeatEvents(backends.redis)
+        OpenClasses(sync_redis_client).ensure(sync_repository)
+        class_cache.start_listener()
+        known_users.start()
+        promotion_worker = None
+        if repository.in_process:
+            # python -m enroll.promotions can't see this worker's data, so it promotes itself
+            promotion_worker = PromotionWorker(
+                Promoter(sync_repository, sync_redis_client), sync_redis_client, f"{socket.gethostname()}-{os.getpid()}"
+            )
+            threading.Thread(target=promotion_worker.run, name="promotions", daemon=True).start()
+        try:
+            yield
+        finally:
+            if promotion_worker is not None:
+                promotion_worker.stop()
+            known_users.stop()
+            class_cache.stop_listener()
+            await backends.redis.aclose()
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = tracing.ProfiledRoute
+
+
+@app.middleware("http")
+async def replay_idempotent_requests(request: Request, call_next):
+    return await replay_or_run(idempotency, request, call_next)
+
+
+app.middleware("http")(tracing.RequestTracer(settings.profile_dir, settings.profile_all_requests, settings.trace_log_threshold))
+
+
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        metrics.observe_request(request, status_code, time.perf_counter() - start)
+    return response
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Request latencies and DynamoDB and Redis calls of this worker, in the Prometheus text format."""
+    content, media_type = metrics.render()
+    return Response(content=content, media_type=media_type)
+
+
+@app.get("/profiles/{name}")
+async def get_profile(name: str):
+    """A profile saved for a request sent with an X-Profile header."""
+    path = tracing.profile_path(settings.profile_dir, name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path)
+
+
+class IdAllocator:
+    """Async counterpart of IdAllocator in enroll/api.py, leasing blocks from the same counter"""
+    def __init__(self, counter_name: str, block_size: int):
+        self.counter_name = counter_name
+        self.block_size = block_size
+        self.next_id = 1
+        self.last_id = 0
+        self.lock = asyncio.Lock()
+
+    async def allocate(self):
+        async with self.lock:
+            if self.next_id > self.last_id:
+                self.next_id, self.last_id = await backends.repository.lease_ids(self.counter_name, self.block_size)
+            new_id = self.next_id
+            self.next_id += 1
+            return new_id
+
+enrollment_ids = IdAllocator('EnrollmentID', settings.id_block_size)
+
+
+async def check_user(id_val: int, username: str, email: str):
+    """Makes sure the user has a Users item, new users are written in the background"""
+    user_item = {
+        "UserId": id_val,
+        "Username": username,
+        "Email": email
+    }
+    if known_users.is_known(id_val):
+        return user_item
+    if await backends.redis.sismember(KNOWN_USERS_KEY, id_val):
+        known_users.learn(id_val)
+        return user_item
+    known_users.enqueue(user_item)
+    return user_item
+
+
+async def get_class(class_id: int):
+    """Read through the class cache, returns the class item or None"""
+    class_item = class_cache.lookup(class_id)
+    if class_item is None:
+        version = class_cache.version
+        class_item = await backends.repository.get_class(class_id)
+        if class_item is not None:
+            class_cache.store(class_id, class_item, version)
+    return class_item
+
+
+async def check_class_exists(class_id: int):
+    return check_class_found(await get_class(class_id), class_id)
+
+
+async def get_enrollment(student_id: int, class_id: int):
+    """Returns the student's enrollment item for the class (id and state) or None"""
+    return await backends.repository.get_enrollment(student_id, class_id)
+
+
+async def update_enrollment_status(enrollment_id: int, new_status: str):
+    try:
+        return await backends.repository.set_enrollment_state(enrollment_id, new_status)
+    except RepositoryError as e:
+        logger.error("Error updating enrollment status for enrollmentID %s: %s", enrollment_id, e)
+        return None
+
+
+async def student_pages(class_id: int, enrollment_status: str, limit: int = None, start_key=None):
+    """See student_pages in enroll/api.py"""
+    async for items, start_key in backends.repository.enrollment_pages(class_id, enrollment_status, limit, start_key):
+        yield student_rows(items), start_key
+
+
+async def get_students_for_class(class_id: int, enrollment_status: str, limit: int = None, cursor: str = None):
+    start_key = parse_cursor(cursor)
+    if limit is not None:
+        async for students, last_key in student_pages(class_id, enrollment_status, limit, start_key):
+            return students, encode_cursor(last_key)
+    enrolled_students = []
+    async for students, _ in student_pages(class_id, enrollment_status, start_key=start_key):
+        enrolled_students.extend(students)
+    return enrolled_students, None
+
+
+async def take_seat_and_enroll(student_id: int, class_id: int, enrollment):
+    """See take_seat_and_enroll in enroll/api.py"""
+    new_enrollment_id = await enrollment_ids.allocate() if enrollment is None else None
+    item, write = enrollment_write(student_id, class_id, enrollment, "ENROLLED", new_enrollment_id)
+    try:
+        await backends.repository.transact(enroll_writes(class_id, write))
+        await backends.open_classes.adjust(class_id, 1)
+        return item, None
+    except TransactionCancelled as e:
+        class_item = seat_refused(e, student_id, class_id)
+
+    if not class_item:
+        class_item = await check_class_exists(class_id)
+    check_active(class_item, class_id)
+    return None, class_item
+
+
+async def add_to_waitlist(class_id: int, student_id: int, class_item, enrollment):
+    check_waitlist_push(await backends.waitlist.push(class_id, student_id, class_item["WaitlistMaximum"]), student_id, class_id)
+    await backends.open_classes.adjust(class_id)
+
+    try:
+        if enrollment is None:
+            await backends.repository.put_enrollment(
+                enrollment_item(await enrollment_ids.allocate(), student_id, class_id, "WAITLISTED")
+            )
+            updated_status = "WAITLISTED"
+        else:
+            updated_status = await update_enrollment_status(enrollment["EnrollmentID"], 'WAITLISTED')
+    except RepositoryError:
+        updated_status = None
+    if not updated_status:
+        await backends.waitlist.remove(class_id, student_id)
+        await backends.open_classes.adjust(class_id)
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to update enrollment status"
+        )
+    return True
+
+
+async def drop_enrollment(student_id: int, class_id: int, enrollment):
+    """Sets the enrollment DROPPED, an ENROLLED one gives its seat back in the same transaction
+    and the next student on the waitlist is enrolled in the background (see enroll/promotions.py)"""
+    try:
+        await backends.repository.transact(drop_writes(class_id, enrollment))
+    except TransactionCancelled:
+        raise enrollment_changed(student_id, class_id)
+    if enrollment["EnrollmentState"] == 'ENROLLED':
+        # committed, see UnitOfWork.commit in enroll/api.py
+        try:
+            await backends.seat_events.publish(class_id)
+            await backends.open_classes.adjust(class_id, -1)
+        except RedisError as e:
+            logger.error("Error publishing the seat change of class %s: %s", class_id, e)
+
+
+async def check_instructor_for_class(instructor_id: int, class_id: int, username: str, email: str):
+    await check_user(instructor_id, username, email)
+    check_instructor(instructor_id, class_id, await get_class(class_id))
+
+
+### Student related endpoints
+@app.get("/list")
+async def list_open_classes(request: Request):
+    """API to fetch list of available classes in catalog, see list_open_classes in enroll/api.py"""
+    version = await backends.open_classes.version()
+    if etag_matches(request.headers.get("If-None-Match"), version):
+        return Response(status_code=304, headers=catalog_headers(version))
+    version, body = await backends.open_classes.list_json(version)
+    return Response(content=body, media_type="application/json", headers=catalog_headers(version))
+
+
+def catalog_headers(version: int):
+    return {"ETag": etag(version), "Cache-Control": f"public, max-age={settings.catalog_max_age}"}
+
+
+@app.post("/enroll/{studentid}/{classid}/{username}/{email}")
+async def enroll_student_in_class(studentid: int, classid: int, username: str, email: str):
+    """API to enroll a student in a class."""
+    await check_user(studentid, username, email)
+    enrollment = await get_enrollment(studentid, classid)
+    check_can_enroll(studentid, classid, enrollment_state(enrollment))
+
+    if await backends.waitlist.length(classid):
+        # a freed seat goes to the waitlist before anyone new, even before the promotion worker got to it
+        class_item = await check_class_exists(classid)
+        check_active(class_item, classid)
+        await add_to_waitlist(classid, studentid, class_item, enrollment)
+        return {
+            "message": "Student added to waitlist",
+        }
+
+    enrollment_item, class_item = await take_seat_and_enroll(studentid, classid, enrollment)
+    if enrollment_item is not None:
+        return {
+            "message": "Enrollment added successfully",
+            "enrollment_item": enrollment_item,
+        }
+    if await add_to_waitlist(classid, studentid, class_item, enrollment):
+        return {
+            "message": "Student added to waitlist",
+        }
+
+
+@app.delete("/enrollmentdrop/{studentid}/{classid}/{username}/{email}")
+async def drop_student_from_class(studentid: int, classid: int, username: str, email: str):
+    """API to drop a class."""
+    await check_user(studentid, username, email)
+    enrollment = await get_enrollment(studentid, classid)
+    check_can_drop(studentid, classid, enrollment_state(enrollment))
+    await drop_enrollment(studentid, classid, enrollment)
+    return {
+        "message": "Class dropped updated successfully",
+        "updated_status": 'DROPPED',
+    }
+
+
+@app.delete("/waitlistdrop/{studentid}/{classid}/{username}/{email}")
+async def remove_student_from_waitlist(studentid: int, classid: int, username: str, email: str):
+    """API to drop a class from waitlist."""
+    await check_user(studentid, username, email)
+    enrollment = await get_enrollment(studentid, classid)
+    check_can_leave_waitlist(studentid, classid, enrollment_state(enrollment))
+    await drop_enrollment(studentid, classid, enrollment)
+    exists = await backends.waitlist.remove(classid, studentid)
+    await backends.open_classes.adjust(classid)
+    if exists == 0:
+        raise HTTPException(
+            status_code=400,
+            detail={"Error": "No such student found in the given class on the waitlist"}
+        )
+    return {"Element removed": studentid}
+
+
+@app.get("/waitlist/{studentid}/{classid}/{username}/{email}")
+async def view_waitlist_position(studentid: int, classid: int, username: str, email: str):
+    """API to view a student's position on the waitlist."""
+    await check_user(studentid, username, email)
+    position = await backends.waitlist.position(classid, studentid)
+    if position is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Student {studentid} is not on the waitlist for class {classid}",
+        )
+    return {f"Student {studentid} is on the waitlist for class {classid} in position": position}
+
+
+### Instructor related endpoints
+@app.get("/enrolled/{instructorid}/{classid}/{username}/{email}")
+async def view_enrolled(instructorid: int, classid: int, username: str, email: str, limit: int = Query(None, ge=1, le=1000), cursor: str = None):
+    """API to view all students enrolled in a class."""
+    await check_instructor_for_class(instructorid, classid, username, email)
+    enrolled_students, next_cursor = await get_students_for_class(classid, 'ENROLLED', limit, cursor)
+    if not enrolled_students and cursor is None:
+        raise HTTPException(status_code=404, detail="No enrolled students found for this class.")
+    return {"Enrolled Students": enrolled_students, "next_cursor": next_cursor}
+
+
+@app.get("/dropped/{instructorid}/{classid}/{username}/{email}")
+async def view_dropped_students(instructorid: int, classid: int, username: str, email: str, limit: int = Query(None, ge=1, le=1000), cursor: str = None):
+    """API to view all students dropped from a class."""
+    await check_instructor_for_class(instructorid, classid, username, email)
+    dropped_students, next_cursor = await get_students_for_class(classid, 'DROPPED', limit, cursor)
+    if not dropped_students and cursor is None:
+        raise HTTPException(status_code=404, detail="No dropped students found for this class.")
+    return {"Dropped Students": dropped_students, "next_cursor": next_cursor}
+
+
+@app.delete("/drop/{instructorid}/{classid}/{studentid}/{username}/{email}")
+async def drop_student_administratively(instructorid: int, classid: int, studentid: int, username: str, email: str):
+    """API to drop a student from a class."""
+    await check_instructor_for_class(instructorid, classid, username, email)
+    enrollment = await get_enrollment(studentid, classid)
+    status = enrollment_state(enrollment)
+    check_can_drop_administratively(studentid, classid, enrollment)
+    await drop_enrollment(studentid, classid, enrollment)
+    if status == 'WAITLISTED':
+        await backends.waitlist.remove(classid, studentid)
+        await backends.open_classes.adjust(classid)
+    return {"message": f"Student {studentid} has been administratively dropped from class {classid} by instructor {instructorid}"}
+
+
+@app.get("/instructorwaitlist/{instructorid}/{classid}/{username}/{email}")
+async def view_waitlist(instructorid: int, classid: int, username: str, email: str, limit: int = Query(None, ge=1, le=1000), cursor: str = None):
+    """API to view the waitlist for a class."""
+    await check_instructor_for_class(instructorid, classid, username, email)
+    position = parse_cursor(cursor)
+    offset = position.get("offset", 0) if position else 0
+    if cursor is None:
+        waitlisted_students, _ = await get_students_for_class(classid, 'WAITLISTED', limit=1)
+        if not waitlisted_students:
+            raise HTTPException(status_code=404, detail="No waitlisted students found for this class.")
+
+    # one extra student tells whether there's another page
+    student_ids, next_cursor = waitlist_page(
+        await backends.waitlist.students(classid, offset, None if limit is None else limit + 1), offset, limit
+    )
+    if not len(student_ids) and cursor is None:
+        raise HTTPException(status_code=404, detail="No students found in the waitlist for this class")
+    return {"Waitlist": [{"student_id": student} for student in student_ids], "next_cursor": next_cursor}
+
+
+@app.get("/roster/{instructorid}/{classid}/{username}/{email}")
+async def export_roster(instructorid: int, classid: int, username: str, email: str, status: str = 'ENROLLED', format: str = 'csv'):
+    """API to download the students of a class in one state, streamed a page at a time."""
+    await check_instructor_for_class(instructorid, classid, username, email)
+    check_roster_request(status, format)
+
+    async def rows():
+        header = True
+        async for students, _ in student_pages(classid, status):
+            yield format_rows(students, format, header)
+            header = False
+
+    return StreamingResponse(
+        rows(),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f"attachment; filename=class_{classid}_{status.lower()}.{format}"}
+    )
@@ -0,0 +1,108 @@
+"""In-process cache of Classes items shared by the requests of one worker.
+
+Entries expire after a TTL and the least recently used ones are evicted past
+max_entries. Endpoints that change a class (/state, /change, /remove, /add)
+publish its id on a Redis channel, and every worker drops that entry as soon as
+the message arrives, so a change is seen by all workers right away rather than
+after the TTL.
+
+CurrentEnrollment in a cached item can be behind, capacity decisions must read
+it from DynamoDB (the enroll transaction does it in its condition).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+INVALIDATION_CHANNEL = "classInvalidations"
+
+
+class ClassCache:
+    def __init__(self, redis_client, max_entries: int, ttl: float):
+        self.redis = redis_client
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # bumped by every drop, an item loaded before a drop isn't stored
+        self.version = 0
+        self.listener = None
+
+    def lookup(self, class_id: int):
+        """Returns the cached item or None, counting the hit or miss"""
+        with self.lock:
+            entry = self.entries.get(class_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(class_id)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[class_id]
+            self.misses += 1
+            return None
+
+    def store(self, class_id: int, item, version: int):
+        """Caches an item that was loaded when self.version was version"""
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries[class_id] = (time.monotonic() + self.ttl, item)
+            self.entries.move_to_end(class_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, class_id: int, loader):
+        """Read through: returns the cached item, or loads, caches and returns it.
+        Missing classes (loader returns None) aren't cached."""
+        item = self.lookup(class_id)
+        if item is None:
+            version = self.version
+            item = loader(class_id)
+            if item is not None:
+                self.store(class_id, item, version)
+        return item
+
+    def drop(self, class_id: int):
+        with self.lock:
+            self.entries.pop(class_id, None)
+            self.invalidations += 1
+            self.version += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.version += 1
+
+    def invalidate(self, class_id: int):
+        """Drops the class here and tells every other worker to drop it"""
+        self.drop(class_id)
+        self.redis.publish(INVALIDATION_CHANNEL, class_id)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+    def on_message(self, message):
+        self.drop(int(message["data"]))
+
+    def on_listener_error(self, error, pubsub, thread):
+        # invalidations may have been missed while disconnected, start over
+        self.clear()
+        time.sleep(1)
+
+    def start_listener(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: self.on_message})
+        self.listener = pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=self.on_listener_error)
+
+    def stop_listener(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
@@ -0,0 +1,82 @@
+"""Parsing and validation of rows for the registrar's bulk class import.
+
+Rows come as CSV with a header line or as NDJSON, one class per line, with the
+fields of /add: sectionid, coursecode, classname, department, professorid,
+enrollmax, status and waitmax. CSV fields can't contain line breaks.
+"""
+import csv
+import json
+
+FIELDS = ["sectionid", "coursecode", "classname", "department", "professorid", "enrollmax", "status", "waitmax"]
+INTEGER_FIELDS = ["sectionid", "professorid", "enrollmax", "waitmax"]
+
+
+async def read_lines(stream):
+    """Yields the lines of a streamed request body as they arrive"""
+    pending = b""
+    async for chunk in stream:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode().rstrip("\r")
+    if pending:
+        yield pending.decode().rstrip("\r")
+
+
+async def read_rows(stream, input_format: str):
+    """Yields (row number, fields) for every non-empty line, fields is None if the line can't be parsed"""
+    header = None
+    number = 0
+    async for line in read_lines(stream):
+        if not line.strip():
+            continue
+        if input_format == "csv" and header is None:
+            header = [name.strip().lower() for name in next(csv.reader([line]))]
+            continue
+        number += 1
+        try:
+            if input_format == "csv":
+                fields = dict(zip(header, next(csv.reader([line]))))
+            else:
+                fields = json.loads(line)
+                if not isinstance(fields, dict):
+                    fields = None
+        except (csv.Error, json.JSONDecodeError):
+            fields = None
+        yield number, fields
+
+
+def parse_row(fields):
+    """Returns the class item a row describes (without its ClassID), raises ValueError for a bad row"""
+    if fields is None:
+        raise ValueError("Row can't be parsed")
+    missing = [field for field in FIELDS if fields.get(field) in (None, "")]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)}")
+    values = {}
+    for field in FIELDS:
+        value = fields[field]
+        if field in INTEGER_FIELDS:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{field} must be a whole number")
+            if value < 0:
+                raise ValueError(f"{field} can't be negative")
+        else:
+            value = str(value).strip()
+        values[field] = value
+    if values["status"] not in ["active", "inactive"]:
+        raise ValueError("status must be active or inactive")
+    return {
+        "SectionNumber": values["sectionid"],
+        "CourseCode": values["coursecode"],
+        "ClassName": values["classname"],
+        "Department": values["department"],
+        "InstructorID": values["professorid"],
+        "MaxCapacity": values["enrollmax"],
+        "CurrentEnrollment": 0,
+        "CurrentWaitlist": 0,
+        "State": values["status"],
+        "WaitlistMaximum": values["waitmax"],
+    }
@@ -0,0 +1,372 @@
+"""The Repository on the DynamoDB tables created by enroll/var/catalog.py.
+
+Transactions are TransactWriteItems calls and the conditions of their writes
+are condition expressions. Failed calls raise RepositoryError with the
+ClientError as its cause. AsyncDynamoDBRepository sends the same requests with
+aioboto3 for enroll/async_api.py, built by the functions below.
+"""
+import contextlib
+
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer
+
+from enroll.repository import (
+    Repository, AsyncRepository, RepositoryError, ConditionFailed, TransactionCancelled,
+    TakeSeat, FillSeats, AddSeats, PutEnrollment, SetEnrollmentState,
+)
+
+deserializer = TypeDeserializer()
+
+
+def deserialize_item(item):
+    # items in cancellation reasons aren't converted to python types for us
+    return {key: deserializer.deserialize(value) for key, value in item.items()}
+
+
+@contextlib.contextmanager
+def client_errors():
+    """Raises the RepositoryError matching a ClientError"""
+    try:
+        yield
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        message = e.response['Error']['Message']
+        if code == 'TransactionCanceledException':
+            failed = {
+                index: deserialize_item(reason['Item']) if reason.get('Item') else None
+                for index, reason in enumerate(e.response.get('CancellationReasons', []))
+                if reason.get('Code') == 'ConditionalCheckFailed'
+            }
+            raise TransactionCancelled(message, failed) from e
+        if code == 'ConditionalCheckFailedException':
+            raise ConditionFailed(message) from e
+        raise RepositoryError(message) from e
+
+
+def transaction_item(write, classes_table: str, enrollments_table: str):
+    """The TransactWriteItems item of a write"""
+    if isinstance(write, TakeSeat):
+        return {
+            "Update": {
+                "TableName": classes_table,
+                "Key": {"ClassID": write.class_id},
+                "UpdateExpression": "SET CurrentEnrollment = CurrentEnrollment + :one",
+                "ConditionExpression": "#state_attribute = :active AND CurrentEnrollment < MaxCapacity",
+                "ExpressionAttributeNames": {"#state_attribute": "State"},
+                "ExpressionAttributeValues": {":one": 1, ":active": "active"},
+                "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+            }
+        }
+    if isinstance(write, FillSeats):
+        return {
+            "Update": {
+                "TableName": classes_table,
+                "Key": {"ClassID": write.class_id},
+                "UpdateExpression": "SET CurrentEnrollment = CurrentEnrollment + :seats",
+                "ConditionExpression": (
+                    "#state_attribute = :active AND CurrentEnrollment <= :limit AND MaxCapacity = :max_capacity"
+                ),
+                "ExpressionAttributeNames": {"#state_attribute": "State"},
+                "ExpressionAttributeValues": {
+                    ":seats": write.seats, ":limit": write.limit, ":max_capacity": write.max_capacity, ":active": "active",
+                },
+                "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+            }
+        }
+    if isinstance(write, AddSeats):
+        return {
+            "Update": {
+                "TableName": classes_table,
+                "Key": {"ClassID": write.class_id},
+                "UpdateExpression": "ADD CurrentEnrollment :delta",
+                "ExpressionAttributeValues": {":delta": write.delta},
+            }
+        }
+    if isinstance(write, PutEnrollment):
+        return {
+            "Put": {
+                "TableName": enrollments_table,
+                "Item": write.item,
+                "ConditionExpression": "attribute_not_exists(EnrollmentID)",
+            }
+        }
+    if isinstance(write, SetEnrollmentState):
+        return {
+            "Update": {
+                "TableName": enrollments_table,
+                "Key": {"EnrollmentID": write.enrollment_id},
+                "UpdateExpression": "SET EnrollmentState = :new_status",
+                "ConditionExpression": "EnrollmentState = :old_status",
+                "ExpressionAttributeValues": {":new_status": write.new_state, ":old_status": write.old_state},
+            }
+        }
+    raise TypeError(f"Unknown write {write!r}")
+
+
+def enrollment_query(student_id: int, class_id: int):
+    """Query parameters of get_enrollment"""
+    return {
+        'IndexName': 'StudentID-ClassID-index',
+        'KeyConditionExpression': Key('StudentID').eq(student_id) & Key('ClassID').eq(class_id),
+        'ProjectionExpression': 'EnrollmentID, EnrollmentState',
+        'Limit': 1,
+    }
+
+
+def enrollment_pages_query(class_id: int, enrollment_state: str, limit: int = None):
+    """Query parameters of enrollment_pages, without the start key"""
+    query = {
+        'IndexName': 'ClassID-EnrollmentState-index',
+        'KeyConditionExpression': Key('ClassID').eq(class_id) & Key('EnrollmentState').eq(enrollment_state),
+        'ProjectionExpression': 'EnrollmentID, StudentID, EnrollmentState',
+    }
+    if limit is not None:
+        query['Limit'] = limit
+    return query
+
+
+def lease_update(counter_name: str, size: int):
+    """update_item parameters of lease_ids"""
+    return {
+        'Key': {'CounterName': counter_name},
+        'UpdateExpression': 'ADD CurrentValue :size',
+        'ExpressionAttributeValues': {':size': size},
+        'ReturnValues': 'UPDATED_NEW',
+    }
+
+
+def leased_block(response, size: int):
+    last_id = int(response['Attributes']['CurrentValue'])
+    return last_id - size + 1, last_id
+
+
+def enrollment_state_update(enrollment_id: int, new_state: str):
+    """update_item parameters of set_enrollment_state"""
+    return {
+        'Key': {'EnrollmentID': enrollment_id},
+        'UpdateExpression': 'SET EnrollmentState = :status',
+        'ConditionExpression': 'attribute_exists(EnrollmentID)',
+        'ExpressionAttributeValues': {':status': new_state},
+        'ReturnValues': 'UPDATED_NEW',
+    }
+
+
+class DynamoDBRepository(Repository):
+    def __init__(self, dynamo_db):
+        self.users_table = dynamo_db.Table('Users')
+        self.classes_table = dynamo_db.Table('Classes')
+        self.enrollments_table = dynamo_db.Table('Enrollments')
+        self.counters_table = dynamo_db.Table('Counters')
+        # client for calls the Table resource doesn't have, like transactions
+        # (it still converts between python and DynamoDB types for us)
+        self.client = dynamo_db.meta.client
+
+    def lease_ids(self, counter_name: str, size: int):
+        with client_errors():
+            response = self.counters_table.update_item(**lease_update(counter_name, size))
+        return leased_block(response, size)
+
+    def put_users(self, user_items):
+        with client_errors(), self.users_table.batch_writer() as batch:
+            for user_item in user_items:
+                batch.put_item(Item=user_item)
+
+    def get_class(self, class_id: int, consistent: bool = False):
+        with client_errors():
+            return self.classes_table.get_item(Key={'ClassID': class_id}, ConsistentRead=consistent).get('Item')
+
+    def get_classes(self, class_ids):
+        """Fetches the class items with BatchGetItem"""
+        classes = {}
+        request = {self.classes_table.name: {'Keys': [{'ClassID': class_id} for class_id in class_ids]}}
+        while request:
+            with client_errors():
+                response = self.client.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(self.classes_table.name, []):
+                classes[int(item['ClassID'])] = item
+            request = response.get('UnprocessedKeys')
+        return classes
+
+    def active_classes(self):
+        items = []
+        query = {
+            "IndexName": "State-index",
+            "KeyConditionExpression": Key("State").eq("active"),
+        }
+        while True:
+            with client_errors():
+                response = self.classes_table.query(**query)
+            items.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                return items
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def section_exists(self, section_number: int, course_code: str):
+        with client_errors():
+            response = self.classes_table.query(
+                IndexName='SectionNumber-CourseCode-index',
+                KeyConditionExpression=Key('SectionNumber').eq(section_number) & Key('CourseCode').eq(course_code),
+                ProjectionExpression='ClassID',
+            )
+        return bool(response.get('Items'))
+
+    def class_sections(self):
+        """Read with one paginated scan"""
+        sections = set()
+        scan = {'ProjectionExpression': 'SectionNumber, CourseCode'}
+        while True:
+            with client_errors():
+                response = self.classes_table.scan(**scan)
+            for item in response.get('Items', []):
+                sections.add((int(item['SectionNumber']), item['CourseCode']))
+            if 'LastEvaluatedKey' not in response:
+                return sections
+            scan['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def put_classes(self, class_items):
+        with client_errors(), self.classes_table.batch_writer() as batch:
+            for class_item in class_items:
+                batch.put_item(Item=class_item)
+
+    def put_class(self, class_item):
+        with client_errors():
+            self.classes_table.put_item(Item=class_item)
+
+    def update_class(self, class_id: int, **attributes):
+        names = {f"#attribute{index}": name for index, name in enumerate(attributes)}
+        try:
+            with client_errors():
+                response = self.classes_table.update_item(
+                    Key={'ClassID': class_id},
+                    UpdateExpression='SET ' + ', '.join(f"{name} = :value{index}" for index, name in enumerate(names)),
+                    # an update would create a missing class
+                    ConditionExpression='attribute_exists(ClassID)',
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues={f":value{index}": value for index, value in enumerate(attributes.values())},
+                    ReturnValues='ALL_NEW'
+                )
+        except ConditionFailed:
+            return None
+        return response['Attributes']
+
+    def set_capacity(self, class_id: int, capacity: int):
+        with client_errors():
+            response = self.classes_table.update_item(
+                Key={'ClassID': class_id},
+                UpdateExpression='SET MaxCapacity = :capacity',
+                ConditionExpression='CurrentEnrollment <= :capacity',
+                ExpressionAttributeValues={':capacity': capacity},
+                ReturnValues='ALL_NEW'
+            )
+        return response['Attributes']
+
+    def add_seats(self, class_id: int, delta: int):
+        with client_errors():
+            response = self.classes_table.update_item(
+                Key={'ClassID': class_id},
+                UpdateExpression='ADD CurrentEnrollment :delta',
+                ExpressionAttributeValues={':delta': delta},
+                ReturnValues='UPDATED_NEW'
+            )
+        return response['Attributes']['CurrentEnrollment']
+
+    def delete_class(self, class_id: int):
+        with client_errors():
+            self.classes_table.delete_item(Key={'ClassID': class_id})
+
+    def get_enrollment(self, student_id: int, class_id: int):
+        with client_errors():
+            response = self.enrollments_table.query(**enrollment_query(student_id, class_id))
+        items = response.get('Items', [])
+        return items[0] if items else None
+
+    def enrollment_pages(self, class_id: int, enrollment_state: str, limit: int = None, start_key=None):
+        query = enrollment_pages_query(class_id, enrollment_state, limit)
+        while True:
+            if start_key:
+                query['ExclusiveStartKey'] = start_key
+            with client_errors():
+                response = self.enrollments_table.query(**query)
+            start_key = response.get('LastEvaluatedKey')
+            yield response.get('Items', []), start_key
+            if not start_key:
+                return
+
+    def put_enrollments(self, enrollment_items):
+        with client_errors(), self.enrollments_table.batch_writer() as batch:
+            for enrollment_item in enrollment_items:
+                batch.put_item(Item=enrollment_item)
+
+    def put_enrollment(self, enrollment_item):
+        with client_errors():
+            self.enrollments_table.put_item(Item=enrollment_item)
+
+    def set_enrollment_state(self, enrollment_id: int, new_state: str):
+        try:
+            with client_errors():
+                response = self.enrollments_table.update_item(**enrollment_state_update(enrollment_id, new_state))
+        except ConditionFailed:
+            return None
+        return response['Attributes']['EnrollmentState']
+
+    def transact(self, writes):
+        """One TransactWriteItems call, which takes at most 100 writes"""
+        with client_errors():
+            self.client.transact_write_items(TransactItems=[
+                transaction_item(write, self.classes_table.name, self.enrollments_table.name) for write in writes
+            ])
+
+
+class AsyncDynamoDBRepository(AsyncRepository):
+    """The same calls as DynamoDBRepository on aioboto3 Table resources, see open_async_repository"""
+    def __init__(self, classes_table, enrollments_table, counters_table):
+        self.classes_table = classes_table
+        self.enrollments_table = enrollments_table
+        self.counters_table = counters_table
+        self.client = classes_table.meta.client
+
+    async def lease_ids(self, counter_name: str, size: int):
+        with client_errors():
+            response = await self.counters_table.update_item(**lease_update(counter_name, size))
+        return leased_block(response, size)
+
+    async def get_class(self, class_id: int, consistent: bool = False):
+        with client_errors():
+            return (await self.classes_table.get_item(Key={'ClassID': class_id}, ConsistentRead=consistent)).get('Item')
+
+    async def get_enrollment(self, student_id: int, class_id: int):
+        with client_errors():
+            response = await self.enrollments_table.query(**enrollment_query(student_id, class_id))
+        items = response.get('Items', [])
+        return items[0] if items else None
+
+    async def enrollment_pages(self, class_id: int, enrollment_state: str, limit: int = None, start_key=None):
+        query = enrollment_pages_query(class_id, enrollment_state, limit)
+        while True:
+            if start_key:
+                query['ExclusiveStartKey'] = start_key
+            with client_errors():
+                response = await self.enrollments_table.query(**query)
+            start_key = response.get('LastEvaluatedKey')
+            yield response.get('Items', []), start_key
+            if not start_key:
+                return
+
+    async def put_enrollment(self, enrollment_item):
+        with client_errors():
+            await self.enrollments_table.put_item(Item=enrollment_item)
+
+    async def set_enrollment_state(self, enrollment_id: int, new_state: str):
+        try:
+            with client_errors():
+                response = await self.enrollments_table.update_item(**enrollment_state_update(enrollment_id, new_state))
+        except ConditionFailed:
+            return None
+        return response['Attributes']['EnrollmentState']
+
+    async def transact(self, writes):
+        with client_errors():
+            await self.client.transact_write_items(TransactItems=[
+                transaction_item(write, self.classes_table.name, self.enrollments_table.name) for write in writes
+            ])
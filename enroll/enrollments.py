@@ -0,0 +1,205 @@
+"""Rules of the student and instructor endpoints, shared by enroll/api.py and
+enroll/async_api.py so both services answer every request the same way.
+
+The check_* functions raise the HTTPException an endpoint answers with, the
+others build the repository writes of a change (see enroll/repository.py) or
+shape what was read. None of them does any I/O, each app reads and writes with
+its own sync or async clients.
+"""
+from fastapi import HTTPException
+
+from enroll.pagination import encode_cursor, decode_cursor, MEDIA_TYPES
+from enroll.repository import TakeSeat, AddSeats, PutEnrollment, SetEnrollmentState
+from enroll.waitlist import ALREADY_WAITLISTED, WAITLIST_FULL
+
+ENROLLMENT_STATES = ['ENROLLED', 'WAITLISTED', 'DROPPED']
+
+
+def enrollment_state(enrollment):
+    return enrollment.get('EnrollmentState') if enrollment else None
+
+
+def enrollment_changed(student_id: int, class_id: int):
+    """The answer to a transaction cancelled because the enrollment changed since it was read"""
+    return HTTPException(
+        status_code=409,
+        detail=f"Enrollment for StudentID {student_id} in class with ClassID {class_id} changed, try again"
+    )
+
+
+def check_class_found(class_item, class_id: int):
+    if not class_item:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Class with ClassID {class_id} not found"
+        )
+    return class_item
+
+
+def check_active(class_item, class_id: int):
+    if class_item.get('State') != 'active':
+        raise HTTPException(
+            status_code=409,
+            detail=f"Class with ClassID {class_id} is not active"
+        )
+
+
+def check_can_enroll(student_id: int, class_id: int, state: str):
+    if state == 'ENROLLED':
+        raise HTTPException(
+            status_code=409,
+            detail=f"Student with StudentID {student_id} is already enrolled in class with ClassID {class_id}"
+        )
+    if state == 'WAITLISTED':
+        raise HTTPException(
+            status_code=409,
+            detail=f"Student with StudentID {student_id} is already on the waitlist for class with ClassID {class_id}"
+        )
+
+
+def check_not_dropped(student_id: int, class_id: int, state: str):
+    if state == 'DROPPED':
+        raise HTTPException(
+            status_code=409,
+            detail=f"Student with StudentID {student_id} is already dropped from class with ClassID {class_id}"
+        )
+
+
+def check_can_drop(student_id: int, class_id: int, state: str):
+    """/enrollmentdrop only drops an ENROLLED student"""
+    check_not_dropped(student_id, class_id, state)
+    if state is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Student with StudentID {student_id} is not enrolled in class with ClassID {class_id}"
+        )
+    if state == 'WAITLISTED':
+        raise HTTPException(
+            status_code=404,
+            detail=f"Student with StudentID {student_id} is on the waitlist for class {class_id}. Drop from the waitlist instead."
+        )
+    if state != 'ENROLLED':
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to update enrollment status"
+        )
+
+
+def check_can_leave_waitlist(student_id: int, class_id: int, state: str):
+    """/waitlistdrop only drops a WAITLISTED student"""
+    check_not_dropped(student_id, class_id, state)
+    if state is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Student with StudentID {student_id} is not enrolled in class with ClassID {class_id}"
+        )
+    if state == 'ENROLLED':
+        raise HTTPException(
+            status_code=409,
+            detail=f"Student with StudentID {student_id} is enrolled in class with ClassID {class_id}"
+        )
+
+
+def check_can_drop_administratively(student_id: int, class_id: int, enrollment):
+    """/drop drops an ENROLLED or WAITLISTED student"""
+    check_not_dropped(student_id, class_id, enrollment_state(enrollment))
+    if enrollment is None:
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to update enrollment status"
+        )
+
+
+def check_instructor(instructor_id: int, class_id: int, class_item):
+    """class_item is the class the instructor asks about, None if there's no such class"""
+    if not class_item or class_item.get("InstructorID") != instructor_id:
+        raise HTTPException(
+            status_code=403,
+            detail=f"Instructor with InstructorID {instructor_id} is not an instructor for class with ClassID {class_id}"
+        )
+
+
+def check_waitlist_push(position, student_id: int, class_id: int):
+    """Raises if Waitlist.push refused the student"""
+    if position == ALREADY_WAITLISTED:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Student with StudentID {student_id} is already on the waitlist for class with ClassID {class_id}"
+        )
+    if position == WAITLIST_FULL:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Class and Waitlist with ClassID {class_id} are full"
+        )
+
+
+def check_roster_request(state: str, format: str):
+    if state not in ENROLLMENT_STATES:
+        raise HTTPException(status_code=400, detail=f"Invalid status {state}")
+    if format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid format {format}")
+
+
+def parse_cursor(cursor: str):
+    try:
+        return decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def enrollment_item(enrollment_id: int, student_id: int, class_id: int, state: str):
+    return {
+        "EnrollmentID": enrollment_id,
+        "StudentID": student_id,
+        "ClassID": class_id,
+        "EnrollmentState": state
+    }
+
+
+def enrollment_write(student_id: int, class_id: int, enrollment, new_state: str, new_enrollment_id: int = None):
+    """Returns the enrollment item in new_state and the write making it, a new enrollment
+    with new_enrollment_id or a state change of the DROPPED enrollment"""
+    if enrollment is None:
+        item = enrollment_item(new_enrollment_id, student_id, class_id, new_state)
+        return item, PutEnrollment(item)
+    item = enrollment_item(enrollment["EnrollmentID"], student_id, class_id, new_state)
+    return item, SetEnrollmentState(enrollment["EnrollmentID"], "DROPPED", new_state)
+
+
+def enroll_writes(class_id: int, write):
+    """Takes a seat and makes the enrollment write in one transaction, see seat_refused"""
+    return [TakeSeat(class_id), write]
+
+
+def seat_refused(cancelled, student_id: int, class_id: int):
+    """Given the TransactionCancelled of enroll_writes, raises if the enrollment changed
+    and returns the class item if the seat was refused (None if there's no such class)"""
+    if 1 in cancelled.failed:
+        raise enrollment_changed(student_id, class_id)
+    if 0 not in cancelled.failed:
+        raise cancelled
+    return cancelled.failed[0]
+
+
+def drop_writes(class_id: int, enrollment):
+    """Sets the enrollment DROPPED if it's still in the state it was read in,
+    an ENROLLED one gives its seat back in the same transaction"""
+    writes = [SetEnrollmentState(enrollment["EnrollmentID"], enrollment["EnrollmentState"], "DROPPED")]
+    if enrollment["EnrollmentState"] == 'ENROLLED':
+        writes.append(AddSeats(class_id, -1))
+    return writes
+
+
+def student_rows(items):
+    """The roster entries of enrollment items"""
+    return [
+        {"StudentID": int(item.get("StudentID")), "EnrollmentState": item.get("EnrollmentState")}
+        for item in items
+    ]
+
+
+def waitlist_page(student_ids, offset: int, limit: int):
+    """Cuts the limit + 1 students read from offset on to a page, returns them and the next cursor"""
+    if limit is not None and len(student_ids) > limit:
+        return student_ids[:limit], encode_cursor({"offset": offset + limit})
+    return student_ids, None
@@ -0,0 +1,103 @@
+"""Idempotency keys for the mutating endpoints of enroll/api.py and enroll/async_api.py.
+
+A client retrying a POST, PUT or DELETE sends the same Idempotency-Key header
+with every attempt. The first attempt claims idempotency_<hash> in Redis with
+SET NX and runs, its response is then stored under the key for a day and every
+retry gets it back (with an Idempotent-Replayed header) in one GET, without
+running the endpoint again. The hash covers the method and path with the key,
+so two clients picking the same key don't collide.
+
+- a retry that arrives while the first attempt is still running gets a 409
+- a key reused with a different body gets a 422
+- 5xx responses aren't stored, the key is released so a retry runs again
+- the claim expires after lock_ttl seconds, so a worker dying mid-request
+  doesn't block the key for the whole TTL
+
+Both apps run replay_or_run() in a middleware.
+"""
+import hashlib
+import json
+
+from fastapi.responses import Response, JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+KEY_PREFIX = "idempotency_"
+MAX_KEY_LENGTH = 255
+IDEMPOTENT_METHODS = {"POST", "PUT", "DELETE"}
+
+
+def idempotency_key(method: str, path: str, key: str):
+    return KEY_PREFIX + hashlib.sha256(f"{method} {path} {key}".encode()).hexdigest()
+
+
+def fingerprint(body: bytes):
+    """Identifies the body a key was first used with"""
+    return hashlib.sha256(body).hexdigest()
+
+
+class IdempotencyStore:
+    """Records of idempotent requests, keyed by the Redis keys idempotency_key() returns"""
+    def __init__(self, redis_client, ttl: int, lock_ttl: int):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+
+    def claim(self, key: str, request_fingerprint: str):
+        """Returns None if the key is new and now claimed by this request,
+        or the record of the request that used it first"""
+        running = json.dumps({"fingerprint": request_fingerprint, "state": "running"})
+        while True:
+            if self.redis.set(key, running, nx=True, ex=self.lock_ttl):
+                return None
+            record = self.redis.get(key)
+            # it may have expired or been released since the SET, try to claim it again
+            if record is not None:
+                return json.loads(record)
+
+    def complete(self, key: str, request_fingerprint: str, status_code: int, body: bytes, headers):
+        self.redis.set(key, json.dumps({
+            "fingerprint": request_fingerprint,
+            "state": "done",
+            "status_code": status_code,
+            "body": body.decode(),
+            "headers": headers,
+        }), ex=self.ttl)
+
+    def release(self, key: str):
+        self.redis.delete(key)
+
+
+async def replay_or_run(store, request, call_next, excluded_paths=()):
+    """Runs the request once per Idempotency-Key and replays its response to retries"""
+    key = request.headers.get("Idempotency-Key")
+    if key is None or request.method not in IDEMPOTENT_METHODS or request.url.path in excluded_paths:
+        return await call_next(request)
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return JSONResponse(status_code=400, content={"detail": f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters"})
+
+    key = idempotency_key(request.method, request.url.path, key)
+    request_fingerprint = fingerprint(await request.body())
+    record = await run_in_threadpool(store.claim, key, request_fingerprint)
+    if record is not None:
+        if record["fingerprint"] != request_fingerprint:
+            return JSONResponse(status_code=422, content={"detail": "Idempotency-Key was already used for a different request"})
+        if record["state"] == "running":
+            return JSONResponse(status_code=409, content={"detail": "A request with this Idempotency-Key is still running, try again"})
+        return Response(
+            content=record["body"],
+            status_code=record["status_code"],
+            headers={**record["headers"], "Idempotent-Replayed": "true"},
+        )
+
+    try:
+        response = await call_next(request)
+        body = b"".join([chunk async for chunk in response.body_iterator])
+    except Exception:
+        await run_in_threadpool(store.release, key)
+        raise
+    if response.status_code >= 500:
+        await run_in_threadpool(store.release, key)
+    else:
+        headers = {"content-type": response.headers["content-type"]} if "content-type" in response.headers else {}
+        await run_in_threadpool(store.complete, key, request_fingerprint, response.status_code, body, headers)
+    return Response(content=body, status_code=response.status_code, headers=dict(response.headers))
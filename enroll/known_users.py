@@ -0,0 +1,104 @@
+"""Remembers which users already have a Users item in the repository.
+
+The identity of a caller comes from the JWT that KrakenD checked, so the Users
+item only has to be written once. Ids of written users are kept in the Redis
+set knownUsers, shared by every worker, and in a bounded in-process LRU, so a
+repeat caller costs no database call and usually no Redis call either.
+
+New users are queued and written in batches by a background thread, and only
+added to knownUsers once their item is written.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+KNOWN_USERS_KEY = "knownUsers"
+
+logger = logging.getLogger(__name__)
+
+
+class KnownUsers:
+    def __init__(self, repository, redis_client, max_entries: int, flush_interval: float):
+        self.repository = repository
+        self.redis = redis_client
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.known = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.flusher = None
+
+    def is_known(self, user_id: int):
+        """True if this worker knows the user has been written, no I/O"""
+        with self.lock:
+            if user_id in self.known:
+                self.known.move_to_end(user_id)
+                return True
+            # already queued, the flush will write it
+            return user_id in self.pending
+
+    def learn(self, *user_ids: int):
+        with self.lock:
+            for user_id in user_ids:
+                self.known[user_id] = True
+                self.known.move_to_end(user_id)
+            while len(self.known) > self.max_entries:
+                self.known.popitem(last=False)
+
+    def enqueue(self, user_item):
+        """Queues the Users item to be written by the next flush"""
+        with self.lock:
+            self.pending[user_item["UserId"]] = user_item
+
+    def check(self, user_id: int, username: str, email: str):
+        """Makes sure the user will have a Users item, returns the item from the token"""
+        user_item = {
+            "UserId": user_id,
+            "Username": username,
+            "Email": email
+        }
+        if self.is_known(user_id):
+            return user_item
+        if self.redis.sismember(KNOWN_USERS_KEY, user_id):
+            self.learn(user_id)
+            return user_item
+        self.enqueue(user_item)
+        return user_item
+
+    def flush(self):
+        """Writes every queued user in batches of 25 and marks them known"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        try:
+            self.repository.put_users(list(pending.values()))
+        except Exception:
+            # put them back for the next flush, unless a newer item was queued meanwhile
+            with self.lock:
+                self.pending = {**pending, **self.pending}
+            raise
+        self.redis.sadd(KNOWN_USERS_KEY, *pending)
+        self.learn(*pending)
+        return len(pending)
+
+    def run_flusher(self):
+        while not self.stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Error writing new users: %s", e)
+
+    def start(self):
+        self.stopping.clear()
+        self.flusher = threading.Thread(target=self.run_flusher, daemon=True)
+        self.flusher.start()
+
+    def stop(self):
+        """Stops the background thread and writes whatever is still queued"""
+        self.stopping.set()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
@@ -0,0 +1,202 @@
+"""The Repository in the worker's memory.
+
+Items are kept in dicts by key, next to the secondary indexes the queries need
+(the enrollment of a student in a class, the sorted enrollments of a class in a
+state). One lock is held for every call, so transactions
+check all their conditions and then apply all their writes with nothing in
+between. Items are copied in and out, callers can't change the stored ones.
+
+Nothing is persisted and nothing is shared between processes: it's for
+measuring the service's own code, run a single worker.
+"""
+import bisect
+import threading
+
+from enroll.repository import (
+    Repository, ConditionFailed, TransactionCancelled,
+    TakeSeat, FillSeats, AddSeats, PutEnrollment, SetEnrollmentState,
+)
+
+# enrollments per page when enrollment_pages has no limit
+PAGE_SIZE = 1000
+
+
+class MemoryRepository(Repository):
+    in_process = True
+
+    def __init__(self):
+        self.users = {}
+        self.classes = {}
+        self.enrollments = {}
+        self.counters = {}
+        # (StudentID, ClassID) -> EnrollmentID
+        self.enrollment_ids = {}
+        # (ClassID, EnrollmentState) -> sorted EnrollmentIDs
+        self.enrollments_by_state = {}
+        self.lock = threading.Lock()
+
+    def lease_ids(self, counter_name: str, size: int):
+        with self.lock:
+            last_id = self.counters.get(counter_name, 0) + size
+            self.counters[counter_name] = last_id
+        return last_id - size + 1, last_id
+
+    def put_users(self, user_items):
+        with self.lock:
+            for user_item in user_items:
+                self.users[user_item["UserId"]] = dict(user_item)
+
+    def get_class(self, class_id: int, consistent: bool = False):
+        with self.lock:
+            class_item = self.classes.get(class_id)
+            return dict(class_item) if class_item is not None else None
+
+    def get_classes(self, class_ids):
+        with self.lock:
+            return {class_id: dict(self.classes[class_id]) for class_id in class_ids if class_id in self.classes}
+
+    def active_classes(self):
+        with self.lock:
+            return [dict(class_item) for class_item in self.classes.values() if class_item.get("State") == "active"]
+
+    def section_exists(self, section_number: int, course_code: str):
+        return (section_number, course_code) in self.class_sections()
+
+    def class_sections(self):
+        with self.lock:
+            return {(class_item["SectionNumber"], class_item["CourseCode"]) for class_item in self.classes.values()}
+
+    def put_classes(self, class_items):
+        with self.lock:
+            for class_item in class_items:
+                self.classes[class_item["ClassID"]] = dict(class_item)
+
+    def update_class(self, class_id: int, **attributes):
+        with self.lock:
+            class_item = self.classes.get(class_id)
+            if class_item is None:
+                return None
+            class_item.update(attributes)
+            return dict(class_item)
+
+    def set_capacity(self, class_id: int, capacity: int):
+        with self.lock:
+            class_item = self.classes.get(class_id)
+            if class_item is None or class_item["CurrentEnrollment"] > capacity:
+                raise ConditionFailed(f"Class {class_id} has more than {capacity} students enrolled")
+            class_item["MaxCapacity"] = capacity
+            return dict(class_item)
+
+    def add_seats(self, class_id: int, delta: int):
+        with self.lock:
+            class_item = self.classes.setdefault(class_id, {"ClassID": class_id, "CurrentEnrollment": 0})
+            class_item["CurrentEnrollment"] += delta
+            return class_item["CurrentEnrollment"]
+
+    def delete_class(self, class_id: int):
+        with self.lock:
+            self.classes.pop(class_id, None)
+
+    def get_enrollment(self, student_id: int, class_id: int):
+        with self.lock:
+            enrollment_id = self.enrollment_ids.get((student_id, class_id))
+            if enrollment_id is None:
+                return None
+            enrollment = self.enrollments[enrollment_id]
+            return {"EnrollmentID": enrollment_id, "EnrollmentState": enrollment["EnrollmentState"]}
+
+    def enrollment_page(self, class_id: int, enrollment_state: str, limit: int, start_key):
+        with self.lock:
+            ids = self.enrollments_by_state.get((class_id, enrollment_state), [])
+            start = bisect.bisect_right(ids, start_key["EnrollmentID"]) if start_key else 0
+            page = [dict(self.enrollments[enrollment_id]) for enrollment_id in ids[start:start + limit]]
+        next_key = {"EnrollmentID": page[-1]["EnrollmentID"]} if len(page) == limit else None
+        return page, next_key
+
+    def enrollment_pages(self, class_id: int, enrollment_state: str, limit: int = None, start_key=None):
+        while True:
+            page, start_key = self.enrollment_page(class_id, enrollment_state, limit or PAGE_SIZE, start_key)
+            yield page, start_key
+            if not start_key:
+                return
+
+    def index(self, enrollment):
+        ids = self.enrollments_by_state.setdefault((enrollment["ClassID"], enrollment["EnrollmentState"]), [])
+        bisect.insort(ids, enrollment["EnrollmentID"])
+
+    def unindex(self, enrollment):
+        ids = self.enrollments_by_state[(enrollment["ClassID"], enrollment["EnrollmentState"])]
+        del ids[bisect.bisect_left(ids, enrollment["EnrollmentID"])]
+
+    def store_enrollment(self, enrollment_item):
+        old = self.enrollments.get(enrollment_item["EnrollmentID"])
+        if old is not None:
+            self.unindex(old)
+            self.enrollment_ids.pop((old["StudentID"], old["ClassID"]), None)
+        enrollment = dict(enrollment_item)
+        self.enrollments[enrollment["EnrollmentID"]] = enrollment
+        self.enrollment_ids[(enrollment["StudentID"], enrollment["ClassID"])] = enrollment["EnrollmentID"]
+        self.index(enrollment)
+
+    def store_enrollment_state(self, enrollment, new_state: str):
+        self.unindex(enrollment)
+        enrollment["EnrollmentState"] = new_state
+        self.index(enrollment)
+
+    def put_enrollments(self, enrollment_items):
+        with self.lock:
+            for enrollment_item in enrollment_items:
+                self.store_enrollment(enrollment_item)
+
+    def set_enrollment_state(self, enrollment_id: int, new_state: str):
+        with self.lock:
+            enrollment = self.enrollments.get(enrollment_id)
+            if enrollment is None:
+                return None
+            self.store_enrollment_state(enrollment, new_state)
+            return new_state
+
+    def check(self, write):
+        """Returns whether the write's condition holds, and the class item for seat writes"""
+        if isinstance(write, (TakeSeat, FillSeats)):
+            class_item = self.classes.get(write.class_id)
+            if class_item is None or class_item.get("State") != "active":
+                return False, class_item
+            if isinstance(write, TakeSeat):
+                return class_item["CurrentEnrollment"] < class_item["MaxCapacity"], class_item
+            return (
+                class_item["CurrentEnrollment"] <= write.limit and class_item["MaxCapacity"] == write.max_capacity
+            ), class_item
+        if isinstance(write, PutEnrollment):
+            return write.item["EnrollmentID"] not in self.enrollments, None
+        if isinstance(write, SetEnrollmentState):
+            enrollment = self.enrollments.get(write.enrollment_id)
+            return enrollment is not None and enrollment["EnrollmentState"] == write.old_state, None
+        return True, None
+
+    def apply(self, write):
+        if isinstance(write, TakeSeat):
+            self.classes[write.class_id]["CurrentEnrollment"] += 1
+        elif isinstance(write, FillSeats):
+            self.classes[write.class_id]["CurrentEnrollment"] += write.seats
+        elif isinstance(write, AddSeats):
+            class_item = self.classes.setdefault(write.class_id, {"ClassID": write.class_id, "CurrentEnrollment": 0})
+            class_item["CurrentEnrollment"] += write.delta
+        elif isinstance(write, PutEnrollment):
+            self.store_enrollment(write.item)
+        elif isinstance(write, SetEnrollmentState):
+            self.store_enrollment_state(self.enrollments[write.enrollment_id], write.new_state)
+        else:
+            raise TypeError(f"Unknown write {write!r}")
+
+    def transact(self, writes):
+        with self.lock:
+            failed = {}
+            for index, write in enumerate(writes):
+                holds, item = self.check(write)
+                if not holds:
+                    failed[index] = dict(item) if item is not None else None
+            if failed:
+                raise TransactionCancelled("Transaction cancelled, a condition failed", failed)
+            for write in writes:
+                self.apply(write)
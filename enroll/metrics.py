@@ -0,0 +1,161 @@
+"""Prometheus metrics of the enroll services, served by GET /metrics.
+
+- http_request_duration_seconds{method, route, status}: every request, by route
+  template, so /enroll/{studentid}/{classid}/... is one series
+- backend_call_duration_seconds{backend, operation}: DynamoDB calls by operation
+  (query, update_item, transact_write_items, ...), Redis commands by name (ZCARD,
+  EVALSHA, pipeline, ...) and users service calls by path (/getuser, /getusers)
+- backend_call_errors_total{backend, operation}: calls that raised or that
+  DynamoDB answered with an error
+
+The _count of a histogram is the number of calls. Each uvicorn process serves
+its own numbers, scrape every instance. Every timed call is also added to the
+trace of the request making it, see enroll/tracing.py.
+"""
+import contextlib
+import time
+
+import redis
+import redis.asyncio
+import redis.client
+import redis.asyncio.client
+from botocore import xform_name
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+from enroll import tracing
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling requests",
+    ["method", "route", "status"],
+)
+BACKEND_LATENCY = Histogram(
+    "backend_call_duration_seconds",
+    "Time spent in calls to DynamoDB, Redis and other services",
+    ["backend", "operation"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+BACKEND_ERRORS = Counter(
+    "backend_call_errors_total",
+    "Calls to DynamoDB, Redis and other services that failed",
+    ["backend", "operation"],
+)
+
+
+@contextlib.contextmanager
+def timed(backend: str, operation: str, **details):
+    """Observes the latency of the call made in the block, and counts it as an error if it raises.
+    details go in the request's trace only, not in the labels."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        BACKEND_ERRORS.labels(backend, operation).inc()
+        details["error"] = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        BACKEND_LATENCY.labels(backend, operation).observe(seconds)
+        tracing.record(backend, operation, seconds, **details)
+
+
+def route_name(request):
+    route = request.scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+
+def observe_request(request, status_code: int, seconds: float):
+    REQUEST_LATENCY.labels(request.method, route_name(request), status_code).observe(seconds)
+
+
+def render():
+    """Returns the metrics in the Prometheus text format and its media type"""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+# botocore calls these around every request it sends, context is shared by the calls of one request
+def describe_dynamodb_call(params, model, context, **kwargs):
+    context["trace_target"] = tracing.dynamodb_target(params)
+    # makes DynamoDB return the capacity the call consumed, for the trace
+    if "ReturnConsumedCapacity" in model.input_shape.members:
+        params.setdefault("ReturnConsumedCapacity", "TOTAL")
+
+
+def start_dynamodb_call(context, **kwargs):
+    context["metrics_start"] = time.perf_counter()
+
+
+def end_dynamodb_call(model, context, parsed=None, http_response=None, **kwargs):
+    if "metrics_start" not in context:
+        return
+    operation = xform_name(model.name)
+    seconds = time.perf_counter() - context.pop("metrics_start")
+    BACKEND_LATENCY.labels("dynamodb", operation).observe(seconds)
+    details = dict(context.get("trace_target", {}))
+    if http_response is not None and http_response.status_code >= 400:
+        BACKEND_ERRORS.labels("dynamodb", operation).inc()
+        details["error"] = parsed.get("Error", {}).get("Code", True) if parsed else True
+    elif parsed:
+        details.update(tracing.dynamodb_result(parsed))
+    tracing.record("dynamodb", operation, seconds, **details)
+
+
+def failed_dynamodb_call(model, context, **kwargs):
+    if "metrics_start" not in context:
+        return
+    operation = xform_name(model.name)
+    seconds = time.perf_counter() - context.pop("metrics_start")
+    BACKEND_LATENCY.labels("dynamodb", operation).observe(seconds)
+    BACKEND_ERRORS.labels("dynamodb", operation).inc()
+    tracing.record("dynamodb", operation, seconds, error=True, **context.get("trace_target", {}))
+
+
+def instrument_dynamodb(client):
+    """Times and traces every call of a boto3 or aioboto3 DynamoDB client"""
+    client.meta.events.register('before-parameter-build.dynamodb', describe_dynamodb_call)
+    client.meta.events.register('before-call.dynamodb', start_dynamodb_call)
+    client.meta.events.register('after-call.dynamodb', end_dynamodb_call)
+    client.meta.events.register('after-call-error.dynamodb', failed_dynamodb_call)
+
+
+def redis_command(args):
+    """The name of a command and, for the trace, the key it's on"""
+    name = str(args[0]).upper()
+    if name in ("EVALSHA", "EVAL"):
+        # EVALSHA sha numkeys key ...
+        return name, {"key": str(args[3])} if len(args) > 3 and int(args[2]) else {}
+    return name, {"key": str(args[1])} if len(args) > 1 else {}
+
+
+class Pipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error: bool = True):
+        with timed("redis", "pipeline", commands=len(self.command_stack)):
+            return super().execute(raise_on_error)
+
+
+class Redis(redis.Redis):
+    """redis.Redis timing every command and pipeline"""
+    def execute_command(self, *args, **options):
+        name, details = redis_command(args)
+        with timed("redis", name, **details):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return Pipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class AsyncPipeline(redis.asyncio.client.Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        with timed("redis", "pipeline", commands=len(self.command_stack)):
+            return await super().execute(raise_on_error)
+
+
+class AsyncRedis(redis.asyncio.Redis):
+    """redis.asyncio.Redis timing every command and pipeline"""
+    async def execute_command(self, *args, **options):
+        name, details = redis_command(args)
+        with timed("redis", name, **details):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
@@ -0,0 +1,266 @@
+"""Materialized view of the classes /list returns, kept in Redis.
+
+activeClasses is a hash of ClassID to a JSON summary of every active class.
+openClasses holds the same summaries for the active classes whose waitlist
+isn't full, so /list is a single HVALS. Endpoints update the view as they
+change a class: enroll and drop adjust CurrentEnrollment by a delta, waitlist
+changes re-check the waitlist length, and /add, /state, /change and /remove
+replace or delete the summary. Every update is a Lua script, so concurrent
+requests can't lose each other's deltas.
+
+catalogVersion is incremented by every update that changes what /list
+returns. /list sends it as its ETag and answers a matching If-None-Match with a
+304 after a single GET, and each worker keeps the JSON of the latest version so
+a changed catalog is serialized once per worker rather than once per request.
+A rebuilt view starts the counter from the current time in milliseconds if it
+was lost, so versions handed out before aren't reused.
+
+Rebuild the view from the enroll service's database, or check it for drift, with
+
+    python -m enroll.open_classes check [database]
+    python -m enroll.open_classes rebuild [database]
+
+database is a database setting (see enroll/repository.py), dynamodb://localhost:5500
+if it's left out.
+
+The apps rebuild it on startup when it doesn't exist yet.
+"""
+import json
+import sys
+import time
+
+from enroll.waitlist import Waitlist, waitlist_key
+
+ACTIVE_KEY = "activeClasses"
+OPEN_KEY = "openClasses"
+VERSION_KEY = "catalogVersion"
+
+# attributes of a class listed by /list
+SUMMARY_ATTRIBUTES = [
+    "ClassID", "CourseCode", "SectionNumber", "ClassName", "Department", "MaxCapacity",
+    "CurrentEnrollment", "CurrentWaitlist", "InstructorID", "WaitlistMaximum",
+]
+
+# KEYS[1] active, KEYS[2] open, KEYS[3] waitlist, KEYS[4] version, ARGV[1] class id,
+# ARGV[2] CurrentEnrollment delta, ARGV[3] new summary or ''
+# returns 1, or 0 if the class isn't in the view
+UPDATE_SCRIPT = """
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+local summary = ARGV[3]
+if summary == '' then
+    summary = old
+    if not summary then
+        return 0
+    end
+end
+local class = cjson.decode(summary)
+if tonumber(ARGV[2]) ~= 0 then
+    class.CurrentEnrollment = class.CurrentEnrollment + tonumber(ARGV[2])
+    summary = cjson.encode(class)
+end
+local was_open = redis.call('HEXISTS', KEYS[2], ARGV[1]) == 1
+local is_open = redis.call('ZCARD', KEYS[3]) < class.WaitlistMaximum
+redis.call('HSET', KEYS[1], ARGV[1], summary)
+if is_open then
+    redis.call('HSET', KEYS[2], ARGV[1], summary)
+else
+    redis.call('HDEL', KEYS[2], ARGV[1])
+end
+if (is_open and summary ~= old) or is_open ~= was_open then
+    redis.call('INCR', KEYS[4])
+end
+return 1
+"""
+
+
+def summarize(class_item):
+    """The /list entry of a class item, as JSON"""
+    summary = {}
+    for attribute in SUMMARY_ATTRIBUTES:
+        if attribute in class_item:
+            value = class_item[attribute]
+            # numbers come back from DynamoDB as Decimal, every one of them is whole
+            summary[attribute] = value if isinstance(value, str) else int(value)
+    return json.dumps(summary, sort_keys=True)
+
+
+def parse_summaries(summaries):
+    classes = [json.loads(summary) for summary in summaries]
+    classes.sort(key=lambda aClass: aClass["ClassID"])
+    return classes
+
+
+def etag(version: int):
+    return f'"{version}"'
+
+
+def etag_matches(if_none_match: str, version: int):
+    """Whether an If-None-Match header names the ETag of version"""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag(version) in tags
+
+
+def parse_version(version):
+    return int(version) if version is not None else 0
+
+
+def update_keys(class_id: int):
+    return [ACTIVE_KEY, OPEN_KEY, waitlist_key(class_id), VERSION_KEY]
+
+
+class OpenClasses:
+    """The open classes view on a redis.Redis client"""
+    def __init__(self, r):
+        self.redis = r
+        self.update_script = r.register_script(UPDATE_SCRIPT)
+        # (version, JSON body of /list) of the latest version listed
+        self.listing = (None, None)
+
+    def list(self):
+        return parse_summaries(self.redis.hvals(OPEN_KEY))
+
+    def version(self):
+        return parse_version(self.redis.get(VERSION_KEY))
+
+    def list_json(self, version: int):
+        """Returns (version, JSON body of /list) for the current view, which is version or newer"""
+        if self.listing[0] == version:
+            return self.listing
+        pipe = self.redis.pipeline()
+        pipe.get(VERSION_KEY)
+        pipe.hvals(OPEN_KEY)
+        version, summaries = pipe.execute()
+        self.listing = (parse_version(version), json.dumps({"Classes": parse_summaries(summaries)}))
+        return self.listing
+
+    def adjust(self, class_id: int, delta: int = 0):
+        """Adds delta to the class's CurrentEnrollment and re-checks its waitlist,
+        call with no delta after the waitlist changed"""
+        self.update_script(keys=update_keys(class_id), args=[class_id, delta, ""])
+
+    def put(self, class_item):
+        """Replaces the summary of a class that was added or changed"""
+        class_id = int(class_item["ClassID"])
+        if class_item.get("State") != "active":
+            self.remove(class_id)
+            return
+        self.update_script(keys=update_keys(class_id), args=[class_id, 0, summarize(class_item)])
+
+    def put_many(self, class_items):
+        """put() for many classes, sent as one pipeline"""
+        pipe = self.redis.pipeline(transaction=False)
+        for class_item in class_items:
+            class_id = int(class_item["ClassID"])
+            if class_item.get("State") != "active":
+                pipe.hdel(ACTIVE_KEY, class_id)
+                pipe.hdel(OPEN_KEY, class_id)
+                pipe.incr(VERSION_KEY)
+            else:
+                self.update_script(keys=update_keys(class_id), args=[class_id, 0, summarize(class_item)], client=pipe)
+        pipe.execute()
+
+    def remove(self, class_id: int):
+        pipe = self.redis.pipeline()
+        pipe.hdel(ACTIVE_KEY, class_id)
+        pipe.hdel(OPEN_KEY, class_id)
+        pipe.incr(VERSION_KEY)
+        pipe.execute()
+
+    def expected(self, repository):
+        """Reads every active class from the repository, returns the (active, open) hashes they should give"""
+        items = repository.active_classes()
+        lengths = Waitlist(self.redis).lengths([int(item["ClassID"]) for item in items])
+        active = {}
+        open_classes = {}
+        for item in items:
+            class_id = int(item["ClassID"])
+            active[str(class_id)] = summarize(item)
+            if lengths[class_id] < item["WaitlistMaximum"]:
+                open_classes[str(class_id)] = active[str(class_id)]
+        return active, open_classes
+
+    def rebuild(self, repository):
+        """Replaces the view with one built from the repository, returns the number of open classes.
+        Updates made by requests while it reads the classes can be lost, run check again afterwards."""
+        active, open_classes = self.expected(repository)
+        pipe = self.redis.pipeline()
+        pipe.delete(ACTIVE_KEY, OPEN_KEY)
+        if active:
+            pipe.hset(ACTIVE_KEY, mapping=active)
+        if open_classes:
+            pipe.hset(OPEN_KEY, mapping=open_classes)
+        pipe.set(VERSION_KEY, int(time.time() * 1000), nx=True)
+        pipe.incr(VERSION_KEY)
+        pipe.execute()
+        return len(open_classes)
+
+    def ensure(self, repository):
+        """Builds the view if it doesn't exist yet"""
+        if not self.redis.exists(ACTIVE_KEY):
+            self.rebuild(repository)
+        else:
+            self.redis.set(VERSION_KEY, int(time.time() * 1000), nx=True)
+
+    def check(self, repository):
+        """Compares the view with the repository, returns a list of differences"""
+        expected_active, expected_open = self.expected(repository)
+        problems = []
+        for key, expected in ((ACTIVE_KEY, expected_active), (OPEN_KEY, expected_open)):
+            actual = {class_id.decode(): summary.decode() for class_id, summary in self.redis.hgetall(key).items()}
+            for class_id in sorted(expected.keys() | actual.keys(), key=int):
+                if class_id not in actual:
+                    problems.append(f"{key}: class {class_id} is missing")
+                elif class_id not in expected:
+                    problems.append(f"{key}: class {class_id} shouldn't be listed")
+                elif json.loads(actual[class_id]) != json.loads(expected[class_id]):
+                    problems.append(f"{key}: class {class_id} is {actual[class_id]}, should be {expected[class_id]}")
+        return problems
+
+
+class AsyncOpenClasses:
+    """The open classes view on a redis.asyncio.Redis client"""
+    def __init__(self, r):
+        self.redis = r
+        self.update_script = r.register_script(UPDATE_SCRIPT)
+        self.listing = (None, None)
+
+    async def list(self):
+        return parse_summaries(await self.redis.hvals(OPEN_KEY))
+
+    async def version(self):
+        return parse_version(await self.redis.get(VERSION_KEY))
+
+    async def list_json(self, version: int):
+        if self.listing[0] == version:
+            return self.listing
+        async with self.redis.pipeline() as pipe:
+            pipe.get(VERSION_KEY)
+            pipe.hvals(OPEN_KEY)
+            version, summaries = await pipe.execute()
+        self.listing = (parse_version(version), json.dumps({"Classes": parse_summaries(summaries)}))
+        return self.listing
+
+    async def adjust(self, class_id: int, delta: int = 0):
+        await self.update_script(keys=update_keys(class_id), args=[class_id, delta, ""])
+
+
+if __name__ == "__main__":
+    import redis
+    from enroll.repository import open_repository
+
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ("check", "rebuild"):
+        sys.exit("usage: python -m enroll.open_classes check|rebuild [database]")
+    database = sys.argv[2] if len(sys.argv) == 3 else "dynamodb://localhost:5500"
+    repository = open_repository(database)
+    view = OpenClasses(redis.Redis())
+    if sys.argv[1] == "rebuild":
+        print(f"Rebuilt the view, {view.rebuild(repository)} open classes")
+    else:
+        problems = view.check(repository)
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(f"{len(problems)} differences, fix them with: python -m enroll.open_classes rebuild")
+        print(f"Open classes view matches {database}")
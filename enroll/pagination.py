@@ -0,0 +1,53 @@
+"""Cursors for the paginated roster endpoints.
+
+A cursor is the LastEvaluatedKey of the previous DynamoDB page (or the next
+offset into a Redis waitlist) as URL-safe base64 JSON, clients pass it back
+unchanged. Rows of the streaming roster export are formatted here too.
+"""
+import base64
+import binascii
+import csv
+import io
+import json
+from decimal import Decimal
+
+ROSTER_FIELDS = ["StudentID", "EnrollmentState"]
+
+
+def encode_cursor(position):
+    if not position:
+        return None
+    # keys come back from DynamoDB with Decimal numbers, all ids are whole
+    plain = {name: int(value) if isinstance(value, Decimal) else value for name, value in position.items()}
+    return base64.urlsafe_b64encode(json.dumps(plain).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """Returns the position the cursor points at, raises ValueError for a cursor we didn't hand out"""
+    if cursor is None:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError(f"Invalid cursor {cursor}")
+    if not isinstance(position, dict):
+        raise ValueError(f"Invalid cursor {cursor}")
+    return position
+
+
+def format_rows(rows, output_format: str, header: bool):
+    """Formats roster rows as NDJSON or CSV lines"""
+    if output_format == "ndjson":
+        return "".join(json.dumps(row) + "\n" for row in rows)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=ROSTER_FIELDS, extrasaction="ignore")
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
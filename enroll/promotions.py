@@ -0,0 +1,271 @@
+"""Background promotion of waitlisted students into freed seats.
+
+A drop only writes the dropped enrollment and the class's lower
+CurrentEnrollment, then adds a "seat freed" event with the ClassID to the
+Redis Stream seatFreed. The worker reads the stream in the consumer group
+promoters, handles the events of each class once per read, filling every free
+seat from the head of the waitlist, and acknowledges them after the writes.
+
+Promotion is idempotent, so an event can be handled any number of times:
+
+- students are enrolled in one transaction with the class's CurrentEnrollment,
+  conditional on each enrollment still being WAITLISTED, on the seats still
+  being free and on MaxCapacity not having changed since it was read, and only taken off the waitlist after it commits
+- a student at the head of the waitlist whose enrollment isn't WAITLISTED
+  (promoted before a crash, or dropped) is just taken off it
+- events of a worker that died before acknowledging them are claimed by
+  another worker after CLAIM_IDLE_MS
+
+Seats freed without an event (a drop that crashed between its write and the
+XADD, a class that was reactivated) are found by a sweep of every active
+class, which the worker runs on startup and every SWEEP_INTERVAL seconds.
+When Redis or the database fail the worker logs it and tries again, waiting
+from MIN_BACKOFF up to MAX_BACKOFF seconds.
+
+Run a worker, or sweep once, with
+
+    python -m enroll.promotions run [database]
+    python -m enroll.promotions sweep [database]
+
+database defaults to the enroll service's DATABASE setting in enroll/.env. A
+memory:// database only exists in the enroll service, which runs its own worker
+then, so the standalone worker refuses to start on one.
+"""
+import contextvars
+import logging
+import logging.config
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+from pydantic_settings import BaseSettings
+
+from enroll.waitlist import Waitlist
+from enroll.open_classes import OpenClasses
+from enroll.repository import open_repository, RepositoryError, TransactionCancelled, FillSeats, SetEnrollmentState
+
+logger = logging.getLogger(__name__)
+
+STREAM_KEY = "seatFreed"
+GROUP = "promoters"
+# the stream is trimmed to about this many events
+STREAM_MAXLEN = 100000
+# events read at once, several events of a class are handled as one
+READ_COUNT = 100
+BLOCK_MS = 5000
+# unacknowledged events idle this long are claimed from the worker that read them
+CLAIM_IDLE_MS = 60000
+SWEEP_INTERVAL = 300
+# seconds the worker waits after Redis or the database failed, doubling up to MAX_BACKOFF
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+# students enrolled per transaction, with the class update that's 100 items at most
+MAX_PROMOTIONS = 99
+# cancelled promotion transactions in a row before the class is left for later
+MAX_CONFLICTS = 3
+
+
+class Settings(BaseSettings, env_file="enroll/.env", extra="ignore"):
+    """The enroll service's settings the standalone worker needs, see Settings in enroll/api.py"""
+    database: str
+    logging_config: str = "./enroll/etc/logging.ini"
+    redis_host: str = "localhost"
+    redis_port: int = 6379
+    redis_db: int = 0
+
+
+class PromotionConflict(Exception):
+    pass
+
+
+class SeatEvents:
+    """Publishes seat freed events on a redis.Redis client"""
+    def __init__(self, r):
+        self.redis = r
+
+    def publish(self, class_id: int):
+        self.redis.xadd(STREAM_KEY, {"ClassID": class_id}, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+class AsyncSeatEvents:
+    """Publishes seat freed events on a redis.asyncio.Redis client"""
+    def __init__(self, r):
+        self.redis = r
+
+    async def publish(self, class_id: int):
+        await self.redis.xadd(STREAM_KEY, {"ClassID": class_id}, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+class Promoter:
+    def __init__(self, repository, redis_client, lookup_workers: int = 8):
+        self.repository = repository
+        self.waitlist = Waitlist(redis_client)
+        self.open_classes = OpenClasses(redis_client)
+        self.seat_events = SeatEvents(redis_client)
+        self.lookup_workers = lookup_workers
+
+    def get_enrollments(self, student_ids, class_id: int):
+        """Returns {student id: enrollment or None}, queried in parallel"""
+        with ThreadPoolExecutor(max_workers=min(len(student_ids), self.lookup_workers)) as pool:
+            # each query runs in the caller's context, so a request counts its DynamoDB calls
+            futures = {
+                student_id: pool.submit(contextvars.copy_context().run, self.repository.get_enrollment, student_id, class_id)
+                for student_id in student_ids
+            }
+            return {student_id: future.result() for student_id, future in futures.items()}
+
+    def enroll(self, class_id: int, enrollments, max_capacity: int):
+        """Enrolls the students in one transaction, conditional on their enrollments being
+        WAITLISTED, on MaxCapacity still being max_capacity and on the seats still being free,
+        raises TransactionCancelled if not"""
+        writes = [SetEnrollmentState(enrollment["EnrollmentID"], "WAITLISTED", "ENROLLED") for enrollment in enrollments]
+        writes.append(FillSeats(class_id, len(enrollments), max_capacity - len(enrollments), max_capacity))
+        self.repository.transact(writes)
+
+    def promote(self, class_id: int):
+        """Fills the class's free seats from the head of its waitlist, returns the students enrolled.
+        Raises PromotionConflict if concurrent changes keep cancelling the transaction."""
+        promoted = []
+        conflicts = 0
+        while True:
+            class_item = self.repository.get_class(class_id, consistent=True)
+            if not class_item or class_item.get('State') != 'active':
+                return promoted
+            free_seats = int(class_item['MaxCapacity'] - class_item['CurrentEnrollment'])
+            if free_seats <= 0:
+                return promoted
+            candidates = self.waitlist.students(class_id, 0, min(free_seats, MAX_PROMOTIONS))
+            if not candidates:
+                return promoted
+
+            enrollments = self.get_enrollments(candidates, class_id)
+            stale = [
+                student_id for student_id in candidates
+                if enrollments[student_id] is None or enrollments[student_id]['EnrollmentState'] != 'WAITLISTED'
+            ]
+            if stale:
+                self.waitlist.remove_students(class_id, stale)
+                self.open_classes.adjust(class_id)
+            students = [student_id for student_id in candidates if student_id not in stale]
+            if not students:
+                continue
+            try:
+                self.enroll(class_id, [enrollments[student_id] for student_id in students], int(class_item['MaxCapacity']))
+            except TransactionCancelled:
+                # an enrollment, the class or its capacity changed since we read them, read them again
+                conflicts += 1
+                if conflicts > MAX_CONFLICTS:
+                    raise PromotionConflict(f"Promotions for class {class_id} keep conflicting")
+                continue
+            self.waitlist.remove_students(class_id, students)
+            self.open_classes.adjust(class_id, len(students))
+            promoted.extend(students)
+
+    def sweep(self):
+        """Publishes an event for every active class with a free seat and a waitlist, returns their ids"""
+        items = self.repository.active_classes()
+        free = [int(item["ClassID"]) for item in items if item["CurrentEnrollment"] < item["MaxCapacity"]]
+        lengths = self.waitlist.lengths(free)
+        waiting = [class_id for class_id in free if lengths[class_id]]
+        for class_id in waiting:
+            self.seat_events.publish(class_id)
+        return waiting
+
+
+class PromotionWorker:
+    """Consumes seat freed events as one consumer of the promoters group"""
+    def __init__(self, promoter, redis_client, consumer: str):
+        self.promoter = promoter
+        self.redis = redis_client
+        self.consumer = consumer
+        self.stopping = threading.Event()
+
+    def ensure_group(self):
+        try:
+            self.redis.xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def handle(self, messages):
+        """Promotes once for each class in messages, acknowledges the events of the classes that worked out.
+        The others stay pending and are claimed again after CLAIM_IDLE_MS."""
+        events = {}
+        for message_id, fields in messages:
+            if not fields:
+                # trimmed from the stream before it was handled, the sweep covers it
+                self.redis.xack(STREAM_KEY, GROUP, message_id)
+                continue
+            events.setdefault(int(fields[b"ClassID"]), []).append(message_id)
+        for class_id, message_ids in events.items():
+            try:
+                promoted = self.promoter.promote(class_id)
+            except (RepositoryError, PromotionConflict) as e:
+                logger.warning("Error promoting from the waitlist of class %s: %s", class_id, e)
+                continue
+            self.redis.xack(STREAM_KEY, GROUP, *message_ids)
+            if promoted:
+                logger.info("Class %s: enrolled %s from the waitlist", class_id, ", ".join(map(str, promoted)))
+
+    def claim_stale(self):
+        response = self.redis.xautoclaim(STREAM_KEY, GROUP, self.consumer, CLAIM_IDLE_MS, start_id="0-0", count=READ_COUNT)
+        # [next start id, messages] and, since Redis 7, the ids of deleted messages
+        if response[1]:
+            self.handle(response[1])
+
+    def poll(self):
+        """Claims stale events and handles the new ones, or waits up to BLOCK_MS for some"""
+        self.claim_stale()
+        for _, messages in self.redis.xreadgroup(GROUP, self.consumer, {STREAM_KEY: ">"}, count=READ_COUNT, block=BLOCK_MS):
+            self.handle(messages)
+
+    def run(self):
+        """Promotes until stop(), riding out Redis and database failures so no event is given up on"""
+        next_sweep = 0
+        backoff = MIN_BACKOFF
+        group_exists = False
+        while not self.stopping.is_set():
+            try:
+                if not group_exists:
+                    # again after a failure too, Redis may have come back empty
+                    self.ensure_group()
+                    group_exists = True
+                if time.monotonic() >= next_sweep:
+                    self.promoter.sweep()
+                    next_sweep = time.monotonic() + SWEEP_INTERVAL
+                self.poll()
+            except (redis.RedisError, RepositoryError):
+                logger.exception("Promotion worker %s failed, retrying in %s seconds", self.consumer, backoff)
+                group_exists = False
+                self.stopping.wait(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+            backoff = MIN_BACKOFF
+
+    def stop(self):
+        self.stopping.set()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ("run", "sweep"):
+        sys.exit("usage: python -m enroll.promotions run|sweep [database]")
+    settings = Settings()
+    logging.config.fileConfig(settings.logging_config, disable_existing_loggers=False)
+    database = sys.argv[2] if len(sys.argv) == 3 else settings.database
+    repository = open_repository(database)
+    if repository.in_process:
+        sys.exit(f"{database} only exists inside the enroll service, which promotes from it itself")
+    redis_client = redis.Redis(host=settings.redis_host, port=settings.redis_port, db=settings.redis_db)
+    promoter = Promoter(repository, redis_client)
+    if sys.argv[1] == "sweep":
+        print(f"Published events for {len(promoter.sweep())} classes")
+    else:
+        worker = PromotionWorker(promoter, redis_client, f"{socket.gethostname()}-{os.getpid()}")
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,297 @@
+"""Storage of the enroll service's users, classes, enrollments and id counters.
+
+enroll/api.py reads and writes through a Repository, picked by the database
+setting:
+
+- dynamodb://localhost:5500 (dynamodb:// alone for AWS), the tables created by
+  enroll/var/catalog.py, see enroll/dynamodb_repository.py
+- sqlite:///./enroll/var/enroll.db, one SQLite file in WAL mode for a single
+  node without Java, see enroll/sqlite_repository.py
+- memory://, dicts and indexes in the worker's memory, for profiling the
+  business logic without any I/O. Every worker has its own data, so run one
+  worker, see enroll/memory_repository.py
+
+Items are dicts with the DynamoDB attribute names (ClassID, MaxCapacity,
+EnrollmentState, ...) whatever the backend. Writes that have to happen together
+are passed to transact() as a list of the write operations below, which either
+all apply or, if a condition fails, none do.
+
+enroll/async_api.py awaits an AsyncRepository with the same items and writes,
+opened next to the worker's Repository by open_async_repository(): aioboto3 calls
+on DynamoDB, the Repository's calls in a thread on the other databases.
+
+Load the sample data into a SQLite database (the DynamoDB tables are loaded by
+enroll/var/catalog.py, a memory database starts with it) with
+
+    python -m enroll.repository seed sqlite:///./enroll/var/enroll.db
+"""
+import asyncio
+import contextlib
+import sys
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+
+
+class RepositoryError(Exception):
+    """A read or write the database failed or refused"""
+
+
+class ConditionFailed(RepositoryError):
+    pass
+
+
+class TransactionCancelled(RepositoryError):
+    """Nothing in the transaction was written. failed maps the index of every write whose
+    condition failed to the item as it is now, the class item for seat writes, None for others.
+    It's empty when the transaction was cancelled by a concurrent write instead."""
+    def __init__(self, message: str, failed=None):
+        super().__init__(message)
+        self.failed = failed or {}
+
+
+class TakeSeat(NamedTuple):
+    """CurrentEnrollment + 1, if the class is active and not full"""
+    class_id: int
+
+
+class FillSeats(NamedTuple):
+    """CurrentEnrollment + seats, if the class is active, CurrentEnrollment is at most limit
+    and MaxCapacity is still max_capacity"""
+    class_id: int
+    seats: int
+    limit: int
+    max_capacity: int
+
+
+class AddSeats(NamedTuple):
+    """CurrentEnrollment + delta, unconditionally"""
+    class_id: int
+    delta: int
+
+
+class PutEnrollment(NamedTuple):
+    """A new enrollment item, if there's none with its EnrollmentID"""
+    item: dict
+
+
+class SetEnrollmentState(NamedTuple):
+    """EnrollmentState = new_state, if it's still old_state"""
+    enrollment_id: int
+    old_state: str
+    new_state: str
+
+
+class Repository(ABC):
+    """What enroll/api.py and its helpers need from a database. Raises RepositoryError."""
+    # True if the data only exists in this process, so a separate promotions worker can't see it
+    in_process = False
+
+    # counters
+    @abstractmethod
+    def lease_ids(self, counter_name: str, size: int):
+        """Adds size to the counter, returns the (first, last) id of the block that makes"""
+        raise NotImplementedError
+
+    # users
+    @abstractmethod
+    def put_users(self, user_items):
+        raise NotImplementedError
+
+    # classes
+    @abstractmethod
+    def get_class(self, class_id: int, consistent: bool = False):
+        """Returns the class item or None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_classes(self, class_ids):
+        """Returns {class id: class item} of the ids that are classes"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def active_classes(self):
+        """Returns every class item in the active state"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def section_exists(self, section_number: int, course_code: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def class_sections(self):
+        """Returns the (SectionNumber, CourseCode) of every class"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_classes(self, class_items):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_class(self, class_id: int, **attributes):
+        """Sets the attributes, returns the updated class item (None if there's no such class)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_capacity(self, class_id: int, capacity: int):
+        """Sets MaxCapacity, returns the updated class item.
+        Raises ConditionFailed if more students than that are enrolled."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_seats(self, class_id: int, delta: int):
+        """Adds delta to CurrentEnrollment, returns the new CurrentEnrollment"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_class(self, class_id: int):
+        raise NotImplementedError
+
+    # enrollments
+    @abstractmethod
+    def get_enrollment(self, student_id: int, class_id: int):
+        """Returns the student's enrollment in the class (EnrollmentID and EnrollmentState) or None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def enrollment_pages(self, class_id: int, enrollment_state: str, limit: int = None, start_key=None):
+        """Yields (enrollment items, key of the next page or None) for each page of the class's
+        enrollments in a state, in EnrollmentID order"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_enrollments(self, enrollment_items):
+        """Writes the items whole, replacing any with the same EnrollmentID"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_enrollment_state(self, enrollment_id: int, new_state: str):
+        """Returns the new state, or None if there's no such enrollment"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def transact(self, writes):
+        """Applies the writes all together, raises TransactionCancelled if any condition fails"""
+        raise NotImplementedError
+
+    def put_enrollment(self, enrollment_item):
+        self.put_enrollments([enrollment_item])
+
+    def put_class(self, class_item):
+        self.put_classes([class_item])
+
+
+class AsyncRepository(ABC):
+    """The Repository methods enroll/async_api.py needs, as coroutines. Raises RepositoryError."""
+    in_process = False
+
+    @abstractmethod
+    async def lease_ids(self, counter_name: str, size: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_class(self, class_id: int, consistent: bool = False):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_enrollment(self, student_id: int, class_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def enrollment_pages(self, class_id: int, enrollment_state: str, limit: int = None, start_key=None):
+        """An async generator of the pages Repository.enrollment_pages yields"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def put_enrollment(self, enrollment_item):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_enrollment_state(self, enrollment_id: int, new_state: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def transact(self, writes):
+        raise NotImplementedError
+
+
+class ThreadedRepository(AsyncRepository):
+    """Runs the calls of a Repository in threads, for databases without an async client"""
+    def __init__(self, repository):
+        self.repository = repository
+        self.in_process = repository.in_process
+
+    async def lease_ids(self, counter_name: str, size: int):
+        return await asyncio.to_thread(self.repository.lease_ids, counter_name, size)
+
+    async def get_class(self, class_id: int, consistent: bool = False):
+        return await asyncio.to_thread(self.repository.get_class, class_id, consistent)
+
+    async def get_enrollment(self, student_id: int, class_id: int):
+        return await asyncio.to_thread(self.repository.get_enrollment, student_id, class_id)
+
+    async def enrollment_pages(self, class_id: int, enrollment_state: str, limit: int = None, start_key=None):
+        pages = self.repository.enrollment_pages(class_id, enrollment_state, limit, start_key)
+        while (page := await asyncio.to_thread(next, pages, None)) is not None:
+            yield page
+
+    async def put_enrollment(self, enrollment_item):
+        await asyncio.to_thread(self.repository.put_enrollment, enrollment_item)
+
+    async def set_enrollment_state(self, enrollment_id: int, new_state: str):
+        return await asyncio.to_thread(self.repository.set_enrollment_state, enrollment_id, new_state)
+
+    async def transact(self, writes):
+        await asyncio.to_thread(self.repository.transact, writes)
+
+
+def open_repository(database: str):
+    """The Repository for a database setting, see the module docstring"""
+    scheme, _, location = database.partition("://")
+    if scheme == "dynamodb":
+        import boto3
+        from enroll.dynamodb_repository import DynamoDBRepository
+        return DynamoDBRepository(boto3.resource("dynamodb", endpoint_url=f"http://{location}" if location else None))
+    if scheme == "sqlite":
+        from enroll.sqlite_repository import SQLiteRepository
+        # sqlite:///relative/path and sqlite:////absolute/path
+        return SQLiteRepository(location[1:])
+    if scheme == "memory":
+        from enroll.memory_repository import MemoryRepository
+        repository = MemoryRepository()
+        seed(repository)
+        return repository
+    raise ValueError(f"Unknown database {database}, use dynamodb://host:port, sqlite:///path or memory://")
+
+
+@contextlib.asynccontextmanager
+async def open_async_repository(repository):
+    """An AsyncRepository on the database of a Repository, see the module docstring"""
+    from enroll.dynamodb_repository import DynamoDBRepository, AsyncDynamoDBRepository
+    if not isinstance(repository, DynamoDBRepository):
+        yield ThreadedRepository(repository)
+        return
+    import aioboto3
+    async with aioboto3.Session().resource("dynamodb", endpoint_url=repository.client.meta.endpoint_url) as dynamo_db:
+        yield AsyncDynamoDBRepository(
+            await dynamo_db.Table("Classes"), await dynamo_db.Table("Enrollments"), await dynamo_db.Table("Counters"),
+        )
+
+
+def seed(repository):
+    """Loads the sample data of enroll/var/sample_data.py"""
+    from enroll.var import sample_data
+
+    repository.put_users(sample_data.users_items)
+    repository.put_classes(sample_data.classes_items)
+    repository.put_enrollments(sample_data.enrollments_items)
+    for counter in sample_data.counters_items:
+        repository.lease_ids(counter["CounterName"], counter["CurrentValue"])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "seed" or not sys.argv[2].startswith("sqlite://"):
+        sys.exit("usage: python -m enroll.repository seed sqlite:///path/to/enroll.db")
+    sqlite_repository = open_repository(sys.argv[2])
+    sqlite_repository.reset()
+    seed(sqlite_repository)
+    print(f"Loaded the sample data into {sys.argv[2]}")
@@ -0,0 +1,296 @@
+"""The Repository in a SQLite database file.
+
+The tables mirror the DynamoDB items, with indexes in place of the global
+secondary indexes. The database is in WAL mode, so reads don't wait for the
+writer, and every thread has its own connection. Writes run in BEGIN
+IMMEDIATE transactions, which take the write lock up front instead of failing
+to upgrade a read lock, and transactions check each write's condition in the
+WHERE clause of its statement, rolling back if one matches no row.
+
+Every call is timed as a sqlite backend call, see enroll/metrics.py.
+"""
+import contextlib
+import functools
+import sqlite3
+import threading
+
+from enroll import metrics
+from enroll.repository import (
+    Repository, RepositoryError, ConditionFailed, TransactionCancelled,
+    TakeSeat, FillSeats, AddSeats, PutEnrollment, SetEnrollmentState,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Users (
+    UserId INTEGER PRIMARY KEY,
+    Username TEXT NOT NULL,
+    Email TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS Classes (
+    ClassID INTEGER PRIMARY KEY,
+    SectionNumber INTEGER NOT NULL,
+    CourseCode TEXT NOT NULL,
+    ClassName TEXT,
+    Department TEXT,
+    InstructorID INTEGER,
+    MaxCapacity INTEGER NOT NULL,
+    CurrentEnrollment INTEGER NOT NULL DEFAULT 0,
+    CurrentWaitlist INTEGER NOT NULL DEFAULT 0,
+    State TEXT NOT NULL,
+    WaitlistMaximum INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ClassesState ON Classes (State);
+CREATE INDEX IF NOT EXISTS ClassesSection ON Classes (SectionNumber, CourseCode);
+
+CREATE TABLE IF NOT EXISTS Enrollments (
+    EnrollmentID INTEGER PRIMARY KEY,
+    StudentID INTEGER NOT NULL,
+    ClassID INTEGER NOT NULL,
+    EnrollmentState TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS EnrollmentsStudentClass ON Enrollments (StudentID, ClassID);
+CREATE INDEX IF NOT EXISTS EnrollmentsClassState ON Enrollments (ClassID, EnrollmentState, EnrollmentID);
+
+CREATE TABLE IF NOT EXISTS Counters (
+    CounterName TEXT PRIMARY KEY,
+    CurrentValue INTEGER NOT NULL
+);
+"""
+CLASS_COLUMNS = (
+    "ClassID", "SectionNumber", "CourseCode", "ClassName", "Department", "InstructorID",
+    "MaxCapacity", "CurrentEnrollment", "CurrentWaitlist", "State", "WaitlistMaximum",
+)
+ENROLLMENT_COLUMNS = ("EnrollmentID", "StudentID", "ClassID", "EnrollmentState")
+# enrollments per page when enrollment_pages has no limit
+PAGE_SIZE = 1000
+# seconds a writer waits for the write lock
+BUSY_TIMEOUT = 5
+
+
+def timed(method):
+    @functools.wraps(method)
+    def run(self, *args, **kwargs):
+        with metrics.timed("sqlite", method.__name__):
+            try:
+                return method(self, *args, **kwargs)
+            except sqlite3.Error as e:
+                raise RepositoryError(str(e)) from e
+    return run
+
+
+def placeholders(columns):
+    return ", ".join("?" for _ in columns)
+
+
+class SQLiteRepository(Repository):
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            # autocommit, transactions are begun explicitly
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode = WAL")
+            # WAL is still consistent after a crash, only the last commits can be lost to a power failure
+            db.execute("PRAGMA synchronous = NORMAL")
+            self.local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def write(self):
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def reset(self):
+        """Deletes every row"""
+        with self.write() as db:
+            for table in ("Users", "Classes", "Enrollments", "Counters"):
+                db.execute(f"DELETE FROM {table}")
+
+    @timed
+    def lease_ids(self, counter_name: str, size: int):
+        with self.write() as db:
+            db.execute(
+                "INSERT INTO Counters (CounterName, CurrentValue) VALUES (?, ?) "
+                "ON CONFLICT (CounterName) DO UPDATE SET CurrentValue = CurrentValue + excluded.CurrentValue",
+                (counter_name, size),
+            )
+            last_id = db.execute("SELECT CurrentValue FROM Counters WHERE CounterName = ?", (counter_name,)).fetchone()[0]
+        return last_id - size + 1, last_id
+
+    @timed
+    def put_users(self, user_items):
+        with self.write() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO Users (UserId, Username, Email) VALUES (?, ?, ?)",
+                [(user_item["UserId"], user_item["Username"], user_item["Email"]) for user_item in user_items],
+            )
+
+    @timed
+    def get_class(self, class_id: int, consistent: bool = False):
+        row = self.connection().execute("SELECT * FROM Classes WHERE ClassID = ?", (class_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    @timed
+    def get_classes(self, class_ids):
+        class_ids = list(class_ids)
+        rows = self.connection().execute(
+            f"SELECT * FROM Classes WHERE ClassID IN ({placeholders(class_ids)})", class_ids
+        ).fetchall()
+        return {row["ClassID"]: dict(row) for row in rows}
+
+    @timed
+    def active_classes(self):
+        return [dict(row) for row in self.connection().execute("SELECT * FROM Classes WHERE State = 'active'")]
+
+    @timed
+    def section_exists(self, section_number: int, course_code: str):
+        return self.connection().execute(
+            "SELECT 1 FROM Classes WHERE SectionNumber = ? AND CourseCode = ? LIMIT 1", (section_number, course_code)
+        ).fetchone() is not None
+
+    @timed
+    def class_sections(self):
+        return {(row[0], row[1]) for row in self.connection().execute("SELECT SectionNumber, CourseCode FROM Classes")}
+
+    @timed
+    def put_classes(self, class_items):
+        with self.write() as db:
+            db.executemany(
+                f"INSERT OR REPLACE INTO Classes ({', '.join(CLASS_COLUMNS)}) VALUES ({placeholders(CLASS_COLUMNS)})",
+                [tuple(class_item.get(column) for column in CLASS_COLUMNS) for class_item in class_items],
+            )
+
+    @timed
+    def update_class(self, class_id: int, **attributes):
+        unknown = attributes.keys() - set(CLASS_COLUMNS)
+        if unknown:
+            raise ValueError(f"Classes have no {', '.join(unknown)}")
+        with self.write() as db:
+            db.execute(
+                f"UPDATE Classes SET {', '.join(f'{name} = ?' for name in attributes)} WHERE ClassID = ?",
+                (*attributes.values(), class_id),
+            )
+            row = db.execute("SELECT * FROM Classes WHERE ClassID = ?", (class_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    @timed
+    def set_capacity(self, class_id: int, capacity: int):
+        with self.write() as db:
+            updated = db.execute(
+                "UPDATE Classes SET MaxCapacity = ? WHERE ClassID = ? AND CurrentEnrollment <= ?",
+                (capacity, class_id, capacity),
+            ).rowcount
+            if not updated:
+                raise ConditionFailed(f"Class {class_id} has more than {capacity} students enrolled")
+            return dict(db.execute("SELECT * FROM Classes WHERE ClassID = ?", (class_id,)).fetchone())
+
+    @timed
+    def add_seats(self, class_id: int, delta: int):
+        with self.write() as db:
+            db.execute("UPDATE Classes SET CurrentEnrollment = CurrentEnrollment + ? WHERE ClassID = ?", (delta, class_id))
+            row = db.execute("SELECT CurrentEnrollment FROM Classes WHERE ClassID = ?", (class_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    @timed
+    def delete_class(self, class_id: int):
+        with self.write() as db:
+            db.execute("DELETE FROM Classes WHERE ClassID = ?", (class_id,))
+
+    @timed
+    def get_enrollment(self, student_id: int, class_id: int):
+        row = self.connection().execute(
+            "SELECT EnrollmentID, EnrollmentState FROM Enrollments WHERE StudentID = ? AND ClassID = ? LIMIT 1",
+            (student_id, class_id),
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    @timed
+    def enrollment_page(self, class_id: int, enrollment_state: str, limit: int, start_key):
+        rows = self.connection().execute(
+            "SELECT EnrollmentID, StudentID, EnrollmentState FROM Enrollments "
+            "WHERE ClassID = ? AND EnrollmentState = ? AND EnrollmentID > ? ORDER BY EnrollmentID LIMIT ?",
+            (class_id, enrollment_state, start_key["EnrollmentID"] if start_key else -1, limit),
+        ).fetchall()
+        page = [dict(row) for row in rows]
+        next_key = {"EnrollmentID": page[-1]["EnrollmentID"]} if len(page) == limit else None
+        return page, next_key
+
+    def enrollment_pages(self, class_id: int, enrollment_state: str, limit: int = None, start_key=None):
+        while True:
+            page, start_key = self.enrollment_page(class_id, enrollment_state, limit or PAGE_SIZE, start_key)
+            yield page, start_key
+            if not start_key:
+                return
+
+    @timed
+    def put_enrollments(self, enrollment_items):
+        with self.write() as db:
+            db.executemany(
+                f"INSERT OR REPLACE INTO Enrollments ({', '.join(ENROLLMENT_COLUMNS)}) VALUES ({placeholders(ENROLLMENT_COLUMNS)})",
+                [tuple(item[column] for column in ENROLLMENT_COLUMNS) for item in enrollment_items],
+            )
+
+    @timed
+    def set_enrollment_state(self, enrollment_id: int, new_state: str):
+        with self.write() as db:
+            updated = db.execute(
+                "UPDATE Enrollments SET EnrollmentState = ? WHERE EnrollmentID = ?", (new_state, enrollment_id)
+            ).rowcount
+        return new_state if updated else None
+
+    def execute_write(self, db, write):
+        """Runs the write's statement, returns whether its condition held"""
+        if isinstance(write, TakeSeat):
+            cursor = db.execute(
+                "UPDATE Classes SET CurrentEnrollment = CurrentEnrollment + 1 "
+                "WHERE ClassID = ? AND State = 'active' AND CurrentEnrollment < MaxCapacity",
+                (write.class_id,),
+            )
+        elif isinstance(write, FillSeats):
+            cursor = db.execute(
+                "UPDATE Classes SET CurrentEnrollment = CurrentEnrollment + ? "
+                "WHERE ClassID = ? AND State = 'active' AND CurrentEnrollment <= ? AND MaxCapacity = ?",
+                (write.seats, write.class_id, write.limit, write.max_capacity),
+            )
+        elif isinstance(write, AddSeats):
+            db.execute("UPDATE Classes SET CurrentEnrollment = CurrentEnrollment + ? WHERE ClassID = ?", (write.delta, write.class_id))
+            return True
+        elif isinstance(write, PutEnrollment):
+            cursor = db.execute(
+                f"INSERT OR IGNORE INTO Enrollments ({', '.join(ENROLLMENT_COLUMNS)}) VALUES ({placeholders(ENROLLMENT_COLUMNS)})",
+                tuple(write.item[column] for column in ENROLLMENT_COLUMNS),
+            )
+        elif isinstance(write, SetEnrollmentState):
+            cursor = db.execute(
+                "UPDATE Enrollments SET EnrollmentState = ? WHERE EnrollmentID = ? AND EnrollmentState = ?",
+                (write.new_state, write.enrollment_id, write.old_state),
+            )
+        else:
+            raise TypeError(f"Unknown write {write!r}")
+        return cursor.rowcount == 1
+
+    @timed
+    def transact(self, writes):
+        with self.write() as db:
+            failed = {}
+            for index, write in enumerate(writes):
+                if not self.execute_write(db, write):
+                    failed[index] = None
+                    if isinstance(write, (TakeSeat, FillSeats)):
+                        row = db.execute("SELECT * FROM Classes WHERE ClassID = ?", (write.class_id,)).fetchone()
+                        failed[index] = dict(row) if row is not None else None
+            if failed:
+                # rolls the writes that worked back
+                raise TransactionCancelled("Transaction cancelled, a condition failed", failed)
@@ -0,0 +1,74 @@
+"""Bulk teardown of a class removed by /remove.
+
+Every ENROLLED and WAITLISTED enrollment of the class is rewritten as DROPPED.
+The enrollments are read a page at a time from the repository, and each page
+is cut into batches of 25 that are written (with BatchWriteItem on DynamoDB) by
+a bounded pool of threads while the next page is read. The class's waitlist keys are deleted.
+
+Progress is kept in the Redis hash teardownClassID_<classid> (state, found,
+dropped) for a day, GET /remove/{classid} returns it.
+"""
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from enroll.waitlist import waitlist_key, sequence_key
+
+BATCH_SIZE = 25
+PROGRESS_TTL = 24 * 60 * 60
+
+
+def progress_key(class_id: int):
+    return f"teardownClassID_{class_id}"
+
+
+class ClassTeardown:
+    def __init__(self, repository, redis_client, max_workers: int):
+        self.repository = repository
+        self.redis = redis_client
+        self.max_workers = max_workers
+
+    def get_progress(self, class_id: int):
+        progress = self.redis.hgetall(progress_key(class_id))
+        if not progress:
+            return None
+        return {field.decode(): int(value) if value.isdigit() else value.decode() for field, value in progress.items()}
+
+    def drop_batch(self, class_id: int, batch):
+        # enrollment items only have these four attributes, so a put replaces them whole
+        self.repository.put_enrollments([
+            {
+                "EnrollmentID": item["EnrollmentID"],
+                "StudentID": item["StudentID"],
+                "ClassID": class_id,
+                "EnrollmentState": "DROPPED",
+            }
+            for item in batch
+        ])
+        self.redis.hincrby(progress_key(class_id), "dropped", len(batch))
+        return [item["StudentID"] for item in batch]
+
+    def run(self, class_id: int):
+        """Drops every student of the class, returns their ids.
+        The class must already be inactive so nobody enrolls while this runs."""
+        key = progress_key(class_id)
+        self.redis.delete(key)
+        self.redis.hset(key, mapping={"state": "running", "found": 0, "dropped": 0, "started": int(time.time())})
+        self.redis.expire(key, PROGRESS_TTL)
+        futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for enrollment_status in ("ENROLLED", "WAITLISTED"):
+                    for page, _ in self.repository.enrollment_pages(class_id, enrollment_status):
+                        self.redis.hincrby(key, "found", len(page))
+                        for start in range(0, len(page), BATCH_SIZE):
+                            # run in the request's context so its DynamoDB call count includes the batches
+                            context = contextvars.copy_context()
+                            futures.append(pool.submit(context.run, self.drop_batch, class_id, page[start:start + BATCH_SIZE]))
+                dropped_students = [student_id for future in futures for student_id in future.result()]
+        except Exception:
+            self.redis.hset(key, "state", "failed")
+            raise
+        self.redis.delete(waitlist_key(class_id), sequence_key(class_id))
+        self.redis.hset(key, "state", "done")
+        return dropped_students
@@ -0,0 +1,191 @@
+"""Per-request traces of backend calls, and an opt-in sampling profiler.
+
+Every DynamoDB, Redis and users service call made while a request runs is
+recorded with its duration and, for DynamoDB, the table and index, the items
+returned and the capacity consumed. The trace is returned in the standard
+Server-Timing header, which browser devtools show as a timeline:
+
+    Server-Timing: dynamodb.query;dur=3.1;desc="Enrollments StudentID-ClassID-index items=1 capacity=0.5", redis.ZCARD;dur=0.2;desc="waitClassID_8"
+
+The number of DynamoDB calls goes in the X-DynamoDB-Calls header. Requests
+slower than trace_log_threshold seconds are logged in full as JSON by the
+enroll.trace logger.
+
+A request with the header X-Profile: speedscope (or html) runs its endpoint
+under the pyinstrument sampling profiler. The profile is written to
+profile_dir, its file name comes back in the X-Profile header and
+GET /profiles/{name} downloads it. Speedscope files open as a flame graph at
+https://www.speedscope.app. Setting profile_all_requests profiles every request.
+"""
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import time
+import uuid
+
+from fastapi.routing import APIRoute
+from pyinstrument import Profiler
+from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
+
+PROFILE_FORMATS = {"speedscope": (SpeedscopeRenderer, "json"), "html": (HTMLRenderer, "html")}
+# Server-Timing entries per response, the rest are only in the log
+MAX_TIMING_ENTRIES = 40
+
+logger = logging.getLogger("enroll.trace")
+
+
+class RequestTrace:
+    def __init__(self, profile_format: str = None):
+        self.calls = []
+        self.profile_format = profile_format
+        self.profile_session = None
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def record(backend: str, operation: str, seconds: float, **details):
+    """Adds a call to the trace of the request being handled, if any"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.calls.append({"backend": backend, "operation": operation, "ms": round(seconds * 1000, 3), **details})
+
+
+def dynamodb_target(params):
+    """The table (or tables) and index a DynamoDB call's parameters name"""
+    target = {}
+    if "TableName" in params:
+        target["table"] = params["TableName"]
+    elif "RequestItems" in params:
+        target["table"] = ",".join(sorted(params["RequestItems"]))
+    elif "TransactItems" in params:
+        target["table"] = ",".join(sorted({
+            request["TableName"] for item in params["TransactItems"] for request in item.values()
+        }))
+    if "IndexName" in params:
+        target["index"] = params["IndexName"]
+    return target
+
+
+def dynamodb_result(parsed):
+    """Items returned and capacity consumed by a DynamoDB call"""
+    result = {}
+    if "Count" in parsed:
+        result["items"] = parsed["Count"]
+    elif "Item" in parsed:
+        result["items"] = 1
+    elif "Responses" in parsed:
+        responses = parsed["Responses"]
+        result["items"] = sum(len(items) for items in responses.values()) if isinstance(responses, dict) else len(responses)
+    consumed = parsed.get("ConsumedCapacity")
+    if consumed:
+        consumed = consumed if isinstance(consumed, list) else [consumed]
+        result["capacity"] = sum(entry.get("CapacityUnits", 0) for entry in consumed)
+    return result
+
+
+def server_timing(calls):
+    entries = []
+    for call in calls[:MAX_TIMING_ENTRIES]:
+        description = " ".join(
+            str(value) if name in ("table", "index", "key", "path") else f"{name}={value}"
+            for name, value in call.items() if name not in ("backend", "operation", "ms")
+        )
+        entry = f"{call['backend']}.{call['operation']};dur={call['ms']}"
+        if description:
+            entry += ';desc="' + description.replace("\\", "").replace('"', "'") + '"'
+        entries.append(entry)
+    if len(calls) > MAX_TIMING_ENTRIES:
+        entries.append(f'truncated;desc="{len(calls) - MAX_TIMING_ENTRIES} more calls"')
+    return ", ".join(entries)
+
+
+class RequestTracer:
+    """Middleware tracing every request and profiling the ones that ask for it"""
+    def __init__(self, profile_dir: str, profile_all_requests: bool, log_threshold: float):
+        self.profile_dir = profile_dir
+        self.profile_all_requests = profile_all_requests
+        self.log_threshold = log_threshold
+
+    async def __call__(self, request, call_next):
+        profile_format = request.headers.get("X-Profile") or ("speedscope" if self.profile_all_requests else None)
+        trace = RequestTrace(profile_format if profile_format in PROFILE_FORMATS else None)
+        token = current_trace.set(trace)
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            current_trace.reset(token)
+        seconds = time.perf_counter() - start
+
+        response.headers["X-DynamoDB-Calls"] = str(sum(call["backend"] == "dynamodb" for call in trace.calls))
+        if trace.calls:
+            response.headers["Server-Timing"] = server_timing(trace.calls)
+        if trace.profile_session is not None:
+            response.headers["X-Profile"] = self.save_profile(trace)
+        if seconds >= self.log_threshold:
+            logger.warning(json.dumps({
+                "method": request.method,
+                "path": request.url.path,
+                "status": response.status_code,
+                "ms": round(seconds * 1000, 3),
+                "calls": trace.calls,
+            }))
+        return response
+
+    def save_profile(self, trace):
+        renderer, extension = PROFILE_FORMATS[trace.profile_format]
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.{extension}"
+        os.makedirs(self.profile_dir, exist_ok=True)
+        with open(os.path.join(self.profile_dir, name), "w") as profile_file:
+            profile_file.write(renderer().render(trace.profile_session))
+        return name
+
+
+def profile_path(profile_dir: str, name: str):
+    """The path of a saved profile, or None if there's no profile by that name"""
+    if os.path.basename(name) != name or not name.endswith(tuple("." + extension for _, extension in PROFILE_FORMATS.values())):
+        return None
+    path = os.path.join(profile_dir, name)
+    return path if os.path.isfile(path) else None
+
+
+def profiled(endpoint):
+    """Wraps an endpoint so it runs under the profiler when its request asked for a profile.
+    The profiler samples the thread it's started in, so it has to start in the endpoint
+    itself, for sync endpoints that's a threadpool thread rather than the middleware's."""
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def run_async(*args, **kwargs):
+            trace = current_trace.get()
+            if trace is None or trace.profile_format is None:
+                return await endpoint(*args, **kwargs)
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                trace.profile_session = profiler.stop()
+        return run_async
+
+    @functools.wraps(endpoint)
+    def run(*args, **kwargs):
+        trace = current_trace.get()
+        if trace is None or trace.profile_format is None:
+            return endpoint(*args, **kwargs)
+        profiler = Profiler(async_mode="disabled")
+        profiler.start()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            trace.profile_session = profiler.stop()
+    return run
+
+
+class ProfiledRoute(APIRoute):
+    """Route class for app.router.route_class, making every endpoint profiled()"""
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, profiled(endpoint), **kwargs)
@@ -0,0 +1,101 @@
+"""Client for the users service, used by the registrar endpoints to look up instructors.
+
+Calls go straight to the users service instances rather than through KrakenD,
+over a requests.Session that keeps connections alive, with a timeout on every
+call. Instances are tried in turn, so one being down doesn't fail the lookup.
+Profiles are cached per worker for a TTL, ids that aren't users aren't cached
+so a newly registered instructor is found right away.
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from enroll import metrics
+
+# ids per /getusers call
+BATCH_SIZE = 100
+
+
+class UsersServiceUnavailable(Exception):
+    pass
+
+
+class UsersClient:
+    def __init__(self, base_urls, timeout: float, ttl: float, max_entries: int, pool_size: int):
+        self.base_urls = list(base_urls)
+        self.next_url = itertools.cycle(range(len(self.base_urls)))
+        self.timeout = timeout
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=len(self.base_urls), pool_maxsize=pool_size))
+        self.profiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def call(self, path: str, params=None):
+        """GETs path from the next instance, moving on to the others if it can't be reached"""
+        with self.lock:
+            first = next(self.next_url)
+        error = None
+        for attempt in range(len(self.base_urls)):
+            base_url = self.base_urls[(first + attempt) % len(self.base_urls)]
+            try:
+                # one series per endpoint, not per user id
+                with metrics.timed("users_service", "/" + path.split("/")[1], path=path):
+                    return self.session.get(f"{base_url}{path}", params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = e
+        raise UsersServiceUnavailable(f"Users service unavailable: {error}")
+
+    def cached(self, user_id: int):
+        with self.lock:
+            entry = self.profiles.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.profiles.move_to_end(user_id)
+                return entry[1]
+            self.profiles.pop(user_id, None)
+            return None
+
+    def remember(self, profile):
+        with self.lock:
+            self.profiles[profile["userid"]] = (time.monotonic() + self.ttl, profile)
+            self.profiles.move_to_end(profile["userid"])
+            while len(self.profiles) > self.max_entries:
+                self.profiles.popitem(last=False)
+
+    def get_user(self, user_id: int):
+        """Returns the user's profile (userid, username, email, name, roles) or None if there's no such user"""
+        profile = self.cached(user_id)
+        if profile is not None:
+            return profile
+        response = self.call(f"/getuser/{user_id}")
+        if response.status_code in (400, 404):
+            return None
+        if response.status_code != 200:
+            raise UsersServiceUnavailable(f"Users service returned {response.status_code}")
+        profile = response.json()
+        self.remember(profile)
+        return profile
+
+    def get_users(self, user_ids):
+        """Returns {user id: profile} for the ids that are users, fetching the uncached ones in batches"""
+        profiles = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            profile = self.cached(user_id)
+            if profile is not None:
+                profiles[user_id] = profile
+            else:
+                missing.append(user_id)
+        for start in range(0, len(missing), BATCH_SIZE):
+            response = self.call("/getusers", params={"uid": missing[start:start + BATCH_SIZE]})
+            if response.status_code != 200:
+                raise UsersServiceUnavailable(f"Users service returned {response.status_code}")
+            for profile in response.json()["users"]:
+                self.remember(profile)
+                profiles[profile["userid"]] = profile
+        return profiles
@@ -1,6 +1,8 @@
 import boto3
 from botocore.exceptions import ClientError
 
+from sample_data import users_items, classes_items, enrollments_items, counters_items
+
 class Catalog:
     """Creates tables for the catalog database"""
     def __init__(self, dyn_resource):
@@ -12,7 +14,7 @@ class Catalog:
         # 'exists' if the table exists. Otherwise, it is set by 'create_table'.
         self.table = None
 
-    def create_table(self, table_name, key_schema, attribute_definitions, global_secondary_indexes):
+    def create_table(self, table_name, key_schema, attribute_definitions, global_secondary_indexes=None):
         """
         Creates an Amazon DynamoDB table for the catalog database.
 
@@ -20,16 +22,18 @@ class Catalog:
         :return: The newly created table.
         """
         try:
-            self.table = self.dyn_resource.create_table(
-                TableName = table_name,
-                KeySchema = key_schema,
-                AttributeDefinitions= attribute_definitions,
-                ProvisionedThroughput={
+            table_args = {
+                "TableName": table_name,
+                "KeySchema": key_schema,
+                "AttributeDefinitions": attribute_definitions,
+                "ProvisionedThroughput": {
                     "ReadCapacityUnits": 10,
                     "WriteCapacityUnits": 10,
                 },
-                GlobalSecondaryIndexes=global_secondary_indexes
-            )
+            }
+            if global_secondary_indexes:
+                table_args["GlobalSecondaryIndexes"] = global_secondary_indexes
+            self.table = self.dyn_resource.create_table(**table_args)
             self.table.wait_until_exists()
             print(f"Table {table_name} created successfully.")
         except ClientError as err:
@@ -89,6 +93,7 @@ my_catalog = Catalog(dynamo_db)
 my_catalog.delete_table_if_exists("Users")
 my_catalog.delete_table_if_exists("Classes")
 my_catalog.delete_table_if_exists("Enrollments")
+my_catalog.delete_table_if_exists("Counters")
 
 # ********************************** Create "Users table" ***************************************
 
@@ -234,78 +239,26 @@ enrollments_global_secondary_indexes = [
 # Create the "Enrollments" table
 my_catalog.create_table("Enrollments", enrollments_key_schema, enrollments_attribute_definitions, enrollments_global_secondary_indexes)
 
+# ********************************** Create "Counters table" ************************************
 
-
-# ********************************** Populate tables with data **********************************
-
-# Populate the "Users" table
-users_items = [
-    # User ID 1-4 are students
-    {"UserId": 1, "Username": "fara", "Email": "fsmith@csu.fullerton.edu"},
-    {"UserId": 2, "Username": "steve", "Email": "sjobs@csu.fullerton.edu"},
-    {"UserId": 3, "Username": "andy", "Email": "ajones@csu.fullerton.edu"},
-    {"UserId": 4, "Username": "tim", "Email": "traft@csu.fullerton.edu"},
-    # User ID 5-7 are instructors
-    {"UserId": 5, "Username": "elizabeth", "Email": "ebarnes@csu.fullerton.edu"},
-    {"UserId": 6, "Username": "george", "Email": "gderns@csu.fullerton.edu"},
-    {"UserId": 7, "Username": "pheobe", "Email": "pessek@fsmithcsu.fullerton.edu"},
-    # User ID 8-10 are registrars
-    {"UserId": 8, "Username": "earl", "Email": "epoppins@csu.fullerton.edu"},
-    {"UserId": 9, "Username": "sarah", "Email": "fsmith@csu.fullerton.edu"},
-    {"UserId": 10, "Username": "anna", "Email": "akant@csu.fullerton.edu"},
-    # All roles
-    {"UserId": 11, "Username": "micah", "Email": "mbaumann@csu.fullerton.edu"},
-    {"UserId": 12, "Username": "edwin", "Email": "edwinperaza@csu.fullerton.edu"},
+# One item per id sequence, the enroll service leases blocks of ids from these with an atomic ADD
+counters_key_schema = [
+    {"AttributeName": "CounterName", "KeyType": "HASH"}
 ]
 
-my_catalog.put_items("Users", users_items)
-
-
-# Populate the "Classes" table
-classes_items = [
-    {"ClassID": 1, "SectionNumber": 1, "CourseCode": "CS-101", "ClassName": "Introduction to Computer Science", "Department": "Computer Science", "InstructorID": 11, "MaxCapacity": 50, "CurrentEnrollment": 1, "CurrentWaitlist": 0, "State": "inactive", "WaitlistMaximum": 30},
-    {"ClassID": 2, "SectionNumber": 2, "CourseCode": "CS-101", "ClassName": "Introduction to Computer Science", "Department": "Computer Science", "InstructorID": 11, "MaxCapacity": 50, "CurrentEnrollment": 0, "CurrentWaitlist": 0, "State": "active", "WaitlistMaximum": 30},
-    
-    {"ClassID": 3, "SectionNumber": 1, "CourseCode": "ENG-101", "ClassName": "English 101", "Department": "English", "InstructorID": 11, "MaxCapacity": 30, "CurrentEnrollment": 0, "CurrentWaitlist": 0, "State": "inactive", "WaitlistMaximum": 30},
-    {"ClassID": 4, "SectionNumber": 2, "CourseCode": "ENG-101", "ClassName": "English 101", "Department": "English", "InstructorID": 11, "MaxCapacity": 30, "CurrentEnrollment": 0, "CurrentWaitlist": 0, "State": "active", "WaitlistMaximum": 30},
-    
-    {"ClassID": 5, "SectionNumber": 1, "CourseCode": "MATH-101", "ClassName": "Mathematics 101", "Department": "Mathematics", "InstructorID": 11, "MaxCapacity": 40, "CurrentEnrollment": 0, "CurrentWaitlist": 0, "State": "inactive", "WaitlistMaximum": 30},
-    {"ClassID": 6, "SectionNumber": 2, "CourseCode": "MATH-101", "ClassName": "Mathematics 101", "Department": "Mathematics", "InstructorID": 11, "MaxCapacity": 40, "CurrentEnrollment": 0, "CurrentWaitlist": 0, "State": "active", "WaitlistMaximum": 30},
-    
-    {"ClassID": 7, "SectionNumber": 1, "CourseCode": "PHYS-101", "ClassName": "Physics 101", "Department": "Physics", "InstructorID": 5, "MaxCapacity": 35, "CurrentEnrollment": 0, "CurrentWaitlist": 0, "State": "inactive", "WaitlistMaximum": 30},
-    {"ClassID": 8, "SectionNumber": 2, "CourseCode": "PHYS-101", "ClassName": "Physics 101", "Department": "Physics", "InstructorID": 5, "MaxCapacity": 35, "CurrentEnrollment": 0, "CurrentWaitlist": 0, "State": "active", "WaitlistMaximum": 30},
-    
-    {"ClassID": 9, "SectionNumber": 1, "CourseCode": "CHEM-101", "ClassName": "Chemistry 101", "Department": "Chemistry", "InstructorID": 6, "MaxCapacity": 45, "CurrentEnrollment": 0, "CurrentWaitlist": 0, "State": "inactive", "WaitlistMaximum": 30},
-    {"ClassID": 10, "SectionNumber": 2, "CourseCode": "CHEM-101", "ClassName": "Chemistry 101", "Department": "Chemistry", "InstructorID": 6, "MaxCapacity": 45, "CurrentEnrollment": 0, "CurrentWaitlist": 0, "State": "active", "WaitlistMaximum": 30},
+counters_attribute_definitions = [
+    {"AttributeName": "CounterName", "AttributeType": "S"}
 ]
 
-my_catalog.put_items("Classes", classes_items)
+# Create the "Counters" table
+my_catalog.create_table("Counters", counters_key_schema, counters_attribute_definitions)
 
 
-# Populate the "Enrollments" table
-enrollments_items = [
-    {"EnrollmentID": 1, "StudentID": 2, "ClassID": 1, "EnrollmentState": "DROPPED"},
-    {"EnrollmentID": 2, "StudentID": 2, "ClassID": 2, "EnrollmentState": "WAITLISTED"},
-    {"EnrollmentID": 3, "StudentID": 2, "ClassID": 3, "EnrollmentState": "ENROLLED"},
-    {"EnrollmentID": 4, "StudentID": 2, "ClassID": 4, "EnrollmentState": "ENROLLED"},
-    {"EnrollmentID": 5, "StudentID": 2, "ClassID": 5, "EnrollmentState": "ENROLLED"},
-    {"EnrollmentID": 6, "StudentID": 3, "ClassID": 6, "EnrollmentState": "ENROLLED"},
-    {"EnrollmentID": 8, "StudentID": 3, "ClassID": 2, "EnrollmentState": "ENROLLED"},
-    {"EnrollmentID": 9, "StudentID": 3, "ClassID": 3, "EnrollmentState": "ENROLLED"},
-    {"EnrollmentID": 10, "StudentID": 3, "ClassID": 4, "EnrollmentState": "ENROLLED"},
-    {"EnrollmentID": 11, "StudentID": 4, "ClassID": 5, "EnrollmentState": "ENROLLED"},
-    # ENROLLMENTS FOR TESTING CLASS ID 1 FOR INSTRUCTOR ID 11
-    {"EnrollmentID": 12, "StudentID": 1, "ClassID": 1, "EnrollmentState": "ENROLLED"},
-    {"EnrollmentID": 13, "StudentID": 3, "ClassID": 1, "EnrollmentState": "ENROLLED"},
-    {"EnrollmentID": 14, "StudentID": 4, "ClassID": 1, "EnrollmentState": "ENROLLED"},
-    # FOR TESTING CLADD ID 2 FOR INSTRUCTOR ID 
-    {"EnrollmentID": 15, "StudentID": 1, "ClassID": 2, "EnrollmentState": "ENROLLED"},
-    {"EnrollmentID": 16, "StudentID": 4, "ClassID": 2, "EnrollmentState": "ENROLLED"},
-    {"EnrollmentID": 17, "StudentID": 12, "ClassID": 2, "EnrollmentState": "ENROLLED"},
-    # FOR TESTING DROP
-    {"EnrollmentID": 18, "StudentID": 11, "ClassID": 1, "EnrollmentState": "ENROLLED"}
 
-]
+# ********************************** Populate tables with data **********************************
 
+# the sample data is in sample_data.py, shared with the SQLite and in-memory databases
+my_catalog.put_items("Users", users_items)
+my_catalog.put_items("Classes", classes_items)
 my_catalog.put_items("Enrollments", enrollments_items)
-
+my_catalog.put_items("Counters", counters_items)
@@ -0,0 +1,189 @@
+"""Redis waitlists for classes.
+
+Each class has a sorted set waitClassID_<classid> of student ids, scored by the
+order they joined in (from the counter waitSeqClassID_<classid>), so the lowest
+score is next to be enrolled. Rank, membership and removal are O(log n), and a
+student's rank only moves when someone ahead of them leaves.
+
+Every mutation is a Lua script, so it runs atomically on the Redis server in a
+single round trip, and concurrent requests can't push a student twice or
+overflow the class's WaitlistMaximum.
+
+Waitlists created before the sorted sets were plain lists, convert them with
+
+    python -m enroll.waitlist migrate
+"""
+import sys
+
+# push result codes, a successful push returns the student's position (1 is next)
+ALREADY_WAITLISTED = -1
+WAITLIST_FULL = -2
+
+# KEYS[1] waitlist, KEYS[2] sequence, ARGV[1] student id, ARGV[2] waitlist maximum
+PUSH_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return -1
+end
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return -2
+end
+redis.call('ZADD', KEYS[1], redis.call('INCR', KEYS[2]), ARGV[1])
+return redis.call('ZRANK', KEYS[1], ARGV[1]) + 1
+"""
+
+# KEYS[1] waitlist, returns {student id, students left} or nil when empty
+POP_SCRIPT = """
+local popped = redis.call('ZPOPMIN', KEYS[1])
+if #popped == 0 then
+    return nil
+end
+return {popped[1], redis.call('ZCARD', KEYS[1])}
+"""
+
+# KEYS[1] waitlist, ARGV[1] student id, returns the position they had or 0
+REMOVE_SCRIPT = """
+local rank = redis.call('ZRANK', KEYS[1], ARGV[1])
+if not rank then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+return rank + 1
+"""
+
+# KEYS[1] waitlist, KEYS[2] sequence, converts a list waitlist to a sorted set
+# keeping its order, returns the number of students or -1 if it isn't a list
+MIGRATE_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'list' then
+    return -1
+end
+local students = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+local sequence = tonumber(redis.call('GET', KEYS[2]) or '0')
+for _, student in ipairs(students) do
+    if not redis.call('ZSCORE', KEYS[1], student) then
+        sequence = sequence + 1
+        redis.call('ZADD', KEYS[1], sequence, student)
+    end
+end
+redis.call('SET', KEYS[2], sequence)
+return redis.call('ZCARD', KEYS[1])
+"""
+
+
+def waitlist_key(class_id: int):
+    return f"waitClassID_{class_id}"
+
+
+def sequence_key(class_id: int):
+    return f"waitSeqClassID_{class_id}"
+
+
+def parse_pop(result):
+    if result is None:
+        return None, 0
+    student_id, remaining = result
+    return int(student_id), remaining
+
+
+def parse_rank(rank):
+    return None if rank is None else rank + 1
+
+
+class Waitlist:
+    """Waitlist operations on a redis.Redis client"""
+    def __init__(self, r):
+        self.redis = r
+        self.push_script = r.register_script(PUSH_SCRIPT)
+        self.pop_script = r.register_script(POP_SCRIPT)
+        self.remove_script = r.register_script(REMOVE_SCRIPT)
+
+    def push(self, class_id: int, student_id: int, maximum: int):
+        """Appends the student unless they are already waitlisted or the waitlist is full"""
+        return self.push_script(keys=[waitlist_key(class_id), sequence_key(class_id)], args=[student_id, int(maximum)])
+
+    def pop(self, class_id: int):
+        """Removes the student at the head, returns (student id, students left) or (None, 0)"""
+        return parse_pop(self.pop_script(keys=[waitlist_key(class_id)]))
+
+    def remove(self, class_id: int, student_id: int):
+        """Removes the student, returns the position they had or 0 if they weren't on the waitlist"""
+        return self.remove_script(keys=[waitlist_key(class_id)], args=[student_id])
+
+    def remove_students(self, class_id: int, student_ids):
+        """Removes the students, returns how many of them were on the waitlist"""
+        return self.redis.zrem(waitlist_key(class_id), *student_ids)
+
+    def length(self, class_id: int):
+        return self.redis.zcard(waitlist_key(class_id))
+
+    def position(self, class_id: int, student_id: int):
+        """Position of the student (1 is next) or None if they aren't on the waitlist"""
+        return parse_rank(self.redis.zrank(waitlist_key(class_id), student_id))
+
+    def students(self, class_id: int, start: int = 0, count: int = None):
+        """Students in waitlist order, count of them from position start + 1, or all of them"""
+        stop = -1 if count is None else start + count - 1
+        return [int(student) for student in self.redis.zrange(waitlist_key(class_id), start, stop)]
+
+    def lengths(self, class_ids):
+        """Returns the waitlist length of every class, sent to Redis as one pipeline"""
+        pipe = self.redis.pipeline(transaction=False)
+        for class_id in class_ids:
+            pipe.zcard(waitlist_key(class_id))
+        return dict(zip(class_ids, pipe.execute()))
+
+    def migrate(self):
+        """Converts every list waitlist to a sorted set, returns {key: students}"""
+        migrate_script = self.redis.register_script(MIGRATE_SCRIPT)
+        migrated = {}
+        for key in self.redis.scan_iter(match=waitlist_key("*"), _type="list"):
+            class_id = key.decode().removeprefix(waitlist_key(""))
+            students = migrate_script(keys=[key, sequence_key(class_id)])
+            if students >= 0:
+                migrated[key.decode()] = students
+        return migrated
+
+
+class AsyncWaitlist:
+    """Waitlist operations on a redis.asyncio.Redis client"""
+    def __init__(self, r):
+        self.redis = r
+        self.push_script = r.register_script(PUSH_SCRIPT)
+        self.pop_script = r.register_script(POP_SCRIPT)
+        self.remove_script = r.register_script(REMOVE_SCRIPT)
+
+    async def push(self, class_id: int, student_id: int, maximum: int):
+        return await self.push_script(keys=[waitlist_key(class_id), sequence_key(class_id)], args=[student_id, int(maximum)])
+
+    async def pop(self, class_id: int):
+        return parse_pop(await self.pop_script(keys=[waitlist_key(class_id)]))
+
+    async def remove(self, class_id: int, student_id: int):
+        return await self.remove_script(keys=[waitlist_key(class_id)], args=[student_id])
+
+    async def length(self, class_id: int):
+        return await self.redis.zcard(waitlist_key(class_id))
+
+    async def position(self, class_id: int, student_id: int):
+        return parse_rank(await self.redis.zrank(waitlist_key(class_id), student_id))
+
+    async def students(self, class_id: int, start: int = 0, count: int = None):
+        stop = -1 if count is None else start + count - 1
+        return [int(student) for student in await self.redis.zrange(waitlist_key(class_id), start, stop)]
+
+    async def lengths(self, class_ids):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for class_id in class_ids:
+                pipe.zcard(waitlist_key(class_id))
+            return dict(zip(class_ids, await pipe.execute()))
+
+
+if __name__ == "__main__":
+    import redis
+
+    if sys.argv[1:] != ["migrate"]:
+        sys.exit("usage: python -m enroll.waitlist migrate")
+    migrated = Waitlist(redis.Redis()).migrate()
+    for key, students in migrated.items():
+        print(f"{key}: {students} students")
+    print(f"Converted {len(migrated)} waitlists to sorted sets")
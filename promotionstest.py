@@ -0,0 +1,97 @@
+"""Changes a class's capacity while enroll/promotions.py is promoting into it.
+
+Needs a local redis-server, run from the project root:
+
+    python promotionstest.py [database ...]
+
+The databases default to memory:// and a throwaway SQLite file, pass
+dynamodb://localhost:5500 to run against DynamoDB Local too. It writes class
+999999 and enrollments from 900000 on.
+"""
+import os
+import sys
+import tempfile
+
+import redis
+
+from enroll.promotions import Promoter
+from enroll.repository import open_repository, TransactionCancelled, FillSeats
+from enroll.waitlist import Waitlist, waitlist_key, sequence_key
+
+CLASS_ID = 999999
+FIRST_STUDENT = 900000
+
+db = redis.Redis()
+waitlist = Waitlist(db)
+
+
+class CapacityChangedAfterRead:
+    """Delegates to the repository, lowering the class's capacity right after the promoter first reads it"""
+    def __init__(self, repository, capacity: int):
+        self.repository = repository
+        self.capacity = capacity
+        self.changed = False
+
+    def get_class(self, class_id: int, consistent: bool = False):
+        class_item = self.repository.get_class(class_id, consistent)
+        if not self.changed:
+            self.changed = True
+            # what PUT /capacity does, allowed since CurrentEnrollment is still below it
+            self.repository.set_capacity(class_id, self.capacity)
+        return class_item
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
+
+
+def set_up(repository, max_capacity: int, enrolled: int, waitlisted: int):
+    repository.put_classes([{
+        "ClassID": CLASS_ID, "SectionNumber": 99, "CourseCode": "TEST-999", "ClassName": "Promotions test",
+        "Department": "Test", "InstructorID": 11, "MaxCapacity": max_capacity, "CurrentEnrollment": enrolled,
+        "CurrentWaitlist": 0, "State": "active", "WaitlistMaximum": 30,
+    }])
+    db.delete(waitlist_key(CLASS_ID), sequence_key(CLASS_ID))
+    students = range(FIRST_STUDENT, FIRST_STUDENT + waitlisted)
+    repository.put_enrollments([
+        {"EnrollmentID": student_id, "StudentID": student_id, "ClassID": CLASS_ID, "EnrollmentState": "WAITLISTED"}
+        for student_id in students
+    ])
+    for student_id in students:
+        waitlist.push(CLASS_ID, student_id, 30)
+
+
+def test_fill_seats_refuses_a_changed_capacity(repository):
+    set_up(repository, max_capacity=10, enrolled=5, waitlisted=0)
+    repository.set_capacity(CLASS_ID, 6)
+    try:
+        repository.transact([FillSeats(CLASS_ID, 5, 5, 10)])
+    except TransactionCancelled as e:
+        assert 0 in e.failed, e.failed
+    else:
+        raise AssertionError("FillSeats wrote with a stale MaxCapacity")
+    assert repository.get_class(CLASS_ID, consistent=True)["CurrentEnrollment"] == 5
+
+
+def test_promote_never_overfills_when_capacity_drops(repository):
+    set_up(repository, max_capacity=10, enrolled=5, waitlisted=5)
+    promoter = Promoter(CapacityChangedAfterRead(repository, 6), db)
+    promoted = promoter.promote(CLASS_ID)
+    class_item = repository.get_class(CLASS_ID, consistent=True)
+    assert class_item["MaxCapacity"] == 6, class_item
+    assert class_item["CurrentEnrollment"] == 6, f"{class_item['CurrentEnrollment']} enrolled in 6 seats"
+    assert promoted == [FIRST_STUDENT], promoted
+    assert waitlist.students(CLASS_ID) == list(range(FIRST_STUDENT + 1, FIRST_STUDENT + 5))
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        databases = sys.argv[1:] or ["memory://", f"sqlite:///{os.path.join(directory, 'enroll.db')}"]
+        for database in databases:
+            repository = open_repository(database)
+            try:
+                test_fill_seats_refuses_a_changed_capacity(repository)
+                test_promote_never_overfills_when_capacity_drops(repository)
+            finally:
+                repository.delete_class(CLASS_ID)
+                db.delete(waitlist_key(CLASS_ID), sequence_key(CLASS_ID))
+            print(f"promotions on {database} OK")
@@ -7,4 +7,9 @@ echo " "
 # one instance of the users service plus two replicas
 # one instance of the krakend service
 # one instance of the dynamodb service
-foreman start --formation "enroll=3, users_primary=1, users_secondary_1=1, users_secondary_2=1, krakend=1, dynamodb_local=1"
+# one waitlist promotion worker, unless the enroll service keeps its data in memory and promotes itself
+promotions=1
+if grep -q '^DATABASE=memory://' enroll/.env; then
+    promotions=0
+fi
+foreman start --formation "enroll=3, users_primary=1, users_secondary_1=1, users_secondary_2=1, krakend=1, dynamodb_local=1, promotions=$promotions"
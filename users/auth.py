@@ -1,7 +1,19 @@
 import sqlite3
 import contextlib
+import contextvars
+import functools
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 
-from fastapi import FastAPI, Depends, HTTPException, status
+import redis
+
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Request, Response
+from fastapi.responses import FileResponse, JSONResponse
+from fastapi.routing import APIRoute
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 
@@ -11,6 +23,9 @@ import secrets
 import datetime
 from typing import List
 import itertools
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from pyinstrument import Profiler
+from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
 
 ALGORITHM = "pbkdf2_sha256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
@@ -20,6 +35,31 @@ class Settings(BaseSettings, env_file="users/.env", extra="ignore"):
     database_2: str
     database_3: str
     logging_config: str
+    # a request sent with X-Profile: speedscope (or html) is profiled, see profiled()
+    profile_dir: str = "./users/var/profiles"
+    profile_all_requests: bool = False
+    # processes hashing passwords, see HashPool
+    hash_workers: int = os.cpu_count() or 1
+    # hashes running or waiting for a process before requests get a 429, keep it below the
+    # 40 threadpool threads so cheap endpoints always have threads left
+    hash_queue_size: int = 16
+    # login admission control, see admit_login
+    redis_host: str = "localhost"
+    redis_port: int = 6379
+    redis_db: int = 0
+    # attempts per second and burst, per username and per client address
+    login_username_rate: float = 0.2
+    login_username_burst: int = 5
+    login_client_rate: float = 2
+    login_client_burst: int = 20
+    # this many failures of a username within login_failure_window seconds lock it for login_lockout_seconds
+    login_lockout_failures: int = 10
+    login_failure_window: int = 900
+    login_lockout_seconds: int = 900
+    # addresses of proxies (KrakenD) whose X-Forwarded-For names the real client, e.g. ["10.0.0.5"].
+    # Leave it empty while anything else can reach the service on the same address, the enroll
+    # service calls it directly and could otherwise claim any client address.
+    trusted_proxies: list[str] = []
 
 class User(BaseModel):
     username : str
@@ -35,18 +75,301 @@ class Login(BaseModel):
 settings = Settings()
 read_replicas = itertools.cycle([settings.database_2, settings.database_3])
 
+# served by /metrics in the Prometheus text format, the _count of a histogram is the number of calls
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling requests",
+    ["method", "route", "status"],
+)
+BACKEND_LATENCY = Histogram(
+    "backend_call_duration_seconds",
+    "Time spent in SQLite statements and password hashing",
+    ["backend", "operation"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+BACKEND_ERRORS = Counter(
+    "backend_call_errors_total",
+    "SQLite statements, password hashes and Redis calls that failed",
+    ["backend", "operation"],
+)
+HASH_QUEUE_DEPTH = Gauge(
+    "password_hash_queue_depth",
+    "Password hashes running or waiting for a hashing process",
+)
+HASH_REJECTED = Counter(
+    "password_hash_rejected_total",
+    "Requests turned away with a 429 because the hash queue was full",
+)
+LOGIN_REJECTED = Counter(
+    "login_rejected_total",
+    "Login and password check attempts refused before hashing",
+    ["reason"],
+)
+
+# the calls of the request being handled, returned in its Server-Timing header
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+@contextlib.contextmanager
+def timed(backend, operation):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        BACKEND_ERRORS.labels(backend, operation).inc()
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        BACKEND_LATENCY.labels(backend, operation).observe(seconds)
+        trace = current_trace.get()
+        if trace is not None:
+            trace["calls"].append(f"{backend}.{operation};dur={round(seconds * 1000, 3)}")
+
+class TimedConnection(sqlite3.Connection):
+    """Times every statement by its kind (SELECT, INSERT, ...) and every commit"""
+    def execute(self, sql, parameters=()):
+        with timed("sqlite", sql.split(None, 1)[0].upper()):
+            return super().execute(sql, parameters)
+
+    def commit(self):
+        with timed("sqlite", "COMMIT"):
+            return super().commit()
+
+redis_client = redis.Redis(host=settings.redis_host, port=settings.redis_port, db=settings.redis_db)
+
+# KEYS[1] username bucket, KEYS[2] client bucket, KEYS[3] username lockout,
+# ARGV[1] username rate, ARGV[2] username burst, ARGV[3] client rate, ARGV[4] client burst.
+# Returns {reason, milliseconds to wait}, reason is ok, locked, username or client.
+# A token is only taken from both buckets or neither, so a refused attempt costs nothing.
+ADMIT_SCRIPT = """
+local locked = redis.call('PTTL', KEYS[3])
+if locked > 0 then
+    return {'locked', locked}
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local function level(key, rate, burst)
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    return math.min(burst, tokens + (now - updated) * rate)
+end
+local buckets = {
+    {'username', KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2])},
+    {'client', KEYS[2], tonumber(ARGV[3]), tonumber(ARGV[4])},
+}
+for _, bucket in ipairs(buckets) do
+    bucket[5] = level(bucket[2], bucket[3], bucket[4])
+    if bucket[5] < 1 then
+        return {bucket[1], math.ceil((1 - bucket[5]) / bucket[3] * 1000)}
+    end
+end
+for _, bucket in ipairs(buckets) do
+    redis.call('HSET', bucket[2], 'tokens', tostring(bucket[5] - 1), 'updated', tostring(now))
+    -- a full bucket is the same as none
+    redis.call('PEXPIRE', bucket[2], math.ceil(bucket[4] / bucket[3] * 1000))
+end
+return {'ok', 0}
+"""
+
+# KEYS[1] username failures, KEYS[2] username lockout,
+# ARGV[1] failure window, ARGV[2] failures before lockout, ARGV[3] lockout seconds
+FAILURE_SCRIPT = """
+local failures = redis.call('INCR', KEYS[1])
+if failures == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+if failures >= tonumber(ARGV[2]) then
+    redis.call('SET', KEYS[2], 1, 'EX', ARGV[3])
+    redis.call('DEL', KEYS[1])
+end
+return failures
+"""
+
+admit_script = redis_client.register_script(ADMIT_SCRIPT)
+failure_script = redis_client.register_script(FAILURE_SCRIPT)
+
+def client_address(request: Request):
+    """The peer address, or for a trusted proxy the last X-Forwarded-For hop it didn't add itself"""
+    peer = request.client.host if request.client else "unknown"
+    if peer not in settings.trusted_proxies:
+        return peer
+    hops = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if hop not in settings.trusted_proxies:
+            return hop
+    return peer
+
+def admit_login(request: Request, username: str):
+    """Refuses the attempt with a 429 if the username is locked out or it or the client is
+    over its rate, before any hashing. Lets everything through if Redis is down."""
+    try:
+        with timed("redis", "admit"):
+            reason, wait_ms = admit_script(
+                keys=[f"loginTokensUser_{username}", f"loginTokensClient_{client_address(request)}", f"loginLockout_{username}"],
+                args=[settings.login_username_rate, settings.login_username_burst, settings.login_client_rate, settings.login_client_burst],
+            )
+    except redis.RedisError:
+        return
+    reason = reason.decode()
+    if reason == "ok":
+        return
+    LOGIN_REJECTED.labels(reason).inc()
+    detail = "Too many failed attempts, the account is locked for now" if reason == "locked" else "Too many attempts, try again later"
+    raise HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(max(1, -(-wait_ms // 1000)))})
+
+def record_login(username: str, succeeded: bool):
+    """Counts a failed attempt towards the username's lockout, a success clears the count"""
+    try:
+        with timed("redis", "record_login"):
+            if succeeded:
+                redis_client.delete(f"loginFailures_{username}")
+            else:
+                failure_script(
+                    keys=[f"loginFailures_{username}", f"loginLockout_{username}"],
+                    args=[settings.login_failure_window, settings.login_lockout_failures, settings.login_lockout_seconds],
+                )
+    except redis.RedisError:
+        pass
+
+# the threadpool may close a connection from another thread than the one that opened it,
+# never two at once though, so check_same_thread is off
 def get_db_read():
-    with contextlib.closing(sqlite3.connect(next(read_replicas))) as db:
+    with contextlib.closing(sqlite3.connect(next(read_replicas), factory=TimedConnection, check_same_thread=False)) as db:
         db.row_factory = sqlite3.Row
         yield db
 
 def get_db_write():
-    with contextlib.closing(sqlite3.connect(settings.database)) as db:
+    with contextlib.closing(sqlite3.connect(settings.database, factory=TimedConnection, check_same_thread=False)) as db:
         db.row_factory = sqlite3.Row
         yield db
 
 
-app = FastAPI()
+PROFILE_FORMATS = {"speedscope": (SpeedscopeRenderer, "json"), "html": (HTMLRenderer, "html")}
+
+def profiled(endpoint):
+    """Runs the endpoint under the sampling profiler if its request asked for a profile.
+    The profiler only samples the thread it starts in, the endpoints here all run in the threadpool."""
+    @functools.wraps(endpoint)
+    def run(*args, **kwargs):
+        trace = current_trace.get()
+        if trace is None or trace["profile_format"] is None:
+            return endpoint(*args, **kwargs)
+        profiler = Profiler(async_mode="disabled")
+        profiler.start()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            trace["profile_session"] = profiler.stop()
+    return run
+
+class ProfiledRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, profiled(endpoint), **kwargs)
+
+def save_profile(profile_format, session):
+    renderer, extension = PROFILE_FORMATS[profile_format]
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.{extension}"
+    os.makedirs(settings.profile_dir, exist_ok=True)
+    with open(os.path.join(settings.profile_dir, name), "w") as profile_file:
+        profile_file.write(renderer().render(session))
+    return name
+
+
+class HashQueueFull(Exception):
+    pass
+
+class HashPool:
+    """Runs PBKDF2 in a pool of processes, so hashing doesn't hold the GIL the endpoints need.
+
+    At most queue_size hashes are running or waiting at once, the next one raises
+    HashQueueFull instead of queueing, so a burst of logins can't take every threadpool thread.
+    """
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.pool = None
+
+    def start(self):
+        # spawned rather than forked from a process with threads running
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        # start the processes now rather than on the first login
+        for future in [self.pool.submit(hashlib.pbkdf2_hmac, "sha256", b"", b"", 1) for _ in range(self.workers)]:
+            future.result()
+
+    def stop(self):
+        self.pool.shutdown(cancel_futures=True)
+
+    def pbkdf2(self, password: bytes, salt: bytes, iterations: int):
+        if not self.slots.acquire(blocking=False):
+            HASH_REJECTED.inc()
+            raise HashQueueFull()
+        HASH_QUEUE_DEPTH.inc()
+        try:
+            # includes the wait for a hashing process
+            with timed("cpu", "pbkdf2"):
+                return self.pool.submit(hashlib.pbkdf2_hmac, "sha256", password, salt, iterations).result()
+        finally:
+            HASH_QUEUE_DEPTH.dec()
+            self.slots.release()
+
+hash_pool = HashPool(settings.hash_workers, settings.hash_queue_size)
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    hash_pool.start()
+    yield
+    hash_pool.stop()
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = ProfiledRoute
+
+@app.exception_handler(HashQueueFull)
+async def hash_queue_full(request: Request, exc: HashQueueFull):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Too many password checks in progress, try again"},
+        headers={"Retry-After": "1"},
+    )
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    profile_format = request.headers.get("X-Profile") or ("speedscope" if settings.profile_all_requests else None)
+    trace = {"calls": [], "profile_format": profile_format if profile_format in PROFILE_FORMATS else None, "profile_session": None}
+    token = current_trace.set(trace)
+    try:
+        response = await call_next(request)
+    finally:
+        current_trace.reset(token)
+    if trace["calls"]:
+        response.headers["Server-Timing"] = ", ".join(trace["calls"])
+    if trace["profile_session"] is not None:
+        response.headers["X-Profile"] = save_profile(trace["profile_format"], trace["profile_session"])
+    return response
+
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(request.method, route.path if route else "unmatched", status_code).observe(time.perf_counter() - start)
+    return response
+
+@app.get("/metrics")
+def get_metrics():
+    """Request latencies, SQLite statements and password hashing (and its queue) of this worker, in the Prometheus text format."""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/profiles/{name}")
+def get_profile(name: str):
+    """A profile saved for a request sent with an X-Profile header."""
+    path = os.path.join(settings.profile_dir, name)
+    if os.path.basename(name) != name or not name.endswith((".json", ".html")) or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path)
 
 # given 260000 - modified to 600000 based on research
 def get_hashed_pwd(password, salt=None, iterations=600000):
@@ -54,9 +377,7 @@ def get_hashed_pwd(password, salt=None, iterations=600000):
         salt = secrets.token_hex(16)
     assert salt and isinstance(salt, str) and "$" not in salt
     assert isinstance(password, str)
-    pw_hash = hashlib.pbkdf2_hmac(
-        "sha256", password.encode("utf-8"), salt.encode("utf-8"), iterations
-    )
+    pw_hash = hash_pool.pbkdf2(password.encode("utf-8"), salt.encode("utf-8"), iterations)
     b64_hash = base64.b64encode(pw_hash).decode("ascii").strip()
     return "{}${}${}${}".format(ALGORITHM, iterations, salt, b64_hash)
 
@@ -130,7 +451,7 @@ def register_user(user_data: User, db_read: sqlite3.Connection = Depends(get_db_
     return {"status" : "200 OK","message": f"User {username} successfully registered with role {roles}."}
 
 @app.post("/login")
-def login(user_data: Login, db: sqlite3.Connection = Depends(get_db_read)):
+def login(user_data: Login, request: Request, db: sqlite3.Connection = Depends(get_db_read)):
     """Login an existing user and generate JWT token for future requests."""
     '''
     Request body
@@ -142,10 +463,13 @@ def login(user_data: Login, db: sqlite3.Connection = Depends(get_db_read)):
     '''
     username = user_data.username
     userpwd = user_data.password
+    admit_login(request, username)
 
     user_verify = db.execute(f"SELECT * FROM Registrations WHERE username = ?",(username,)).fetchone()
 
-    if user_verify is None or not verify_password(userpwd, user_verify[4]):
+    verified = user_verify is not None and verify_password(userpwd, user_verify[4])
+    record_login(username, verified)
+    if not verified:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
     
     roles = db.execute(f"SELECT roles.rolename FROM roles JOIN userroles ON roles.roleid = userroles.roleid WHERE userroles.userid=?",(user_verify[0],)).fetchall()
@@ -157,7 +481,7 @@ def login(user_data: Login, db: sqlite3.Connection = Depends(get_db_read)):
     return {"access_token": jwt_claims}
 
 @app.post("/checkpwd")
-def checkpwd(user_data: Login, db: sqlite3.Connection = Depends(get_db_read)):
+def checkpwd(user_data: Login, request: Request, db: sqlite3.Connection = Depends(get_db_read)):
     """Check if the password is correct or not."""
 
     '''
@@ -169,9 +493,12 @@ def checkpwd(user_data: Login, db: sqlite3.Connection = Depends(get_db_read)):
     '''
     username = user_data.username
     userpwd = user_data.password
+    admit_login(request, username)
     user_verify = db.execute(f"SELECT * FROM Registrations WHERE username = ?",(username,)).fetchone()
     
-    if user_verify is None or not verify_password(userpwd, user_verify[4]):
+    verified = user_verify is not None and verify_password(userpwd, user_verify[4])
+    record_login(username, verified)
+    if not verified:
        raise HTTPException(status_code=400, detail="Incorrect username or password")
     return {"detail" : "Password Correct"}
 
@@ -190,4 +517,23 @@ def getuser(uid: int, db: sqlite3.Connection = Depends(get_db_read)):
         "userid": user["UserId"],
         "username": user["Username"],
         "roles": roles
-    }
\ No newline at end of file
+    }
+
+@app.get("/getusers")
+def getusers(uid: List[int] = Query(..., max_length=500), db: sqlite3.Connection = Depends(get_db_read)):
+    # Gets the information of many users at once, ids that aren't users are left out
+    placeholders = ",".join("?" * len(uid))
+    users = db.execute(f"SELECT Email, FullName, UserId, Username FROM Registrations WHERE UserId IN ({placeholders})", uid).fetchall()
+    roles = {}
+    for row in db.execute(f"SELECT userroles.userid, roles.rolename FROM roles JOIN userroles ON roles.roleid = userroles.roleid WHERE userroles.userid IN ({placeholders})", uid):
+        roles.setdefault(row[0], []).append(row[1])
+    return {"users": [
+        {
+            "email": user["Email"],
+            "name": user["FullName"],
+            "userid": user["UserId"],
+            "username": user["Username"],
+            "roles": roles.get(user["UserId"], [])
+        }
+        for user in users
+    ]}
@@ -0,0 +1,83 @@
+"""Hammers the waitlist scripts in enroll/waitlist.py from many threads.
+
+Needs a local redis-server, run from the project root:
+
+    python waitlisttest.py
+"""
+import threading
+from collections import Counter
+
+import redis
+
+from enroll.waitlist import Waitlist, waitlist_key, ALREADY_WAITLISTED, WAITLIST_FULL
+
+THREADS = 32
+CLASS_ID = 999999
+MAXIMUM = 100
+
+db = redis.Redis(connection_pool=redis.BlockingConnectionPool(max_connections=THREADS))
+waitlist = Waitlist(db)
+
+
+def run_threads(target, *args):
+    threads = [threading.Thread(target=target, args=(n, *args)) for n in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_push_never_overflows_or_duplicates():
+    db.delete(waitlist_key(CLASS_ID))
+    results = Counter()
+    lock = threading.Lock()
+
+    def push(n):
+        # every thread tries the same 200 students, so each one is pushed 32 times
+        for student_id in range(200):
+            result = waitlist.push(CLASS_ID, student_id, MAXIMUM)
+            with lock:
+                results["pushed" if result > 0 else result] += 1
+
+    run_threads(push)
+    students = waitlist.students(CLASS_ID)
+    assert len(students) == MAXIMUM, len(students)
+    assert len(set(students)) == MAXIMUM, "a student was pushed twice"
+    assert results["pushed"] == MAXIMUM, results
+    assert results[ALREADY_WAITLISTED] + results[WAITLIST_FULL] == THREADS * 200 - MAXIMUM, results
+
+
+def test_pop_and_remove_hand_out_each_student_once():
+    db.delete(waitlist_key(CLASS_ID))
+    for student_id in range(MAXIMUM):
+        waitlist.push(CLASS_ID, student_id, MAXIMUM)
+    taken = []
+    lock = threading.Lock()
+
+    def take(n):
+        while True:
+            # half the threads pop from the head, the others remove from the middle
+            if n % 2:
+                student_id, _ = waitlist.pop(CLASS_ID)
+                if student_id is None:
+                    return
+            else:
+                students = waitlist.students(CLASS_ID)
+                if not students:
+                    return
+                student_id = students[len(students) // 2]
+                if not waitlist.remove(CLASS_ID, student_id):
+                    continue
+            with lock:
+                taken.append(student_id)
+
+    run_threads(take)
+    assert sorted(taken) == list(range(MAXIMUM)), "a student was lost or taken twice"
+    assert waitlist.students(CLASS_ID) == []
+
+
+if __name__ == "__main__":
+    test_push_never_overflows_or_duplicates()
+    test_pop_and_remove_hand_out_each_student_once()
+    db.delete(waitlist_key(CLASS_ID))
+    print("waitlist scripts OK")